@@ -2,8 +2,9 @@
 BOT_NAME = 'catbot'
 BOT_ID = ''
 AT_BOT = '<@' + BOT_ID + '>'
-READ_WEBSOCKET_DELAY = 1 # 1 second delay between reading from firehose
-MAX_PARALLEL_REQUESTS = 10 # not more than 10 threads at any given time
+READ_WEBSOCKET_DELAY = 1 # max seconds to wait for events from firehose before checking on running jobs
+MAX_PARALLEL_REQUESTS = 10 # not more than 10 commands processed at any given time
+MAX_QUEUED_REQUESTS = 100 # commands waiting beyond that are queued in order
 
 #Catmaid credentials
 SERVER_URL = ''
@@ -25,3 +26,44 @@ JANELIA_GMR_DB = ''
 
 # Folder with FAFB nightly dumps
 FAFB_DUMP = ''
+
+# Number of persistent NBLAST worker processes
+NBLAST_WORKERS = 2
+
+# NBLAST engine for nblast-fafb: 'python' (nblast_engine.py) or 'r' (nat.nblast)
+NBLAST_ENGINE = 'python'
+
+# nblast-fafb: skip targets without any point within N microns of the query
+# (smaller = more aggressive pruning but approximate). 'auto' uses the scoring
+# matrix's second-to-last distance break, which is lossless. None to disable.
+NBLAST_PREFILTER = 'auto'
+
+# Folder for cached NBLAST results (None to disable) and its max size in bytes
+NBLAST_CACHE = 'nblast_cache'
+NBLAST_CACHE_SIZE = 500 * 1024 ** 2
+
+# nblast-fafb: number of top forward hits to calculate reverse scores for
+# (None for all neurons)
+NBLAST_REVERSE_DEPTH = 100
+
+# Max number of CPU cores used by all NBLAST jobs combined (None for all cores)
+NBLAST_CORE_BUDGET = None
+
+# Cache for CATMAID lookups: max number of entries and time-to-live (seconds)
+# per endpoint, e.g. {'get_names': 3600} - see catmaid_cache.py for defaults
+CATMAID_CACHE_SIZE = 10000
+CATMAID_CACHE_TTLS = {}
+
+# Shelve with root nodes of neurons (used for links to neurons)
+ROOT_INDEX = 'rootindex'
+
+# SQLite database for subscriptions (an old 'subscriptiondb' shelve is migrated
+# when it is first created)
+SUBSCRIPTION_DB = 'subscriptions.sqlite'
+
+# SQLite database with a local copy of the Zotero library (synced incrementally)
+ZOTERO_INDEX = 'zotero.sqlite'
+
+# Folder for cached Zotero PDFs and its max size in bytes
+ZOTERO_CACHE = 'zotero_cache'
+ZOTERO_CACHE_SIZE = 2 * 1024 ** 3
@@ -0,0 +1,171 @@
+"""
+    Shared cache for CATMAID lookups
+    catmaid_cache.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Process-wide cache in front of pymaid functions such as get_names or
+    get_neuron: results are kept for a per-endpoint time-to-live, the total
+    number of entries is bounded (least recently used entries are dropped
+    first) and entries can be invalidated by skeleton ID.
+
+    Lookups that map skeleton IDs to values (e.g. get_names) are cached per
+    skeleton ID, so that a request for neurons A, B and C can reuse A and B
+    from an earlier request for A and B. Everything else is cached per call.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import functools, logging, threading, time
+from collections import OrderedDict
+
+logger = logging.getLogger('pybotLog')
+
+#Default time-to-live (seconds) per endpoint
+TTLS = {'get_names': 3600,
+        'neuron_exists': 3600,
+        'get_annotations': 600,
+        'get_neuron': 300,
+        'get_partners': 300,
+        'get_review': 300}
+
+#TTL for endpoints not listed in TTLS
+DEFAULT_TTL = 300
+
+
+def _as_list(x):
+    """ Returns skeleton IDs as list of strings - None if x is a single ID.
+    """
+    if isinstance(x, (list, tuple, set)):
+        return [str(s) for s in x]
+    if hasattr(x, 'tolist') and not isinstance(x, str):
+        return [str(s) for s in x.tolist()]
+    return None
+
+
+class lookup_cache:
+    """ TTL/LRU cache for CATMAID lookups. Wrap functions with wrap().
+
+    Parameters:
+    ----------
+    max_entries :   max number of cached entries
+    ttls :          { endpoint name : seconds } to override TTLS
+    """
+
+    def __init__(self, max_entries=10000, ttls=None):
+        self.max_entries = max_entries
+        self.ttls = dict(TTLS, **(ttls or {}))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get(self, key):
+        """ Returns (True, value) for live entries, (False, None) otherwise.
+        """
+        with self.lock:
+            e = self.entries.get(key)
+            if e is None:
+                return False, None
+            expires, skids, value = e
+            if expires < time.time():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+    def _put(self, key, value, skids):
+        ttl = self.ttls.get(key[0], DEFAULT_TTL)
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, frozenset(skids), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _count(self, name, hits, misses):
+        with self.lock:
+            self.hits[name] = self.hits.get(name, 0) + hits
+            self.misses[name] = self.misses.get(name, 0) + misses
+
+    def invalidate(self, skids=None):
+        """ Drops all entries that involve any of the given skeleton IDs (all
+        entries if skids is None).
+        """
+        with self.lock:
+            if skids is None:
+                self.entries.clear()
+                return
+            skids = set(str(s) for s in skids)
+            for key in [k for k, e in self.entries.items() if e[1] & skids]:
+                del self.entries[key]
+
+    def stats(self):
+        """ Returns { endpoint : {'hits': int, 'misses': int} }. """
+        with self.lock:
+            return {n: {'hits': self.hits.get(n, 0),
+                        'misses': self.misses.get(n, 0)}
+                    for n in set(self.hits) | set(self.misses)}
+
+    def wrap(self, func, per_skid=False, name=None):
+        """ Returns a cached version of a pymaid function whose first argument
+        are skeleton IDs.
+
+        Parameters:
+        ----------
+        func :      function to wrap
+        per_skid :  if True, func returns { skid : value } for lists of
+                    skeleton IDs and results are cached per skeleton ID
+        name :      endpoint name (for TTLs and counters). Defaults to the
+                    function's name
+        """
+        name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(x, *args, remote_instance=None, **kwargs):
+            #Remote instance is not part of the key - there is only one
+            opts = repr((args, sorted(kwargs.items())))
+            skids = _as_list(x)
+
+            if skids is None or not per_skid:
+                key = (name, opts, str(x) if skids is None else tuple(sorted(skids)))
+                found, value = self._get(key)
+                self._count(name, int(found), int(not found))
+                if not found:
+                    value = func(x, *args, remote_instance=remote_instance,
+                                 **kwargs)
+                    self._put(key, value, [str(x)] if skids is None else skids)
+                return value.copy() if hasattr(value, 'copy') else value
+
+            res = {}
+            todo = []
+            for s in skids:
+                found, value = self._get((name, opts, s))
+                if found:
+                    res[s] = value
+                else:
+                    todo.append(s)
+            self._count(name, len(skids) - len(todo), len(todo))
+
+            if todo:
+                fetched = func(todo, *args, remote_instance=remote_instance,
+                               **kwargs)
+                for s, value in fetched.items():
+                    self._put((name, opts, str(s)), value, [str(s)])
+                    res[str(s)] = value
+
+            return res
+
+        return wrapper
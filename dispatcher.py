@@ -0,0 +1,139 @@
+"""
+    Asyncio command dispatcher
+    dispatcher.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Commands are put into a bounded asyncio queue which is served - in order -
+    by a fixed number of consumers running on their own event loop thread.
+    Each consumer runs the command's blocking handler (pymaid, Zotero, ...)
+    on a thread pool of the same size. Users are told their position in the
+    queue instead of being turned away when all consumers are busy.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('pybotLog')
+
+
+class command_dispatcher:
+    """ Runs command handlers (anything with a blocking run() method, e.g.
+    return_url) in order of submission.
+
+    Parameters:
+    ----------
+    slack_client :  slack_delivery.delivery_client - used to tell users about
+                    their queue position
+    workers :       number of commands processed in parallel
+    max_queue :     max number of commands waiting in the queue. Further
+                    commands are held back (in order) until there is space
+    """
+
+    def __init__(self, slack_client, workers=10, max_queue=100):
+        self.slack_client = slack_client
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='command')
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name='dispatcher',
+                                       daemon=True)
+        self.ready = threading.Event()
+
+        #Counters are only changed from within the event loop
+        self.submitted = 0
+        self.started = 0
+        self.done = 0
+        self.running = 0
+
+    def __len__(self):
+        """ Number of commands either waiting or running. """
+        return self.submitted - self.done
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.consumers = [self.loop.create_task(self._consume())
+                          for i in range(self.workers)]
+        self.loop.call_soon(self.ready.set)
+        self.loop.run_forever()
+
+        #Stopped: cancel consumers and commands still waiting for space in
+        #the queue (commands already running are abandoned)
+        tasks = asyncio.all_tasks(self.loop)
+        for t in tasks:
+            t.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks,
+                                                    return_exceptions=True))
+        self.loop.close()
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+        logger.info('Started command dispatcher (%i workers)' % self.workers)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False)
+
+    def submit(self, handler, channel=None):
+        """ Queues a handler. Thread-safe and non-blocking.
+
+        Parameters:
+        ----------
+        handler :   object with a run() method
+        channel :   Slack channel the command came from. Used to report
+                    the queue position and errors
+        """
+        asyncio.run_coroutine_threadsafe(self._put(handler, channel),
+                                         self.loop)
+
+    async def _put(self, handler, channel):
+        #Commands that have to start before this one minus idle consumers
+        position = (self.submitted - self.started) - (self.workers - self.running) + 1
+        self.submitted += 1
+
+        if position > 0 and channel:
+            logger.info('All workers busy - command queued at position %i' % position)
+            self._post(channel, 'I am currently really busy - you are number '
+                                '%i in the queue. I will get back to you as '
+                                'soon as possible!' % position)
+
+        await self.queue.put((handler, channel))
+
+    async def _consume(self):
+        while True:
+            handler, channel = await self.queue.get()
+            self.started += 1
+            self.running += 1
+            try:
+                await self.loop.run_in_executor(self.executor, handler.run)
+            except Exception:
+                logger.error('Error while processing command', exc_info=True)
+                if channel:
+                    self._post(channel, 'Ooops, something went wrong... '
+                                        'please try again or contact an '
+                                        'admin.')
+            finally:
+                self.running -= 1
+                self.done += 1
+                self.queue.task_done()
+
+    def _post(self, channel, text):
+        """ Queues a message with the delivery client (does not block the
+        event loop). """
+        self.slack_client.post(channel, text)
@@ -0,0 +1,229 @@
+"""
+    Memory-mapped store for the FAFB nightly dotprops dump
+    dotprops_store.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Converts the nightly dump into flat arrays (points, vectors, alpha) plus
+    an offset index keyed by skeleton ID. NBLAST jobs open these arrays
+    memory-mapped (zero copy) - concurrent jobs share the pages through the
+    OS page cache instead of each holding their own copy of the dump.
+
+    The CATMAID versions (see skeleton_versions.get_versions()) of all
+    neurons are recorded in the store's meta data when the dump is converted.
+    They are the reference point for the all-by-all matrix (nblast_matrix.py):
+    a precomputed row is only served while the neuron's version still matches
+    the one recorded here. Versions are fetched right after the dump has been
+    loaded, so conversion should run soon after the dump is exported - edits
+    made in between would go unnoticed.
+
+    Run once after each nightly dump (e.g. via cron):
+        python3 dotprops_store.py
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json, logging, os, shutil
+
+import numpy as np
+
+import nblast_engine
+from skeleton_versions import get_versions
+
+logger = logging.getLogger('pybotLog')
+
+#Name of the store (a folder) inside FAFB_DUMP
+STORE_NAME = 'fulln.simp10.dps.store'
+
+#Arrays making up the store
+ARRAYS = ['points', 'vect', 'alpha', 'offsets', 'names', 'bboxes']
+
+
+def make_tmp(path):
+    """ Returns a fresh temporary folder to write a new version of path to.
+    """
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    return tmp
+
+
+def swap_in(tmp, path):
+    """ Replaces folder path with tmp. Processes that still have files of
+    the old folder memory-mapped keep their (now unlinked) mappings.
+    """
+    if os.path.isdir(path):
+        os.rename(path, path + '.old')
+    os.rename(tmp, path)
+    if os.path.isdir(path + '.old'):
+        shutil.rmtree(path + '.old')
+
+
+def write_store(db, path, meta=None, sm=None):
+    """ Writes a dotprops_db to disk. The store is first written to a
+    temporary folder and then swapped in, so that running jobs keep their
+    (now unlinked) mappings of the old store.
+
+    Parameters:
+    ----------
+    db :        nblast_engine.dotprops_db
+    path :      folder to write to
+    meta :      dict with additional info (e.g. dump date) to store
+    sm :        nblast_engine.smat to store alongside (optional)
+    """
+    tmp = make_tmp(path)
+
+    np.save(os.path.join(tmp, 'points.npy'), db.points.astype(np.float32))
+    np.save(os.path.join(tmp, 'vect.npy'), db.vect.astype(np.float32))
+    np.save(os.path.join(tmp, 'alpha.npy'), db.alpha.astype(np.float32))
+    np.save(os.path.join(tmp, 'offsets.npy'), db.offsets.astype(np.int64))
+    np.save(os.path.join(tmp, 'names.npy'), db.names.astype(str))
+    np.save(os.path.join(tmp, 'bboxes.npy'), db.get_bboxes().astype(np.float32))
+
+    if sm is not None:
+        np.savez(os.path.join(tmp, 'smat.npz'), **sm._asdict())
+
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(dict(meta or {}, n_neurons=len(db), n_points=len(db.points)), f)
+
+    swap_in(tmp, path)
+
+    logger.info('Wrote %i neurons to %s' % (len(db), path))
+
+
+def open_store(path):
+    """ Opens a store memory-mapped (read-only, zero copy).
+
+    Returns:
+    -------
+    nblast_engine.dotprops_db
+    """
+    arrays = {a: np.load(os.path.join(path, a + '.npy'), mmap_mode='r')
+              for a in ARRAYS if a not in ['names', 'bboxes']}
+    #Names and bounding boxes are small - load them into memory
+    arrays['names'] = np.load(os.path.join(path, 'names.npy'))
+    if os.path.isfile(os.path.join(path, 'bboxes.npy')):
+        arrays['bboxes'] = np.load(os.path.join(path, 'bboxes.npy'))
+
+    return nblast_engine.dotprops_db(**arrays)
+
+
+def open_smat(path):
+    """ Returns the scoring matrix stored with the store (None if missing).
+    """
+    p = os.path.join(path, 'smat.npz')
+    if not os.path.isfile(p):
+        return None
+    with np.load(p) as f:
+        return nblast_engine.smat(**{k: f[k] for k in f.files})
+
+
+def read_meta(path):
+    """ Returns the store's meta data.
+    """
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        return json.load(f)
+
+
+def read_versions(path):
+    """ Returns { skid : version } recorded when the store was converted
+    (None for stores without versions).
+    """
+    return read_meta(path).get('versions')
+
+
+def store_is_current(dump_folder):
+    """ Returns True if the store in dump_folder is at least as recent as
+    the dump it was generated from.
+    """
+    store = os.path.join(dump_folder, STORE_NAME)
+    if not os.path.isfile(os.path.join(store, 'meta.json')):
+        return False
+
+    meta = read_meta(store)
+    return meta.get('source_mtime') == dump_mtime(dump_folder)
+
+
+def dump_mtime(dump_folder):
+    """ Modification time of the dump the store is generated from. """
+    for f in ['fulln.simp10.dps.rda', 'fulln.simp10.rda']:
+        p = os.path.join(dump_folder, f)
+        if os.path.isfile(p):
+            return os.path.getmtime(p)
+    return None
+
+
+def convert_dump(dump_folder, remote_instance=None):
+    """ Loads the nightly dump via R (generating dotprops if necessary) and
+    writes it into the store together with the CATMAID versions of its
+    neurons.
+    """
+    import rpy2.robjects as robjects
+    from rpy2.robjects.packages import importr
+    import ffnblast_fafb
+
+    nat = importr('nat')
+    r_nblast = importr('nat.nblast')
+    domc = importr('doMC')
+    robjects.r('registerDoMC()')
+
+    p = os.path.join(dump_folder, 'fulln.simp10.dps.rda')
+    if os.path.isfile(p):
+        _ = robjects.r('load("{}")'.format(p))
+        obj = 'fulln.simp10.dps'
+    else:
+        p = os.path.join(dump_folder, 'fulln.simp10.rda')
+        _ = robjects.r('load("{}")'.format(p))
+        obj = 'fulln.simp10'
+
+    #Get versions before the (slow) conversion to keep the gap to the export small
+    versions = get_versions(robjects.r('names({})'.format(obj)),
+                            remote_instance=remote_instance)
+
+    if obj == 'fulln.simp10.dps':
+        dps = robjects.r(obj)
+    else:
+        # Generate dps (note the conversion to um!)
+        dps = robjects.r("dotprops(fulln.simp10/1e3, k=5, resample=1, "
+                         ".parallel=T, OmitFailures=T)")
+
+    db = ffnblast_fafb.dotprops_db_from_r(dps)
+
+    write_store(db, os.path.join(dump_folder, STORE_NAME),
+                meta={'source': os.path.basename(p),
+                      'source_mtime': dump_mtime(dump_folder),
+                      'versions': {n: versions.get(n) for n in db.names}},
+                sm=ffnblast_fafb.smat_from_r())
+
+
+if __name__ == '__main__':
+    import botconfig
+    import pymaid
+
+    #Create console handler
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - '
+                                      '%(levelname)s - %(message)s'))
+    logger.addHandler(ch)
+
+    pymaid.set_pbars(hide=True)
+    pymaid.set_loggers('ERROR')
+
+    rm = pymaid.CatmaidInstance(botconfig.SERVER_URL,
+                                botconfig.HTTP_USER,
+                                botconfig.HTTP_PW,
+                                botconfig.AUTHTOKEN)
+
+    convert_dump(botconfig.FAFB_DUMP, remote_instance=rm)
@@ -6,6 +6,10 @@
     Call from shell or using subprocess.Popen('python ffnblast <skid> <channel>')
     Will post results in slack channel and upload a webGL file containg the first 3 hits.
 
+    The loading and blasting steps are also available as functions so that
+    a persistent worker (see nblast_pool.py) can load the databases once and
+    then run any number of searches.
+
     This program is free software: you can redistribute it and/or modify
     it under the terms of the GNU General Public License as published by
     the Free Software Foundation, either version 3 of the License, or
@@ -22,50 +26,29 @@
 
 import rpy2.robjects as robjects
 from rpy2.robjects.packages import importr
-import json, logging
+import csv, json, logging, os
 from tabulate import tabulate
-from slackclient import SlackClient
-
-if __name__ == '__main__':
-    import sys
-    import botconfig
+from slack_delivery import delivery_client
 
-    #Skid of the neuron to NBLAST and Slack channel to post the response to have to be passed as arguments
-    skid = sys.argv[1]
-    channel = sys.argv[2]
-    mirror = bool(int( sys.argv[3]))
-    hits = int(sys.argv[4])
-    db = sys.argv[5]
-    cores = int(sys.argv[6])
-    prefer_muscore = bool( int( sys.argv[7]))
-    use_alpha = bool(int( sys.argv[8]))
-    reverse = False
+logger = logging.getLogger('fire-n-forget NBLAST')
 
-    #Create logger
-    logger = logging.getLogger('fire-n-forget NBLAST')
-    logger.setLevel(logging.INFO)
-    #Create console handler - define different log level is desired
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.INFO)
-    #Create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
-    #Add the handlers to the logger
-    logger.addHandler(ch)
 
-    #Initialize slack client from botconfig.py
-    slack_client = SlackClient( botconfig.SLACK_KEY)
-    logger.debug('Connection to Slack:', slack_client.rtm_connect())
+def load_databases(botconfig):
+    """ Imports R libraries and loads flycircuit and GMR dotprops.
 
-    logger.info('Blasting neuron #%s (mirror=%s; reverse=%s; hits=%i; db=%s; use_alpha=%s; prefer_reverse_score=%s) - please wait...' % ( skid, mirror, reverse, hits, db, use_alpha, prefer_muscore ) )
-    ts = slack_client.api_call("chat.postMessage", channel=channel, text='Blasting neuron #%s `( mirror=%s; reverse=%s; hits=%i; db=%s; use_alpha=%s; prefer_reverse_score=%s )` - please wait...' % ( skid, mirror, reverse, hits, db, use_alpha, prefer_muscore ) , as_user=True)['ts']
+    Parameters:
+    ----------
+    botconfig :     botconfig module holding credentials and database urls
 
+    Returns:
+    -------
+    dbs :           { 'fc' : fcdps, 'gmr' : gmrdps }
+    """
     #Import R libraries
     elmr = importr('elmr')
     fc = importr('flycircuit')
     domc = importr('doMC')
     rjson = importr('rjson')
-    cores = robjects.r('registerDoMC(%i)' % cores)
     vfbr = importr('vfbr')
 
     #Make sure variables for databases are set correctly
@@ -78,6 +61,33 @@ if __name__ == '__main__':
     #To access the neurons' dotproducts, do e.g. this: dp = robjects.r(fcdps[[1]])
     #This will then have three entries: ['points', 'alpha', 'vect']
 
+    return {'fc': fcdps, 'gmr': gmrdps}
+
+
+def nblast(skid, dbs, mirror=True, hits=3, db='fc', cores=8,
+           prefer_muscore=False, use_alpha=False, webgl_dir='webGL'):
+    """ Blasts a single neuron against the flycircuit or GMR database.
+
+    Parameters:
+    ----------
+    skid :              skeleton ID of the neuron to blast
+    dbs :               databases as returned by load_databases()
+    mirror :            if True, mirror neuron before blasting
+    hits :              number of hits to include in the WebGL file
+    db :                'fc' or 'gmr'
+    cores :             number of cores to register with doMC
+    prefer_muscore :    if True, sort hits by muscore
+    use_alpha :         if True, use alpha values
+    webgl_dir :         directory to write the WebGL rendering to
+
+    Returns:
+    -------
+    results :           { 'table': str, 'legend': str, 'webgl': filename }
+    """
+    reverse = False
+
+    robjects.r('registerDoMC(%i)' % cores)
+
     #Make R functions callable in Python
     nblast_fafb = robjects.r('nblast_fafb')
     summary = robjects.r('summary')
@@ -88,16 +98,11 @@ if __name__ == '__main__':
     gmr_vfbid = robjects.r('gmr_vfbid')
     rainbow = robjects.r('rainbow')
 
-    logger.debug('Blasting - please wait...')
+    logger.info('Blasting neuron #%s (mirror=%s; reverse=%s; hits=%i; db=%s; use_alpha=%s; prefer_reverse_score=%s) - please wait...' % ( skid, mirror, reverse, hits, db, use_alpha, prefer_muscore ) )
 
-    if db == 'fc':
-        res = nblast_fafb(int(skid), mirror=mirror, reverse=reverse,
-                          db=fcdps, UseAlpha=use_alpha)
-        su = summary(res, db=fcdps)
-    elif db == 'gmr':
-        res = nblast_fafb(int(skid), mirror=mirror, reverse=reverse,
-                          db=gmrdps, UseAlpha=use_alpha)
-        su = summary(res, db = gmrdps)
+    res = nblast_fafb(int(skid), mirror=mirror, reverse=reverse,
+                      db=dbs[db], UseAlpha=use_alpha)
+    su = summary(res, db=dbs[db])
 
     #Read results into python data objects
     #summary = dict( zip( su.names, map( list, list( su ) ) ) )
@@ -134,19 +139,12 @@ if __name__ == '__main__':
         for i, n in enumerate(s):
             s[i]['n'] = i+1
 
-    if db == 'fc':
-        plot3d(res, hits=h, db=fcdps, soma=True)
-    elif db == 'gmr':
-        plot3d(res, hits=h, db=gmrdps, soma=True)
+    plot3d(res, hits=h, db=dbs[db], soma=True)
 
-    writeWebGL('webGL', width=1000)
+    writeWebGL(webgl_dir, width=1000)
     robjects.r('rgl.close()')
 
-    logger.debug('Finished nblasting neuron', skid)
-
-    slack_client.api_call("chat.delete",
-                          channel=channel,
-                          ts=ts)
+    logger.debug('Finished nblasting neuron %s' % skid)
 
     if db == 'fc':
         table = [['*Gene Name*', '*Score*', '*MuScore*', '*Driver*',
@@ -196,19 +194,141 @@ if __name__ == '__main__':
     for vfb_id in vfb_urls:
         tab = tab.replace(vfb_id , '<%s|%s>' % (vfb_urls[vfb_id], vfb_id))
 
-    slack_client.api_call("chat.postMessage",
-                          channel=channel,
-                          text= '```' + tab + '```',
-                          as_user=True)
-
-    with open('webGL/index.html', 'r') as f:
-        slack_client.api_call("files.upload", channels=channel,
-                              file=f,
-                              title='3D nblast results for neuron #%s' % skid,
-                              initial_comment='Open file in browser'
-                              )
     #Color palette is based on R's rainbow() -> we have to strip the last two values (those are alpha)
     colors = [e[:-2] for e in list(rainbow(hits))]
     legend = '\n'.join(list(map(lambda c,n : c + ' - ' + n, colors, hit_names)))
-    slack_client.api_call("chat.postMessage", channel=channel,
-                          text=legend, as_user=True)
\ No newline at end of file
+
+    return {'table': '```' + tab + '```',
+            'legend': legend,
+            'webgl': os.path.join(webgl_dir, 'index.html')}
+
+
+def nblast_batch(skids, dbs, mirror=True, top_n=10, db='fc', cores=8,
+                 prefer_muscore=False, use_alpha=False, out_dir='webGL'):
+    """ Blasts several neurons against the flycircuit or GMR database. All
+    queries reuse the database loaded into R.
+
+    Parameters:
+    ----------
+    skids :             skeleton IDs of the neurons to blast
+    dbs :               databases as returned by load_databases()
+    mirror :            if True, mirror neurons before blasting
+    top_n :             number of hits per query to include in the table
+    db :                'fc' or 'gmr'
+    cores :             number of cores to register with doMC
+    prefer_muscore :    if True, sort hits by muscore
+    use_alpha :         if True, use alpha values
+    out_dir :           directory to write the hit table to
+
+    Returns:
+    -------
+    results :           { 'table': str, 'file': filename, 'title': str }
+    """
+    robjects.r('registerDoMC(%i)' % cores)
+
+    #Make R functions callable in Python
+    nblast_fafb = robjects.r('nblast_fafb')
+    summary = robjects.r('summary')
+    row_names = robjects.r('row.names')
+
+    logger.info('Blasting %i neurons (mirror=%s; top_n=%i; db=%s; use_alpha=%s; prefer_reverse_score=%s) - please wait...' % ( len(skids), mirror, top_n, db, use_alpha, prefer_muscore ) )
+
+    rows = []
+    best = [['*Neuron*', '*Top hit*', '*Score*', '*MuScore*']]
+    for skid in skids:
+        res = nblast_fafb(int(skid), mirror=mirror, reverse=False,
+                          db=dbs[db], UseAlpha=use_alpha)
+        su = summary(res, db=dbs[db])
+
+        s = [{'name': c, 'score': su[0][i], 'muscore': su[1][i], 'n': su[6][i]}
+             for i, c in enumerate(list(row_names(su)))]
+
+        #Summary comes ordered by muscore - 'n' is the rank by forward score
+        if not prefer_muscore:
+            s = sorted(s, key=lambda e: e['n'])
+
+        for e in s[:top_n]:
+            rows.append([skid, e['name'], e['score'], e['muscore'], e['n']])
+        if s:
+            best.append(['#%s' % skid, s[0]['name'], round(s[0]['score'], 3),
+                         round(s[0]['muscore'], 3)])
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    fname = os.path.join(out_dir, 'nblast_results.csv')
+    with open(fname, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['query_skeleton_id', 'name', 'score', 'muscore', 'hit_no'])
+        w.writerows(rows)
+
+    logger.debug('Finished nblasting %i neurons' % len(skids))
+
+    return {'table': 'Top hits for %i neurons (top %i per neuron in file):\n```%s```' % (len(skids), top_n, tabulate(best)),
+            'file': fname,
+            'title': 'NBLAST results for neurons #%s' % ' #'.join([str(s) for s in skids])}
+
+
+def post_results(slack_client, channel, skid, results):
+    """ Queues table, WebGL file and legend as returned by nblast() - or table
+    and hit table file as returned by nblast_batch() - on the delivery_client
+    (see slack_delivery.py). Files have to exist until they have been sent:
+    use slack_client.after_sent() to clean up.
+    """
+    slack_client.post(channel, results['table'])
+
+    if results.get('webgl'):
+        slack_client.upload(channel, results['webgl'],
+                            title='3D nblast results for neuron #%s' % skid,
+                            initial_comment='Open file in browser')
+
+    if results.get('file'):
+        slack_client.upload(channel, results['file'],
+                            title=results.get('title', 'NBLAST results'),
+                            filename=os.path.basename(results['file']))
+
+    if results.get('legend'):
+        slack_client.post(channel, results['legend'])
+
+
+if __name__ == '__main__':
+    import sys
+    import botconfig
+
+    #Skid of the neuron to NBLAST and Slack channel to post the response to have to be passed as arguments
+    skid = sys.argv[1]
+    channel = sys.argv[2]
+    mirror = bool(int( sys.argv[3]))
+    hits = int(sys.argv[4])
+    db = sys.argv[5]
+    cores = int(sys.argv[6])
+    prefer_muscore = bool( int( sys.argv[7]))
+    use_alpha = bool(int( sys.argv[8]))
+    reverse = False
+
+    #Create logger
+    logger.setLevel(logging.INFO)
+    #Create console handler - define different log level is desired
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    #Create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    #Add the handlers to the logger
+    logger.addHandler(ch)
+
+    #Initialize slack client from botconfig.py
+    slack_client = delivery_client(botconfig.SLACK_KEY)
+    slack_client.start()
+
+    ts = slack_client.api_call("chat.postMessage", channel=channel, text='Blasting neuron #%s `( mirror=%s; reverse=%s; hits=%i; db=%s; use_alpha=%s; prefer_reverse_score=%s )` - please wait...' % ( skid, mirror, reverse, hits, db, use_alpha, prefer_muscore ) , as_user=True).get('ts')
+
+    dbs = load_databases(botconfig)
+
+    results = nblast(skid, dbs, mirror=mirror, hits=hits, db=db, cores=cores,
+                     prefer_muscore=prefer_muscore, use_alpha=use_alpha)
+
+    if ts:
+        slack_client.delete(channel, ts)
+
+    post_results(slack_client, channel, skid, results)
+    slack_client.stop()
@@ -6,6 +6,10 @@
     Call from shell or using subprocess.Popen('python ffnblast <skid> <channel>')
     Will post results in slack channel and upload a webGL file containg the first 3 hits.
 
+    The loading and blasting steps are also available as functions so that
+    a persistent worker (see nblast_pool.py) can load the dump once and
+    then run any number of searches.
+
     This program is free software: you can redistribute it and/or modify
     it under the terms of the GNU General Public License as published by
     the Free Software Foundation, either version 3 of the License, or
@@ -24,7 +28,7 @@ import rpy2.robjects as robjects
 from rpy2.robjects.packages import importr
 import json, logging
 from tabulate import tabulate
-from slackclient import SlackClient
+from slack_delivery import delivery_client
 
 import os.path
 
@@ -33,58 +37,98 @@ pymaid.set_pbars(hide=True)
 pymaid.set_loggers('ERROR')
 
 import pandas as pd
+import numpy as np
+
+import nblast_engine
+import dotprops_store
+import nblast_matrix
+from skeleton_versions import get_versions
+from ffnblast import post_results
+
+logger = logging.getLogger('fire-n-forget FAFB NBLAST')
+
+
+def dotprops_db_from_r(dps):
+    """ Converts an R neuronlist of dotprops into a nblast_engine.dotprops_db.
+    Concatenation happens in R so that only four objects cross the rpy2
+    boundary.
+    """
+    robjects.globalenv['.dps'] = dps
+    points = np.array(robjects.r('do.call(rbind, lapply(.dps, function(x) x$points))'))
+    vect = np.array(robjects.r('do.call(rbind, lapply(.dps, function(x) x$vect))'))
+    alpha = np.array(robjects.r('unlist(lapply(.dps, function(x) x$alpha), use.names=F)'))
+    n_points = np.array(robjects.r('sapply(.dps, function(x) nrow(x$points))'))
+    names = list(robjects.r('names(.dps)'))
+    robjects.r('rm(.dps)')
+
+    return nblast_engine.dotprops_db(names, points, vect, alpha,
+                                     np.concatenate([[0], np.cumsum(n_points)]))
+
+
+def dotprops_from_r(dp):
+    """ Converts a single R dotprops object into nblast_engine.dotprops.
+    """
+    return nblast_engine.dotprops(np.array(dp.rx2('points')),
+                                  np.array(dp.rx2('vect')),
+                                  np.array(dp.rx2('alpha')))
+
+
+def smat_from_r(name='smat.fcwb'):
+    """ Fetches a scoring matrix (default: smat.fcwb) from nat.nblast.
+    """
+    return nblast_engine.smat(np.array(robjects.r('attr({}, "distbreaks")'.format(name))),
+                              np.array(robjects.r('attr({}, "dotbreaks")'.format(name))),
+                              np.array(robjects.r('unclass({})'.format(name))))
+
+
+def query_dotprops(mirror=False):
+    """ Turns the neuron `n` in R into dotprops like the ones in the FAFB
+    dump: mirrors (optional), simplifies and converts to dotprops.
+
+    Returns:
+    -------
+    R dotprops object
+    """
+    # Mirror neuron if necessary
+    if mirror:
+        # Convert to JFRC2
+        _ = robjects.r('n.jfrc2 = xform_brain(n, sample=FAFB14, reference=JFRC2)')
+        # Mirror
+        _ = robjects.r('n.mirrored = mirror_brain(n.jfrc2, brain=JFRC2)')
+        # Convert back to FAFB
+        _ = robjects.r('n = xform_brain(n.mirrored, sample=JFRC2, reference=FAFB14)')
 
-if __name__ == '__main__':
-    import sys
-    import botconfig
+    # Simplify neuron to same degree as FAFB dump
+    _ = robjects.r('n.simp = simplify_neuron(n[[1]], n=10, OmitFailures=T, .parallel=T)')
 
-    #Skid of the neuron to NBLAST and Slack channel to post the response to have to be passed as arguments
-    skid = sys.argv[1]
-    channel = sys.argv[2]
-    mirror = bool(int(sys.argv[3]))
-    hits = int(sys.argv[4])
-    cores = int(sys.argv[5])
-    prefer_muscore = bool(int(sys.argv[6]))
-    use_alpha = bool(int(sys.argv[7]))
-    reverse = False
+    # Convert to dotprops (also note the conversion to um!)
+    _ = robjects.r('n.simp.dps = dotprops(n.simp/1e3, k=5, resample=1, .parallel=T, OmitFailures=T)')
 
-    #Create logger
-    logger = logging.getLogger('fire-n-forget FAFB NBLAST')
-    logger.setLevel(logging.INFO)
-    #Create console handler - define different log level is desired
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.INFO)
-    #Create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
-    #Add the handlers to the logger
-    logger.addHandler(ch)
+    # Get the neuron into Python
+    return robjects.r('n.simp.dps')
 
-    #Initialize slack client from botconfig.py
-    slack_client = SlackClient(botconfig.SLACK_KEY)
-    logger.debug('Connection to Slack:', slack_client.rtm_connect())
 
-    logger.info('Blasting neuron #%s (mirror=%s; reverse=%s; hits=%i;'
-                ' use_alpha=%s; prefer_reverse_score=%s) - please wait...'
-                '' % (skid, mirror, reverse, hits, use_alpha,
-                      prefer_muscore))
-    ts = slack_client.api_call("chat.postMessage", channel=channel,
-                               text='Blasting neuron #%s `(mirror=%s; '
-                                    'reverse=%s; hits=%i; use_alpha=%s; '
-                                    'prefer_reverse_score=%s)` '
-                                    '- please wait...' % (skid, mirror,
-                                                          reverse, hits,
-                                                          use_alpha,
-                                                          prefer_muscore),
-                               as_user=True)['ts']
+def load_databases(botconfig):
+    """ Imports R libraries, connects to CATMAID and loads the FAFB dump.
+
+    Parameters:
+    ----------
+    botconfig :     botconfig module holding credentials and dump folder
 
+    Returns:
+    -------
+    dbs :           { 'fafb' : fulln_simp10_dps } for the R engine or
+                    { 'fafb' : dotprops_db, 'smat' : smat } for the native
+                    engine (NBLAST_ENGINE = 'python'). If the dotprops store
+                    is used, 'fafb_matrix' holds the all-by-all matrix (or
+                    None if there is none)
+    """
     #Import R libraries
     nat = importr('nat')
     elmr = importr('elmr')
     fc = importr('flycircuit')
     domc = importr('doMC')
     rjson = importr('rjson')
-    cores = robjects.r('registerDoMC(%i)' % cores)
     vfbr = importr('vfbr')
     catmaid = importr('catmaid')
     nat_flybrains = importr('nat.flybrains')
@@ -103,6 +147,17 @@ if __name__ == '__main__':
                                 botconfig.HTTP_PW,
                                 botconfig.AUTHTOKEN)
 
+    if botconfig.NBLAST_ENGINE == 'python':
+        # Use the memory-mapped store if it is up-to-date -> no need to
+        # load the dump into R at all
+        if dotprops_store.store_is_current(botconfig.FAFB_DUMP):
+            store = os.path.join(botconfig.FAFB_DUMP, dotprops_store.STORE_NAME)
+            return {'fafb': dotprops_store.open_store(store),
+                    'smat': dotprops_store.open_smat(store) or smat_from_r(),
+                    'fafb_matrix': nblast_matrix.open_matrix(botconfig.FAFB_DUMP)}
+        logger.warning('No up-to-date dotprops store found - loading dump '
+                       'via R. Run dotprops_store.py to speed this up.')
+
     # If there already is a DPS file from the nightly dump use this
     p = os.path.join(botconfig.FAFB_DUMP, 'fulln.simp10.dps.rda')
     if os.path.isfile(p):
@@ -116,34 +171,74 @@ if __name__ == '__main__':
                                       "resample=1, .parallel=T, "
                                       "OmitFailures=T)")
 
-    #Make R functions callable in Python
-    rainbow = robjects.r('rainbow')
+    if botconfig.NBLAST_ENGINE == 'python':
+        return {'fafb': dotprops_db_from_r(fulln_simp10_dps),
+                'smat': smat_from_r()}
 
-    # Load the neuron of interest
-    _ = robjects.r('n = read.neurons.catmaid({})'.format(skid))
+    return {'fafb': fulln_simp10_dps}
 
-    # Mirror neuron if necessary
-    if mirror:
-        # Convert to JFRC2
-        _ = robjects.r('n.jfrc2 = xform_brain(n, sample=FAFB14, reference=JFRC2)')
-        # Mirror
-        _ = robjects.r('n.mirrored = mirror_brain(n.jfrc2, brain=JFRC2)')
-        # Convert back to FAFB
-        _ = robjects.r('n = xform_brain(n.mirrored, sample=JFRC2, reference=FAFB14)')
 
-    # Simplify neuron to same degree as FAFB dump
-    _ = robjects.r('n.simp = simplify_neuron(n[[1]], n=10, OmitFailures=T, .parallel=T)')
+def _precomputed_scores(skid, mat, nrev):
+    """ Looks up forward scores of skid and reverse scores for its top nrev
+    hits in the all-by-all matrix. """
+    fwd = mat.forward(skid)
 
-    # Convert to dotprops (also note the conversion to um!)
-    _ = robjects.r('n.simp.dps = dotprops(n.simp/1e3, k=5, resample=1, .parallel=T, OmitFailures=T)')
+    top = np.argsort(fwd)[::-1][:nrev]
+    rev = mat.reverse(skid, top)
 
-    # Get the neuron into Python
-    xdp = robjects.r('n.simp.dps')
+    return pd.DataFrame({'skeleton_id': mat.names[top],
+                         'forward_score': fwd[top],
+                         'reverse_score': rev,
+                         'mu_score': (fwd[top] + rev) / 2})
 
-    # Now NBLAST
 
-    # Number of reverse scores to calculate (max 100)
-    nrev = min(100, len(fulln_simp10_dps))
+def _add_reverse_scores(query, fwd, idx, dbs, use_alpha, nrev, cores=1,
+                        progress=None):
+    """ Calculates reverse scores for the top nrev forward hits (native
+    engine). fwd are the forward scores for targets in idx. If provided,
+    progress is called with a short summary of the best mean scores so far
+    whenever a chunk of targets is finished. """
+    db = dbs['fafb']
+
+    order = np.argsort(fwd)[::-1][:nrev]
+    top = idx[order]
+
+    callback = None
+    if progress:
+        partial = np.full(len(top), np.nan)
+
+        def callback(pos, values):
+            partial[pos] = values
+            progress(_progress_message(db.names[top], fwd[order], partial))
+
+    rev = nblast_engine.reverse_scores(query, db, dbs['smat'],
+                                       use_alpha=use_alpha,
+                                       idx=top, cores=cores,
+                                       callback=callback)
+
+    return pd.DataFrame({'skeleton_id': db.names[top],
+                         'forward_score': fwd[order],
+                         'reverse_score': rev,
+                         'mu_score': (fwd[order] + rev) / 2})
+
+
+def _progress_message(names, fwd, rev, n=5):
+    """ Summarises the best mean scores among targets with reverse scores
+    (rev is NaN for the others). """
+    done = np.where(~np.isnan(rev))[0]
+    mu = (fwd[done] + rev[done]) / 2
+    best = done[np.argsort(mu)[::-1][:n]]
+    return 'Reverse scores for {} of {} neurons - best mean scores so far: ' \
+           '{}'.format(len(done), len(rev),
+                       ', '.join(['#{} ({:.3f})'.format(names[i], (fwd[i] + rev[i]) / 2)
+                                  for i in best]))
+
+
+def _r_scores(xdp, fulln_simp10_dps, use_alpha, nrev, reverse=False):
+    """ Forward and reverse scores for the top nrev hits via nat.nblast
+    (reference engine). xdp is the query's R dotprops. """
+    nat = importr('nat')
+    r_nblast = importr('nat.nblast')
 
     if reverse:
         sc = r_nblast.nblast(fulln_simp10_dps,
@@ -185,16 +280,116 @@ if __name__ == '__main__':
                                  '.parallel': True,
                                  'UseAlpha': use_alpha})
 
-        sc_df.set_index('name', inplace=True, drop=True)
+    sc_df.set_index('name', inplace=True, drop=True)
+
+    return pd.DataFrame([[scr.names[i],
+                          sc_df.loc[scr.names[i]].score,
+                          scr[i],
+                          (sc_df.loc[scr.names[i]].score + scr[i]) / 2]
+                        for i in range(len(scr))],
+                       columns=['skeleton_id', 'forward_score',
+                                'reverse_score', 'mu_score']
+                       )
+
+
+def nblast(skid, dbs, mirror=False, hits=3, cores=8, prefer_muscore=False,
+           use_alpha=False, webgl_dir='webGL', engine='python',
+           prefilter=None, show_pruned=False, reverse_depth=100,
+           progress=None):
+    """ Blasts a single neuron against the FAFB nightly dump.
+
+    Parameters:
+    ----------
+    skid :              skeleton ID of the neuron to blast
+    dbs :               databases as returned by load_databases()
+    mirror :            if True, mirror neuron before blasting
+    hits :              number of hits to include in the WebGL file
+    cores :             number of cores to register with doMC
+    prefer_muscore :    if True, sort hits by mean score
+    use_alpha :         if True, use alpha values
+    webgl_dir :         directory to write the WebGL rendering to
+    engine :            'python' to score with nblast_engine, 'r' to score
+                        with nat.nblast (reference)
+    prefilter :         if not None, discard targets that have no point
+                        within this distance (um) of the query before
+                        scoring (python engine only). 'auto' derives the
+                        distance from the scoring matrix (lossless, see
+                        nblast_engine.prefilter())
+    show_pruned :       if True, report number of pruned targets in table
+    reverse_depth :     number of top forward hits to calculate reverse (and
+                        hence mean) scores for. None for all
+    progress :          function that is called with a short status message
+                        while reverse scores are calculated (python engine
+                        only)
+
+    Returns:
+    -------
+    results :           { 'table': str, 'legend': str, 'webgl': filename }
+    """
+    reverse = False
+
+    robjects.r('registerDoMC(%i)' % cores)
 
-        res = pd.DataFrame([[scr.names[i],
-                             sc_df.loc[scr.names[i]].score,
-                             scr[i],
-                             (sc_df.loc[scr.names[i]].score + scr[i]) / 2]
-                           for i in range(len(scr))],
-                          columns=['skeleton_id', 'forward_score',
-                                   'reverse_score', 'mu_score']
-                          )
+    fulln_simp10_dps = dbs['fafb']
+
+    logger.info('Blasting neuron #%s (mirror=%s; reverse=%s; hits=%i;'
+                ' use_alpha=%s; prefer_reverse_score=%s) - please wait...'
+                '' % (skid, mirror, reverse, hits, use_alpha,
+                      prefer_muscore))
+
+    #Make R functions callable in Python
+    rainbow = robjects.r('rainbow')
+
+    # Load the neuron of interest
+    _ = robjects.r('n = read.neurons.catmaid({})'.format(skid))
+
+    # Now NBLAST
+
+    # Number of reverse scores to calculate
+    nrev = len(fulln_simp10_dps) if reverse_depth is None else min(reverse_depth,
+                                                                   len(fulln_simp10_dps))
+
+    # Unmirrored queries that have not been edited since the all-by-all
+    # matrix was built are answered with a row lookup
+    mat = dbs.get('fafb_matrix')
+    precomputed = engine == 'python' and mat is not None and not mirror \
+                  and not use_alpha \
+                  and mat.is_current(skid, get_versions([skid]).get(str(skid)))
+
+    if precomputed:
+        logger.info('Using precomputed scores for neuron #%s' % skid)
+        res = _precomputed_scores(skid, mat, nrev)
+    elif engine == 'python':
+        db = dbs['fafb']
+        sm = dbs['smat']
+        query = dotprops_from_r(query_dotprops(mirror))
+
+        # Discard targets that can't possibly overlap with the query
+        if prefilter is not None:
+            padding = sm.distbreaks[-2] if prefilter == 'auto' else prefilter
+            idx = nblast_engine.prefilter(query, db, padding=padding)
+            pruned = len(db) - len(idx)
+            logger.info('Prefilter pruned {} of {} candidates'.format(pruned,
+                                                                      len(db)))
+        else:
+            idx = np.arange(len(db))
+
+        # Nothing left to score, plot or name
+        if prefilter is not None and not len(idx):
+            return {'table': 'No neuron has a point within {} microns of '
+                             '#{} - nothing to score. Try a larger '
+                             '`prefilter=N` or `noprefilter`.'.format(padding,
+                                                                      skid)}
+
+        fwd = nblast_engine.forward_scores(query, db, sm,
+                                           use_alpha=use_alpha,
+                                           idx=idx, cores=cores)
+
+        res = _add_reverse_scores(query, fwd, idx, dbs, use_alpha, nrev,
+                                  cores=cores, progress=progress)
+    else:
+        res = _r_scores(query_dotprops(mirror), fulln_simp10_dps, use_alpha,
+                        nrev, reverse=reverse)
 
     if prefer_muscore:
         res = res.sort_values('mu_score', ascending=False)
@@ -220,26 +415,195 @@ if __name__ == '__main__':
     robjects.r('plot3d(to_plot, soma=T)')
 
     # Save as RGL plot as WebGL and close
-    robjects.r('writeWebGL("webGL", width=1000)')
+    robjects.r('writeWebGL("{}", width=1000)'.format(webgl_dir))
     robjects.r('rgl.close()')
 
-    logger.debug('Finished nblasting neuron', skid)
-
-    slack_client.api_call("chat.delete",
-                          channel=channel,
-                          ts=ts)
+    logger.debug('Finished nblasting neuron %s' % skid)
 
-    slack_client.api_call("chat.postMessage", channel=channel,
-                          text= '```{}```'.format(res.head(max(10, hits)).to_string()),
-                          as_user=True)
-
-    with open('webGL/index.html', 'r') as f:
-        slack_client.api_call("files.upload", channels=channel, file=f,
-                             title='3D nblast results for neuron #%s' % skid,
-                             initial_comment='Open file in browser'
-                             )
     #Color palette is based on R's rainbow() -> we have to strip the last two values (those are alpha)
     colors = [e[:-2] for e in list(rainbow(hits))]
     legend = '\n'.join(list(map(lambda c,n : c + ' - ' + n, colors, hit_names)))
-    slack_client.api_call("chat.postMessage", channel=channel,
-                          text=legend, as_user=True)
\ No newline at end of file
+
+    table = '```{}```'.format(res.head(max(10, hits)).to_string())
+    if show_pruned and prefilter is not None and not precomputed \
+       and engine == 'python':
+        table = 'Scored {} of {} neurons ({} pruned by spatial ' \
+                'prefilter)\n'.format(len(idx), len(db), pruned) + table
+
+    return {'table': table,
+            'legend': legend,
+            'webgl': os.path.join(webgl_dir, 'index.html')}
+
+
+def nblast_batch(skids, dbs, mirror=False, top_n=10, cores=8,
+                 prefer_muscore=False, use_alpha=False, out_dir='webGL',
+                 engine='python', prefilter=None, reverse_depth=100):
+    """ Blasts several neurons against the FAFB nightly dump as one batch.
+    With the native engine, all queries are scored against the (union of
+    prefiltered) targets in a single pass, so that every target's KD-tree
+    is used for all queries at once. Queries found unchanged in the
+    all-by-all matrix are looked up instead.
+
+    Parameters:
+    ----------
+    skids :             skeleton IDs of the neurons to blast
+    dbs :               databases as returned by load_databases()
+    mirror :            if True, mirror neurons before blasting
+    top_n :             number of hits per query to include in the table
+    cores :             number of cores to use
+    prefer_muscore :    if True, sort hits by mean score
+    use_alpha :         if True, use alpha values
+    out_dir :           directory to write the hit table to
+    engine :            'python' or 'r' (see nblast())
+    prefilter :         see nblast()
+    reverse_depth :     see nblast(). At least top_n
+
+    Returns:
+    -------
+    results :           { 'table': str, 'file': filename, 'title': str }
+    """
+    robjects.r('registerDoMC(%i)' % cores)
+
+    fulln_simp10_dps = dbs['fafb']
+    skids = [str(s) for s in skids]
+
+    logger.info('Blasting %i neurons (mirror=%s; top_n=%i; use_alpha=%s; '
+                'prefer_reverse_score=%s) - please wait...' % (len(skids),
+                                                              mirror, top_n,
+                                                              use_alpha,
+                                                              prefer_muscore))
+
+    nrev = len(fulln_simp10_dps) if reverse_depth is None else min(max(reverse_depth, top_n),
+                                                                   len(fulln_simp10_dps))
+
+    scores = {}
+
+    # Answer unchanged queries from the all-by-all matrix
+    mat = dbs.get('fafb_matrix')
+    if engine == 'python' and mat is not None and not mirror and not use_alpha:
+        versions = get_versions(skids)
+        for s in skids:
+            if mat.is_current(s, versions.get(s)):
+                scores[s] = _precomputed_scores(s, mat, nrev)
+        logger.info('Using precomputed scores for {} of {} neurons'.format(len(scores),
+                                                                          len(skids)))
+
+    todo = [s for s in skids if s not in scores]
+
+    # Load and convert the remaining queries
+    queries = []
+    for s in todo:
+        _ = robjects.r('n = read.neurons.catmaid({})'.format(s))
+        queries.append(query_dotprops(mirror))
+
+    if todo and engine == 'python':
+        db = dbs['fafb']
+        queries = [dotprops_from_r(q) for q in queries]
+
+        if prefilter is not None:
+            padding = None if prefilter == 'auto' else prefilter
+            idx = np.unique(np.concatenate([nblast_engine.prefilter(q, db,
+                                                                    padding=padding,
+                                                                    sm=dbs['smat'])
+                                            for q in queries]))
+            logger.info('Prefilter pruned {} of {} candidates'.format(len(db) - len(idx),
+                                                                      len(db)))
+        else:
+            idx = np.arange(len(db))
+
+        fwd = nblast_engine.forward_scores_batch(queries, db, dbs['smat'],
+                                                 use_alpha=use_alpha,
+                                                 idx=idx, cores=cores)
+
+        for s, q, f in zip(todo, queries, fwd):
+            scores[s] = _add_reverse_scores(q, f, idx, dbs, use_alpha, nrev,
+                                            cores=cores)
+    else:
+        for s, q in zip(todo, queries):
+            scores[s] = _r_scores(q, fulln_simp10_dps, use_alpha, nrev)
+
+    sort_by = 'mu_score' if prefer_muscore else 'forward_score'
+    res = pd.concat([scores[s].sort_values(sort_by, ascending=False)
+                              .head(top_n)
+                              .assign(query_skeleton_id=s)
+                     for s in skids], ignore_index=True)
+
+    # Get all names in one go
+    names = pymaid.get_names(list(set(skids) | set(res.skeleton_id.values)))
+    res['query_name'] = res.query_skeleton_id.map(names)
+    res['neuron_name'] = res.skeleton_id.map(names)
+
+    res = res[['query_name', 'query_skeleton_id', 'neuron_name',
+               'skeleton_id', 'forward_score', 'reverse_score', 'mu_score']]
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    fname = os.path.join(out_dir, 'nblast_results.csv')
+    res.to_csv(fname, index=False)
+
+    logger.debug('Finished nblasting %i neurons' % len(skids))
+
+    # Message lists the top hit for each query - the rest is in the file
+    best = res.groupby('query_skeleton_id', sort=False).head(1)
+    table = 'Top hits for {} neurons (top {} per neuron in file):\n' \
+            '```{}```'.format(len(skids), top_n,
+                              best[['query_name', 'neuron_name', 'skeleton_id',
+                                    sort_by]].to_string(index=False))
+
+    return {'table': table,
+            'file': fname,
+            'title': 'NBLAST results for neurons #{}'.format(' #'.join(skids))}
+
+
+if __name__ == '__main__':
+    import sys
+    import botconfig
+
+    #Skid of the neuron to NBLAST and Slack channel to post the response to have to be passed as arguments
+    skid = sys.argv[1]
+    channel = sys.argv[2]
+    mirror = bool(int(sys.argv[3]))
+    hits = int(sys.argv[4])
+    cores = int(sys.argv[5])
+    prefer_muscore = bool(int(sys.argv[6]))
+    use_alpha = bool(int(sys.argv[7]))
+    reverse = False
+
+    #Create logger
+    logger.setLevel(logging.INFO)
+    #Create console handler - define different log level is desired
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    #Create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    #Add the handlers to the logger
+    logger.addHandler(ch)
+
+    #Initialize slack client from botconfig.py
+    slack_client = delivery_client(botconfig.SLACK_KEY)
+    slack_client.start()
+
+    ts = slack_client.api_call("chat.postMessage", channel=channel,
+                               text='Blasting neuron #%s `(mirror=%s; '
+                                    'reverse=%s; hits=%i; use_alpha=%s; '
+                                    'prefer_reverse_score=%s)` '
+                                    '- please wait...' % (skid, mirror,
+                                                          reverse, hits,
+                                                          use_alpha,
+                                                          prefer_muscore),
+                               as_user=True).get('ts')
+
+    dbs = load_databases(botconfig)
+
+    results = nblast(skid, dbs, mirror=mirror, hits=hits, cores=cores,
+                     prefer_muscore=prefer_muscore, use_alpha=use_alpha,
+                     engine=botconfig.NBLAST_ENGINE,
+                     prefilter=botconfig.NBLAST_PREFILTER,
+                     reverse_depth=botconfig.NBLAST_REVERSE_DEPTH)
+
+    if ts:
+        slack_client.delete(channel, ts)
+
+    post_results(slack_client, channel, skid, results)
+    slack_client.stop()
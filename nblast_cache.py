@@ -0,0 +1,168 @@
+"""
+    Persistent cache for NBLAST results
+    nblast_cache.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Stores hit tables and WebGL files of finished NBLAST jobs on disk, keyed
+    by skeleton ID, skeleton version and all parameters that change the
+    result (database, dump date, mirror, use_alpha, ...). If the same neuron
+    is blasted again without having been edited, the stored results are
+    posted straight away without ever starting R.
+
+    Each entry is a folder with a results.json plus copies of the uploaded
+    files. Once the cache grows beyond its size limit, the least recently
+    used entries are dropped.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib, json, logging, os, shutil
+
+logger = logging.getLogger('pybotLog')
+
+#Entries of results that point to files
+FILE_KEYS = ['webgl', 'file']
+
+
+def make_key(skid, version, db, dump, **params):
+    """ Returns the cache key for a single-neuron NBLAST job.
+
+    Parameters:
+    ----------
+    skid :      skeleton ID of the query
+    version :   skeleton version (see skeleton_versions.get_versions())
+    db :        'fc', 'gmr' or 'fafb'
+    dump :      date (or other identifier) of the database/dump
+    **params :  any other parameter that affects the results (mirror,
+                use_alpha, prefer_muscore, hits, ...)
+    """
+    key = dict(params, skid=str(skid), version=version, db=db, dump=dump)
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def job_key(job, botconfig, remote_instance=None):
+    """ Returns the cache key for a nblast_pool job or None if the job can't
+    be cached (batches or skeleton not found).
+    """
+    import dotprops_store
+    from skeleton_versions import get_versions
+
+    if len(job['skids']) != 1:
+        return None
+
+    skid = job['skids'][0]
+    version = get_versions([skid],
+                           remote_instance=remote_instance).get(str(skid))
+    if version is None:
+        return None
+
+    params = {k: job[k] for k in ['mirror', 'use_alpha', 'prefer_muscore',
+                                  'hits']}
+    if job['db'] == 'fafb':
+        dump = dotprops_store.dump_mtime(botconfig.FAFB_DUMP)
+        params.update({k: job.get(k) for k in ['prefilter', 'show_pruned',
+                                               'reverse_depth']},
+                      engine=botconfig.NBLAST_ENGINE)
+    elif job['db'] == 'gmr':
+        dump = botconfig.JANELIA_GMR_DB
+    else:
+        dump = botconfig.FLYCIRCUIT_DB
+
+    return make_key(skid, version, job['db'], dump, **params)
+
+
+class result_cache:
+    """ On-disk cache for results as returned by ffnblast.nblast() and
+    ffnblast_fafb.nblast().
+
+    Parameters:
+    ----------
+    path :      folder to store the cache in
+    max_size :  max size of the cache in bytes
+    """
+
+    def __init__(self, path, max_size=500 * 1024 ** 2):
+        self.path = path
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        """ Returns cached results (with file paths pointing into the cache)
+        or None.
+        """
+        f = os.path.join(self.path, key, 'results.json')
+        if not os.path.isfile(f):
+            self.misses += 1
+            return None
+
+        with open(f, 'r') as fh:
+            results = json.load(fh)
+        if not all(os.path.isfile(results[k]) for k in FILE_KEYS if results.get(k)):
+            logger.warning('Dropping incomplete NBLAST cache entry %s' % key)
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            self.misses += 1
+            return None
+
+        #Mark as recently used
+        os.utime(os.path.join(self.path, key))
+        self.hits += 1
+        return results
+
+    def put(self, key, results):
+        """ Stores results: files are copied into the cache.
+        """
+        entry = os.path.join(self.path, key)
+        tmp = entry + '.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        results = dict(results)
+        for k in FILE_KEYS:
+            if results.get(k):
+                # Keep extension so that Slack shows the right file type
+                fname = k + os.path.splitext(results[k])[1]
+                shutil.copyfile(results[k], os.path.join(tmp, fname))
+                results[k] = os.path.join(entry, fname)
+
+        with open(os.path.join(tmp, 'results.json'), 'w') as f:
+            json.dump(results, f)
+
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+
+        self.evict()
+
+    def evict(self):
+        """ Removes least recently used entries until the cache is below its
+        size limit.
+        """
+        entries = []
+        for e in os.listdir(self.path):
+            p = os.path.join(self.path, e)
+            if not os.path.isdir(p) or e.endswith('.tmp'):
+                continue
+            size = sum(os.path.getsize(os.path.join(p, f)) for f in os.listdir(p))
+            entries.append((os.path.getmtime(p), size, p))
+
+        total = sum(e[1] for e in entries)
+        for mtime, size, p in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(p, ignore_errors=True)
+            total -= size
+            logger.debug('Evicted NBLAST cache entry %s' % os.path.basename(p))
@@ -0,0 +1,494 @@
+"""
+    Native NBLAST scoring
+    nblast_engine.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Pure NumPy/SciPy re-implementation of nat.nblast's scoring: nearest
+    neighbours are found with KD-trees and distances/absolute dot products
+    are scored by a vectorised lookup in the scoring matrix (e.g. smat.fcwb).
+    The R implementation in ffnblast_fafb.py remains as reference.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+#Single neuron: points (N,3), tangent vectors (N,3) and alpha (N,)
+dotprops = namedtuple('dotprops', ['points', 'vect', 'alpha'])
+
+#Scoring matrix: distance breaks, dot product breaks and the score matrix
+#of shape (len(distbreaks) - 1, len(dotbreaks) - 1)
+smat = namedtuple('smat', ['distbreaks', 'dotbreaks', 'scores'])
+
+#Max number of targets scored in one go in the forward pass
+CHUNK_SIZE = 1000
+
+#Queries of a batch are split into groups of at most this many points; each
+#target's KD-tree is queried with all points of a group at once
+MAX_QUERY_POINTS = 20000
+
+#Max number of (target, query point) pairs scored in one go in the forward
+#pass - bounds memory per process (about 40 bytes per pair)
+MAX_CHUNK_PAIRS = 5000000
+
+#Number of target points scored in one go in the reverse pass
+REVERSE_CHUNK_POINTS = 250000
+
+#Max number of KD-trees kept per database (oldest are dropped first)
+TREE_CACHE_SIZE = 20000
+
+
+class dotprops_db:
+    """ Database of target neurons stored as concatenated arrays.
+
+    Parameters:
+    ----------
+    names :     skeleton IDs/names, one per neuron
+    points :    (N, 3) array with points of all neurons
+    vect :      (N, 3) array with tangent vectors of all neurons
+    alpha :     (N, ) array with alpha values of all neurons
+    offsets :   (len(names) + 1, ) array: points of neuron i are
+                points[offsets[i]:offsets[i+1]]
+    bboxes :    (len(names), 2, 3) array with min/max of each neuron.
+                Calculated on demand if not provided.
+    """
+
+    def __init__(self, names, points, vect, alpha, offsets, bboxes=None):
+        self.names = np.asarray(names).astype(str)
+        self.points = points
+        self.vect = vect
+        self.alpha = alpha
+        self.offsets = np.asarray(offsets)
+        self.trees = {}
+        self.self_scores = {}
+        self.name_index = None
+        self.bboxes = bboxes
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, names):
+        """ Returns positions of given skeleton IDs/names (-1 if missing).
+        """
+        if self.name_index is None:
+            self.name_index = {n: i for i, n in enumerate(self.names)}
+        return np.array([self.name_index.get(str(n), -1) for n in names],
+                        dtype=int)
+
+    def neuron(self, i):
+        """ Returns dotprops of the i-th neuron (views, not copies). """
+        s = slice(self.offsets[i], self.offsets[i + 1])
+        return dotprops(self.points[s], self.vect[s], self.alpha[s])
+
+    def tree(self, i):
+        """ Returns (cached) KD-tree for the i-th neuron. """
+        if i not in self.trees:
+            if len(self.trees) >= TREE_CACHE_SIZE:
+                del self.trees[next(iter(self.trees))]
+            self.trees[i] = cKDTree(self.neuron(i).points)
+        return self.trees[i]
+
+    def build_trees(self, idx):
+        """ Builds KD-trees for neurons in idx that are not cached yet, as
+        long as the cache has room (cached trees are never dropped here).
+        Called before forking so that child processes inherit the trees.
+        """
+        for i in idx:
+            if len(self.trees) >= TREE_CACHE_SIZE:
+                break
+            if i not in self.trees and self.offsets[i + 1] > self.offsets[i]:
+                self.trees[i] = cKDTree(self.neuron(i).points)
+
+    def point_index(self, idx):
+        """ Returns indices into points for the neurons in idx and the
+        offsets of these neurons within that index.
+        """
+        lengths = self.offsets[1:][idx] - self.offsets[:-1][idx]
+        ix = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1])
+                             for i in idx] + [np.zeros(0, dtype=int)])
+        return ix, np.concatenate([[0], np.cumsum(lengths)])
+
+    def get_bboxes(self):
+        """ Returns (cached) bounding boxes. Empty neurons get NaN. """
+        if self.bboxes is None:
+            bboxes = np.full((len(self), 2, 3), np.nan)
+            nonempty = self.offsets[1:] > self.offsets[:-1]
+            if nonempty.any():
+                starts = self.offsets[:-1][nonempty]
+                bboxes[nonempty, 0] = np.minimum.reduceat(self.points, starts, axis=0)
+                bboxes[nonempty, 1] = np.maximum.reduceat(self.points, starts, axis=0)
+            self.bboxes = bboxes
+        return self.bboxes
+
+    def get_self_scores(self, sm, use_alpha=False):
+        """ Returns (cached) raw self-scores for all neurons. """
+        key = (id(sm), use_alpha)
+        if key not in self.self_scores:
+            self.self_scores[key] = _sum_by_offsets(
+                                        score(np.zeros(len(self.points)),
+                                              _self_dots(self.vect, self.alpha,
+                                                         use_alpha),
+                                              sm),
+                                        self.offsets)
+        return self.self_scores[key]
+
+
+def score(dist, dot, sm):
+    """ Vectorised lookup of distances and dot products in scoring matrix.
+    Works like R's findInterval(..., all.inside=TRUE).
+    """
+    i = np.searchsorted(sm.distbreaks, dist, side='right') - 1
+    j = np.searchsorted(sm.dotbreaks, dot, side='right') - 1
+    i = np.clip(i, 0, len(sm.distbreaks) - 2)
+    j = np.clip(j, 0, len(sm.dotbreaks) - 2)
+    return sm.scores[i, j]
+
+
+def _self_dots(vect, alpha, use_alpha):
+    dots = np.abs(np.einsum('ij,ij->i', vect, vect))
+    if use_alpha:
+        dots = dots * alpha
+    return dots
+
+
+def _sum_by_offsets(values, offsets):
+    """ Sums values per neuron - also works for neurons without points. """
+    cs = np.concatenate([[0], np.cumsum(values)])
+    return cs[offsets[1:]] - cs[offsets[:-1]]
+
+
+def self_score(query, sm, use_alpha=False):
+    """ Raw score of a neuron against itself (used to normalise). """
+    return score(np.zeros(len(query.points)),
+                 _self_dots(query.vect, query.alpha, use_alpha),
+                 sm).sum()
+
+
+def prefilter(query, db, padding=None, sm=None):
+    """ Finds targets that can possibly overlap with the query. Targets that
+    have no point within `padding` of any query point are discarded before
+    the expensive forward pass.
+
+    If padding is the scoring matrix's second-to-last distance break (the
+    default), discarded targets could only have scored in the worst distance
+    bin, i.e. the filter is lossless. Smaller paddings prune more but are
+    an approximation: e.g. with smat.fcwb (breaks ..., 30, 40, 500) and
+    padding=30, points 30-40 microns away would have scored in the 30-40 bin.
+
+    Runs in two stages: (1) bounding boxes and (2) distance of each target
+    point to its nearest query point (single KD-tree of the query).
+
+    Parameters:
+    ----------
+    query :     dotprops of the query neuron
+    db :        dotprops_db with targets
+    padding :   max distance (same units as points) between target and query.
+                If None, derived from sm.
+    sm :        smat scoring matrix - only needed if padding is None
+
+    Returns:
+    -------
+    idx :       indices of remaining targets
+    """
+    if not len(query.points):
+        return np.arange(len(db))
+
+    if padding is None:
+        padding = sm.distbreaks[-2]
+
+    # Stage 1: bounding boxes
+    bb = db.get_bboxes()
+    qmin = query.points.min(axis=0) - padding
+    qmax = query.points.max(axis=0) + padding
+    # Comparisons with NaN (empty neurons) are False -> those are dropped
+    idx = np.where(np.all((bb[:, 0] <= qmax) & (bb[:, 1] >= qmin), axis=1))[0]
+
+    # Stage 2: any target point within padding of the query?
+    tree = cKDTree(query.points)
+    keep = []
+    for i in range(0, len(idx), CHUNK_SIZE):
+        chunk = idx[i:i + CHUNK_SIZE]
+        ix, offsets = db.point_index(chunk)
+        d, _ = tree.query(db.points[ix], distance_upper_bound=padding)
+        keep.append(chunk[_sum_by_offsets(np.isfinite(d), offsets) > 0])
+
+    return np.concatenate(keep + [np.zeros(0, dtype=int)])
+
+
+def concat(queries):
+    """ Concatenates several dotprops into one. Returns the concatenated
+    dotprops and the offsets of the individual neurons within it.
+    """
+    lengths = [len(q.points) for q in queries]
+    cat = dotprops(np.concatenate([q.points for q in queries] + [np.zeros((0, 3))]),
+                   np.concatenate([q.vect for q in queries] + [np.zeros((0, 3))]),
+                   np.concatenate([q.alpha for q in queries] + [np.zeros(0)]))
+    return cat, np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+
+
+def _forward_chunk(query, qoffsets, db, sm, use_alpha, idx):
+    """ Raw forward scores (query -> target) for targets in idx. `query` may
+    hold several concatenated queries (see concat()): all of them are
+    matched against a target's KD-tree in a single query.
+
+    Returns:
+    -------
+    scores :    (len(qoffsets) - 1, len(idx)) array
+    """
+    dist = []
+    dots = []
+    for i in idx:
+        t = db.neuron(i)
+        if not len(t.points):
+            #Empty neurons: no neighbours -> worst distance bin
+            dist.append(np.full(len(query.points), np.inf))
+            dots.append(np.zeros(len(query.points)))
+            continue
+        d, ix = db.tree(i).query(query.points)
+        dp = np.abs(np.einsum('ij,ij->i', query.vect, t.vect[ix]))
+        if use_alpha:
+            dp = dp * np.sqrt(query.alpha * t.alpha[ix])
+        dist.append(d)
+        dots.append(dp)
+
+    if not dist:
+        return np.zeros((len(qoffsets) - 1, 0))
+
+    sc = score(np.concatenate(dist), np.concatenate(dots), sm)
+    sc = sc.reshape(len(idx), len(query.points))
+
+    # Sum per query
+    cs = np.concatenate([np.zeros((len(idx), 1)), np.cumsum(sc, axis=1)], axis=1)
+    return (cs[:, qoffsets[1:]] - cs[:, qoffsets[:-1]]).T
+
+
+#Set before forking a process pool so that children inherit the databases
+_shared = None
+
+
+def _forward_worker(args):
+    k, idx = args
+    groups, db, sm, use_alpha = _shared
+    query, qoffsets = groups[k]
+    return _forward_chunk(query, qoffsets, db, sm, use_alpha, idx)
+
+
+def query_groups(queries, max_points):
+    """ Splits queries into consecutive groups of at most max_points points
+    (a larger query makes up a group on its own).
+
+    Returns:
+    -------
+    list of lists of indices into queries
+    """
+    groups = []
+    points = 0
+    for i, q in enumerate(queries):
+        if not groups or points + len(q.points) > max_points:
+            groups.append([])
+            points = 0
+        groups[-1].append(i)
+        points += len(q.points)
+    return groups
+
+
+def forward_scores(query, db, sm, use_alpha=False, idx=None,
+                   normalised=True, cores=1):
+    """ Scores query against targets in db (nearest target point for every
+    query point). Equivalent to nblast(query, db) in R.
+
+    Parameters:
+    ----------
+    query :         dotprops of the query neuron
+    db :            dotprops_db with targets
+    sm :            smat scoring matrix
+    use_alpha :     if True, weigh dot products by alpha
+    idx :           indices of targets to score. If None, score all
+    normalised :    if True, normalise by the query's self-score
+    cores :         number of processes to use
+
+    Returns:
+    -------
+    scores :        np.array with one score per target in idx
+    """
+    return forward_scores_batch([query], db, sm, use_alpha=use_alpha, idx=idx,
+                                normalised=normalised, cores=cores)[0]
+
+
+def forward_scores_batch(queries, db, sm, use_alpha=False, idx=None,
+                         normalised=True, cores=1):
+    """ Scores several queries against targets in db: queries are combined
+    into groups of up to MAX_QUERY_POINTS points and each target's KD-tree
+    is queried with the points of a whole group at the same time. Targets
+    are scored in chunks of at most CHUNK_SIZE targets and MAX_CHUNK_PAIRS
+    (target, query point) pairs, which bounds memory per process.
+
+    With cores > 1 a new process pool is forked for each call. Trees built
+    in child processes would be lost when the pool exits, so missing trees
+    are built and cached in this process before forking (up to
+    TREE_CACHE_SIZE, see dotprops_db.build_trees()) and are inherited by the
+    children. Only targets beyond the cache size are built in the children.
+
+    Parameters:
+    ----------
+    queries :       list of dotprops
+    db :            dotprops_db with targets
+    sm :            smat scoring matrix
+    use_alpha :     if True, weigh dot products by alpha
+    idx :           indices of targets to score. If None, score all
+    normalised :    if True, normalise by the queries' self-scores
+    cores :         number of processes to use
+
+    Returns:
+    -------
+    scores :        (len(queries), len(idx)) array
+    """
+    global _shared
+
+    if idx is None:
+        idx = np.arange(len(db))
+
+    groups = query_groups(queries, MAX_QUERY_POINTS)
+    concatenated = [concat([queries[i] for i in g]) for g in groups]
+
+    #(group, targets) tasks
+    tasks = []
+    for k, (query, qoffsets) in enumerate(concatenated):
+        size = max(1, min(CHUNK_SIZE, MAX_CHUNK_PAIRS // max(1, len(query.points))))
+        tasks += [(k, idx[i:i + size]) for i in range(0, len(idx), size)]
+
+    if cores > 1 and len(tasks) > 1:
+        db.build_trees(idx)
+        _shared = (concatenated, db, sm, use_alpha)
+        with multiprocessing.get_context('fork').Pool(cores) as pool:
+            results = pool.map(_forward_worker, tasks)
+        _shared = None
+    else:
+        results = [_forward_chunk(*concatenated[k], db, sm, use_alpha, c)
+                   for k, c in tasks]
+
+    scores = np.zeros((len(queries), len(idx)))
+    done = {k: 0 for k in range(len(groups))}
+    for (k, c), res in zip(tasks, results):
+        scores[groups[k], done[k]:done[k] + len(c)] = res
+        done[k] += len(c)
+
+    if normalised:
+        scores = scores / np.array([[self_score(q, sm, use_alpha)]
+                                    for q in queries])
+
+    return scores
+
+
+def chunk_by_size(idx, db, max_points):
+    """ Splits targets in idx into consecutive chunks of roughly max_points
+    points each (large neurons end up in smaller chunks).
+    """
+    if not len(idx):
+        return []
+    lengths = db.offsets[1:][idx] - db.offsets[:-1][idx]
+    breaks = np.where(np.diff(np.cumsum(lengths) // max_points))[0] + 1
+    return np.split(np.asarray(idx), breaks)
+
+
+def _reverse_chunk(tree, query, db, sm, use_alpha, idx):
+    """ Raw reverse scores (target -> query) for targets in idx. tree is the
+    query's KD-tree (None for empty queries). """
+    ix, offsets = db.point_index(idx)
+
+    if tree is None:
+        #Empty query: no neighbours -> worst distance bin
+        d = np.full(len(ix), np.inf)
+        dp = np.zeros(len(ix))
+    else:
+        d, qix = tree.query(db.points[ix])
+        dp = np.abs(np.einsum('ij,ij->i', db.vect[ix], query.vect[qix]))
+        if use_alpha:
+            dp = dp * np.sqrt(db.alpha[ix] * query.alpha[qix])
+
+    return _sum_by_offsets(score(d, dp, sm), offsets)
+
+
+def _reverse_worker(args):
+    k, idx = args
+    tree, query, db, sm, use_alpha = _shared
+    return k, _reverse_chunk(tree, query, db, sm, use_alpha, idx)
+
+
+def reverse_scores(query, db, sm, use_alpha=False, idx=None,
+                   normalised=True, cores=1, callback=None):
+    """ Scores targets in db against query (nearest query point for every
+    target point). Equivalent to nblast(db, query) in R. All targets are
+    matched against a single KD-tree of the query.
+
+    Targets are scored in chunks of about REVERSE_CHUNK_POINTS points,
+    optionally spread across several processes. A new process pool is forked
+    for each call: the query's KD-tree and the targets' self-scores are
+    prepared before forking, so children build nothing worth keeping.
+
+    Parameters:
+    ----------
+    query :         dotprops of the query neuron
+    db :            dotprops_db with targets
+    sm :            smat scoring matrix
+    use_alpha :     if True, weigh dot products by alpha
+    idx :           indices of targets to score. If None, score all
+    normalised :    if True, normalise by the targets' self-scores
+    cores :         number of processes to use
+    callback :      function called as callback(pos, scores) whenever a chunk
+                    is finished. pos are the chunk's positions in idx
+
+    Returns:
+    -------
+    scores :        np.array with one score per target in idx
+    """
+    global _shared
+
+    if idx is None:
+        idx = np.arange(len(db))
+
+    tree = cKDTree(query.points) if len(query.points) else None
+    chunks = chunk_by_size(idx, db, REVERSE_CHUNK_POINTS)
+    starts = np.cumsum([0] + [len(c) for c in chunks])
+
+    # Calculate before forking so that children don't have to
+    if normalised:
+        self_scores = db.get_self_scores(sm, use_alpha)
+
+    scores = np.zeros(len(idx))
+
+    def collect(k, values):
+        pos = np.arange(starts[k], starts[k + 1])
+        if normalised:
+            values = values / self_scores[chunks[k]]
+        scores[pos] = values
+        if callback:
+            callback(pos, values)
+
+    if cores > 1 and len(chunks) > 1:
+        _shared = (tree, query, db, sm, use_alpha)
+        with multiprocessing.get_context('fork').Pool(cores) as pool:
+            for k, values in pool.imap_unordered(_reverse_worker,
+                                                 enumerate(chunks)):
+                collect(k, values)
+        _shared = None
+    else:
+        for k, c in enumerate(chunks):
+            collect(k, _reverse_chunk(tree, query, db, sm, use_alpha, c))
+
+    return scores
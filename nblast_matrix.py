@@ -0,0 +1,225 @@
+"""
+    Precomputed all-by-all NBLAST of the FAFB nightly dump
+    nblast_matrix.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Stores the normalised forward scores of every neuron in the dotprops store
+    (see dotprops_store.py) against every other neuron as a quantised int16
+    matrix (row = query, column = target). On later nights only rows and
+    columns of neurons that changed since the last run are recomputed.
+
+    nblast-fafb uses the matrix to answer with a row lookup if the query
+    skeleton has not been edited since the dump was converted into the store:
+    rows are scored from the dump's geometry, so the reference point for
+    is_current() are the CATMAID versions recorded by dotprops_store.py at
+    conversion time - not versions fetched when the matrix is built.
+
+    Run after the dotprops store has been updated (e.g. via cron):
+        python3 dotprops_store.py && python3 nblast_matrix.py [cores]
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib, json, logging, multiprocessing, os
+
+import numpy as np
+
+import nblast_engine
+import dotprops_store
+
+logger = logging.getLogger('pybotLog')
+
+#Name of the matrix (a folder) inside FAFB_DUMP
+MATRIX_NAME = 'fulln.simp10.allbyall'
+
+#Scores are stored as int16: score = value / SCALE (range +/- 3.27)
+SCALE = 10000
+
+#Number of rows copied from the previous matrix in one go
+COPY_ROWS = 1000
+
+
+class score_matrix:
+    """ Read-only access to a precomputed all-by-all matrix.
+
+    Parameters:
+    ----------
+    path :      folder of the matrix
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.scores = np.load(os.path.join(path, 'scores.npy'), mmap_mode='r')
+        self.names = np.load(os.path.join(path, 'names.npy'))
+        self.fingerprints = np.load(os.path.join(path, 'fingerprints.npy'))
+        with open(os.path.join(path, 'versions.json'), 'r') as f:
+            self.versions = json.load(f)
+        self.name_index = {n: i for i, n in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def is_current(self, skid, version):
+        """ True if skid is in the matrix and has not changed since. """
+        skid = str(skid)
+        return skid in self.name_index and self.versions.get(skid) == version
+
+    def forward(self, skid):
+        """ Forward scores of skid against all neurons. """
+        return self.scores[self.name_index[str(skid)]] / SCALE
+
+    def reverse(self, skid, idx):
+        """ Scores of neurons in idx against skid (i.e. reverse scores). """
+        return self.scores[np.asarray(idx), self.name_index[str(skid)]] / SCALE
+
+
+def open_matrix(dump_folder):
+    """ Opens the matrix in dump_folder. Returns None if there is none.
+    """
+    path = os.path.join(dump_folder, MATRIX_NAME)
+    if not os.path.isfile(os.path.join(path, 'versions.json')):
+        return None
+    return score_matrix(path)
+
+
+def quantise(scores):
+    #Empty neurons have NaN scores -> put them at the very bottom
+    scores = np.nan_to_num(scores, nan=-32767 / SCALE)
+    return np.clip(np.round(scores * SCALE), -32767, 32767).astype(np.int16)
+
+
+def fingerprint(db):
+    """ Returns a hash of each neuron's points - changes if the neuron's
+    geometry in the dump changes.
+    """
+    return np.array([hashlib.sha1(np.ascontiguousarray(db.neuron(i).points).tobytes()).hexdigest()[:16]
+                     for i in range(len(db))])
+
+
+#Set before forking a process pool so that children inherit the databases
+_shared = None
+
+
+def _column(c):
+    """ Target c's column (all neurons against c). Uses the reverse pass:
+    scoring all points against c's KD-tree at once.
+    """
+    db, sm, unchanged = _shared
+    return c, quantise(nblast_engine.reverse_scores(db.neuron(c), db, sm))
+
+
+def _row(c):
+    """ Query c's row (c against all unchanged neurons). """
+    db, sm, unchanged = _shared
+    return c, quantise(nblast_engine.forward_scores(db.neuron(c), db, sm,
+                                                    idx=unchanged))
+
+
+def refresh_matrix(dump_folder, cores=1):
+    """ Builds (or incrementally updates) the all-by-all matrix. Neuron
+    versions are taken from the store (recorded when the dump was converted).
+
+    Parameters:
+    ----------
+    dump_folder :   folder with the dotprops store
+    cores :         number of processes to use
+    """
+    global _shared
+
+    store = os.path.join(dump_folder, dotprops_store.STORE_NAME)
+    db = dotprops_store.open_store(store)
+    sm = dotprops_store.open_smat(store)
+    if sm is None:
+        raise ValueError('Dotprops store has no scoring matrix - please '
+                         're-run dotprops_store.py')
+    versions = dotprops_store.read_versions(store)
+    if versions is None:
+        raise ValueError('Dotprops store has no neuron versions - please '
+                         're-run dotprops_store.py')
+
+    fps = fingerprint(db)
+    old = open_matrix(dump_folder)
+
+    # Find neurons that are unchanged since the last run
+    if old is not None:
+        oi = np.array([old.name_index.get(n, -1) for n in db.names], dtype=int)
+        unchanged = (oi >= 0)
+        unchanged[unchanged] = old.fingerprints[oi[unchanged]] == fps[unchanged]
+    else:
+        oi = np.full(len(db), -1, dtype=int)
+        unchanged = np.zeros(len(db), dtype=bool)
+
+    ni = np.where(unchanged)[0]
+    changed = np.where(~unchanged)[0]
+    logger.info('%i neurons in dump: %i unchanged, %i new or changed' % (len(db),
+                                                                       len(ni),
+                                                                       len(changed)))
+
+    path = os.path.join(dump_folder, MATRIX_NAME)
+    tmp = dotprops_store.make_tmp(path)
+    scores = np.lib.format.open_memmap(os.path.join(tmp, 'scores.npy'),
+                                       mode='w+', dtype=np.int16,
+                                       shape=(len(db), len(db)))
+
+    # Copy unchanged block in chunks of rows
+    for i in range(0, len(ni), COPY_ROWS):
+        rows = ni[i:i + COPY_ROWS]
+        scores[rows[:, None], ni[None, :]] = old.scores[oi[rows]][:, oi[ni]]
+
+    # Columns for changed neurons cover all rows; rows for changed neurons
+    # then only need the unchanged columns
+    jobs = [(_column, changed), (_row, changed if len(ni) else [])]
+
+    _shared = (db, sm, ni)
+    with multiprocessing.get_context('fork').Pool(cores) as pool:
+        for func, args in jobs:
+            for k, (c, values) in enumerate(pool.imap_unordered(func, args,
+                                                                chunksize=16)):
+                if func is _column:
+                    scores[:, c] = values
+                else:
+                    scores[c, ni] = values
+                if k and not k % 1000:
+                    logger.info('%s: %i of %i' % (func.__name__, k, len(args)))
+    _shared = None
+
+    scores.flush()
+    del scores
+
+    np.save(os.path.join(tmp, 'names.npy'), db.names)
+    np.save(os.path.join(tmp, 'fingerprints.npy'), fps)
+    with open(os.path.join(tmp, 'versions.json'), 'w') as f:
+        json.dump({n: versions.get(n) for n in db.names}, f)
+
+    dotprops_store.swap_in(tmp, path)
+    logger.info('All-by-all matrix updated')
+
+
+if __name__ == '__main__':
+    import sys
+    import botconfig
+
+    #Create console handler
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - '
+                                      '%(levelname)s - %(message)s'))
+    logger.addHandler(ch)
+
+    if len(sys.argv) > 1:
+        cores = int(sys.argv[1])
+    else:
+        cores = multiprocessing.cpu_count()
+
+    refresh_matrix(botconfig.FAFB_DUMP, cores=cores)
@@ -0,0 +1,358 @@
+"""
+    Persistent pool of NBLAST workers
+    nblast_pool.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    A single server process imports the R libraries and loads the flycircuit,
+    GMR and FAFB dotprops exactly once. It then forks the actual workers which
+    inherit the loaded databases (copy-on-write, i.e. all workers share one
+    copy in memory). Each worker has its own job queue, so that the bot knows
+    which jobs are lost if a worker dies. Results are passed back to the bot
+    via a shared queue. If the server itself dies, its jobs are failed and a
+    new server is started.
+
+    Jobs are not handed to the workers straight away: the bot-side scheduler
+    keeps them in a queue and only starts a job once a worker and the number
+    of CPU cores the job asked for are free (machine-wide core budget). The
+    queue is FIFO but interleaves users, so that a single user can't block
+    everyone else with a batch of jobs.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging, multiprocessing, os, shutil, tempfile, time, traceback
+
+logger = logging.getLogger('pybotLog')
+
+#Min number of seconds between two progress messages of a job
+PROGRESS_INTERVAL = 10
+
+#Each job writes its WebGL file/hit table to its own folder in here
+OUTPUT_DIR = 'webGL'
+
+
+def _serve(jobs, results, n_workers, stop, parent_pid):
+    """ Loads databases once, then forks and babysits the workers.
+    """
+    import botconfig
+
+    #Create console handler - workers do not inherit the bot's handlers
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - '
+                                      '%(levelname)s - %(message)s'))
+    for l in [logger,
+              logging.getLogger('fire-n-forget NBLAST'),
+              logging.getLogger('fire-n-forget FAFB NBLAST')]:
+        l.addHandler(ch)
+        l.setLevel(logging.INFO)
+
+    dbs = {}
+    if botconfig.FLYCIRCUIT_DB or botconfig.JANELIA_GMR_DB:
+        try:
+            import ffnblast
+            dbs.update(ffnblast.load_databases(botconfig))
+        except Exception:
+            logger.error('Failed to load flycircuit/GMR databases',
+                         exc_info=True)
+    if botconfig.FAFB_DUMP:
+        try:
+            import ffnblast_fafb
+            dbs.update(ffnblast_fafb.load_databases(botconfig))
+        except Exception:
+            logger.error('Failed to load FAFB dump', exc_info=True)
+
+    logger.info('NBLAST databases loaded: %s' % ', '.join(dbs))
+
+    #Fork workers AFTER loading so that they share the databases
+    ctx = multiprocessing.get_context('fork')
+    workers = {}
+    while not stop.is_set():
+        for i in range(n_workers):
+            if i in workers and workers[i].is_alive():
+                continue
+            if i in workers:
+                logger.error('NBLAST worker %i died - restarting' % i)
+                #The bot fails the job it gave this worker - drop it in case
+                #the worker died before picking it up
+                while not jobs[i].empty():
+                    jobs[i].get()
+                results.put({'worker': i, 'status': 'died'})
+            workers[i] = ctx.Process(target=_work,
+                                     args=(i, jobs[i], results, dbs),
+                                     name='nblast_worker_%i' % i)
+            workers[i].start()
+
+        #Shut down if the bot is gone
+        if os.getppid() != parent_pid:
+            stop.set()
+
+        stop.wait(5)
+
+    #One sentinel per worker
+    for w in workers:
+        jobs[w].put(None)
+    for w in workers.values():
+        w.join()
+
+
+def _work(index, jobs, results, dbs):
+    """ Runs NBLAST jobs until it receives a None sentinel.
+    """
+    import botconfig
+    import ffnblast, ffnblast_fafb
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+
+        results.put({'id': job['id'], 'worker': index, 'status': 'started'})
+
+        params = {k: job[k] for k in ['mirror', 'cores', 'prefer_muscore',
+                                      'use_alpha']}
+        try:
+            if job['db'] not in dbs:
+                raise ValueError('Database "%s" not loaded' % job['db'])
+
+            webgl_dir = job['out_dir']
+            if job['db'] == 'fafb':
+                fafb_params = dict(engine=botconfig.NBLAST_ENGINE,
+                                   prefilter=job.get('prefilter'),
+                                   reverse_depth=job.get('reverse_depth', 100))
+                if len(job['skids']) > 1:
+                    res = ffnblast_fafb.nblast_batch(job['skids'], dbs,
+                                                     top_n=job['top_n'],
+                                                     out_dir=webgl_dir,
+                                                     **fafb_params, **params)
+                else:
+                    res = ffnblast_fafb.nblast(job['skids'][0], dbs,
+                                               hits=job['hits'],
+                                               webgl_dir=webgl_dir,
+                                               show_pruned=job.get('show_pruned', False),
+                                               progress=_progress(job, results),
+                                               **fafb_params, **params)
+            elif len(job['skids']) > 1:
+                res = ffnblast.nblast_batch(job['skids'], dbs, db=job['db'],
+                                            top_n=job['top_n'],
+                                            out_dir=webgl_dir, **params)
+            else:
+                res = ffnblast.nblast(job['skids'][0], dbs, db=job['db'],
+                                      hits=job['hits'], webgl_dir=webgl_dir,
+                                      **params)
+            results.put({'id': job['id'], 'status': 'done', 'results': res})
+        except Exception:
+            logger.error('NBLAST job %i failed' % job['id'], exc_info=True)
+            results.put({'id': job['id'], 'status': 'failed',
+                         'error': traceback.format_exc()})
+
+
+def _progress(job, results):
+    """ Returns a function that passes progress messages of job back to the
+    bot - at most one every PROGRESS_INTERVAL seconds.
+    """
+    last = [time.time()]
+
+    def progress(message):
+        if time.time() - last[0] >= PROGRESS_INTERVAL:
+            last[0] = time.time()
+            results.put({'id': job['id'], 'status': 'progress',
+                         'message': message})
+
+    return progress
+
+
+class nblast_pool:
+    """ Long-lived pool of NBLAST workers with a scheduler. Submit jobs and
+    regularly collect finished ones with finished().
+
+    Parameters:
+    ----------
+    n_workers :     number of parallel NBLAST jobs
+    core_budget :   max number of CPU cores used by all running jobs combined.
+                    Defaults to the number of cores of the machine
+    """
+
+    def __init__(self, n_workers=1, core_budget=None):
+        self.n_workers = n_workers
+        self.core_budget = core_budget or multiprocessing.cpu_count()
+        self.pending = {}
+        self.queue = []
+        #{ job_id : cores } of jobs handed to a worker
+        self.dispatched = {}
+        #{ worker : job_id }
+        self.assigned = {}
+        self.positions = {}
+        self.next_id = 1
+        self.server = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def start(self):
+        #Spawn (not fork) the server so that it does not inherit the bot's
+        #threads and websocket
+        ctx = multiprocessing.get_context('spawn')
+        self.jobs = [ctx.SimpleQueue() for i in range(self.n_workers)]
+        self.results = ctx.SimpleQueue()
+        self.stop_event = ctx.Event()
+        self.server = ctx.Process(target=_serve,
+                                  args=(self.jobs, self.results,
+                                        self.n_workers, self.stop_event,
+                                        os.getpid()),
+                                  name='nblast_pool')
+        self.server.start()
+        logger.info('Started NBLAST pool (pid %i)' % self.server.pid)
+
+    def stop(self):
+        self.stop_event.set()
+        self.server.join()
+
+    def submit(self, job):
+        """ Queues a job.
+
+        Parameters:
+        ----------
+        job :   dict with 'skids' (list), 'db' ('fc', 'gmr' or 'fafb'),
+                'mirror', 'hits', 'cores', 'prefer_muscore' and 'use_alpha'.
+                Jobs with more than one skid are blasted as one batch and
+                also need 'top_n' (hits per query in the table). 'user' is
+                used to interleave users in the queue. Anything else (e.g.
+                channel) is handed back untouched by finished().
+
+        Returns:
+        -------
+        job_id
+        """
+        if not os.path.isdir(OUTPUT_DIR):
+            os.makedirs(OUTPUT_DIR)
+
+        job = dict(job, id=self.next_id,
+                   cores=max(1, min(job['cores'], self.core_budget)),
+                   out_dir=tempfile.mkdtemp(prefix='%i_' % self.next_id,
+                                            dir=OUTPUT_DIR))
+        self.next_id += 1
+        self.pending[job['id']] = job
+        self.queue.append(job)
+        logger.debug('Queued NBLAST job %i for #%s' % (job['id'],
+                                                      ' #'.join(job['skids'])))
+        self._dispatch()
+        return job['id']
+
+    def cleanup(self, job):
+        """ Removes the job's output folder. Call once results are posted.
+        """
+        shutil.rmtree(job['out_dir'], ignore_errors=True)
+
+    def _release(self, job_id):
+        """ Frees the cores and the worker of a dispatched job. """
+        self.dispatched.pop(job_id, None)
+        self.assigned = {w: j for w, j in self.assigned.items() if j != job_id}
+
+    def _fail(self, job_id, error):
+        self._release(job_id)
+        return (self.pending.pop(job_id),
+                {'id': job_id, 'status': 'failed', 'error': error})
+
+    def queue_position(self, job_id):
+        """ Returns the job's position in the queue (0 if already running).
+        """
+        for i, job in enumerate(self._fair_order()):
+            if job['id'] == job_id:
+                return i + 1
+        return 0
+
+    def _fair_order(self):
+        """ Returns queued jobs in the order they will be started: a user's
+        n-th job (counting running ones) goes after every other user's
+        (n-1)-th job, otherwise first come first served.
+        """
+        running = {}
+        for job_id in self.dispatched:
+            u = self.pending[job_id].get('user')
+            running[u] = running.get(u, 0) + 1
+
+        ranked = []
+        for k, job in enumerate(self.queue):
+            u = job.get('user')
+            ranked.append((running.get(u, 0), k, job))
+            running[u] = running.get(u, 0) + 1
+
+        return [job for n, k, job in sorted(ranked, key=lambda x: x[:2])]
+
+    def _dispatch(self):
+        """ Hands queued jobs to the workers while there are idle workers and
+        enough free cores. Never skips ahead of the next job in line.
+        """
+        used = sum(self.dispatched.values())
+        idle = [i for i in range(self.n_workers) if i not in self.assigned]
+        for job in self._fair_order():
+            if not idle or used + job['cores'] > self.core_budget:
+                break
+            self.queue.remove(job)
+            self.dispatched[job['id']] = job['cores']
+            self.assigned[idle[0]] = job['id']
+            used += job['cores']
+            self.jobs[idle.pop(0)].put(job)
+            logger.debug('Started NBLAST job %i (%i of %i cores in use)' % (job['id'],
+                                                                          used,
+                                                                          self.core_budget))
+
+    def finished(self):
+        """ Collects finished jobs without blocking and starts queued jobs
+        if possible.
+
+        Returns:
+        -------
+        list of (job, result) tuples. result['status'] is either 'done' (with
+        result['results']), 'failed' (with result['error']), 'progress'
+        (with result['message'] - the job is still running) or 'queued'
+        (with result['position'] - the job's queue position changed, 0 means
+        it has been started).
+        """
+        done = []
+        while not self.results.empty():
+            r = self.results.get()
+            if r['status'] == 'started':
+                continue
+            elif r['status'] == 'died':
+                #Fail the job given to that worker (started or not)
+                job_id = self.assigned.get(r['worker'])
+                if job_id is not None:
+                    done.append(self._fail(job_id, 'NBLAST worker died'))
+            elif r['status'] == 'progress':
+                if r['id'] in self.pending:
+                    done.append((self.pending[r['id']], r))
+            elif r['id'] in self.pending:
+                self._release(r['id'])
+                done.append((self.pending.pop(r['id']), r))
+
+        if not self.server.is_alive() and not self.stop_event.is_set():
+            logger.error('NBLAST server died - failing its jobs and restarting')
+            for job_id in list(self.dispatched):
+                done.append(self._fail(job_id, 'NBLAST server died'))
+            self.start()
+
+        self._dispatch()
+
+        #Report changed queue positions
+        positions = {job['id']: i + 1 for i, job in enumerate(self._fair_order())}
+        for job_id in set(positions) | set(self.positions):
+            if job_id in self.pending and \
+               positions.get(job_id, 0) != self.positions.get(job_id, 0):
+                done.append((self.pending[job_id],
+                             {'id': job_id, 'status': 'queued',
+                              'position': positions.get(job_id, 0)}))
+        self.positions = positions
+
+        return done
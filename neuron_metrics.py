@@ -0,0 +1,164 @@
+"""
+    Summary metrics for subscribed neurons
+    neuron_metrics.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Reduces skeletons, partners, annotations and review status as returned by
+    pymaid to one small record per neuron. Node and connector tables of all
+    neurons are concatenated and counted with grouped operations instead of
+    filtering each neuron's tables separately.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+
+import pandas as pd
+
+logger = logging.getLogger('pybotLog')
+
+#Tags that mark an end node as closed
+END_TAGS = ['ends', 'uncertain_end']
+
+#Partners smaller than this (nodes) are not tracked
+PARTNER_MIN_SIZE = 500
+
+
+def _counts(table, column, skids, values):
+    """ Returns DataFrame (skids x values) with number of rows per skeleton
+    and value in column.
+    """
+    counts = table.groupby(['skeleton_id', column]).size().unstack(fill_value=0)
+    return counts.reindex(index=skids, columns=values, fill_value=0).fillna(0).astype(int)
+
+
+def _concat(neurons, attr, columns):
+    """ Concatenates the given columns of each neuron's table and adds the
+    skeleton ID.
+    """
+    tables = [getattr(n, attr)[columns].assign(skeleton_id=str(n.skeleton_id))
+              for n in neurons]
+    if not tables:
+        return pd.DataFrame(columns=columns + ['skeleton_id'])
+    return pd.concat(tables, ignore_index=True)
+
+
+def extract_roots(skdata):
+    """ Returns { skid : { 'root_id', 'x', 'y', 'z' } } (see root_index.py).
+    """
+    roots = {}
+    for n in skdata.itertuples():
+        root = n.nodes[n.nodes.type == 'root']
+        if root.empty:
+            continue
+        root = root.iloc[0]
+        #Older pymaid versions call it treenode_id
+        root_id = root['node_id'] if 'node_id' in root.index else root['treenode_id']
+        roots[str(n.skeleton_id)] = {'root_id': int(root_id),
+                                     'x': float(root.x),
+                                     'y': float(root.y),
+                                     'z': float(root.z)}
+    return roots
+
+
+def extract_partners(connectivity, skids):
+    """ Returns { skid : { relation : { 'ids', 'counts' } } } with partners
+    as sorted ID/count lists per relation (see subscription_diff.py).
+
+    Parameters:
+    ----------
+    connectivity :  partner table from get_partners
+    skids :         skeleton IDs (str) of the queried neurons
+    """
+    #Long format: one row per (neuron, partner, relation) with synapses
+    queries = [s for s in skids if s in connectivity.columns]
+    edges = connectivity.melt(id_vars=['skeleton_id', 'relation'],
+                              value_vars=queries, var_name='query',
+                              value_name='synapses')
+    edges = edges[edges.synapses > 0]
+    edges = edges.assign(partner=edges.skeleton_id.astype('int64'),
+                         synapses=edges.synapses.astype('int64'))
+    edges = edges.sort_values(['query', 'relation', 'partner'])
+
+    partners = {s: {rel: {'ids': [], 'counts': []} for rel in ['upstream', 'downstream']}
+                for s in skids}
+    for (q, rel), grp in edges.groupby(['query', 'relation'], sort=False):
+        partners[q][rel] = {'ids': grp.partner.tolist(),
+                            'counts': grp.synapses.tolist()}
+    return partners
+
+
+def closed_end_counts(tags, skids):
+    """ Returns { skid : number of nodes tagged with END_TAGS }.
+
+    Parameters:
+    ----------
+    tags :      table with 'skeleton_id' and 'tag' columns (one row per
+                tagged node), e.g. from get_label_list
+    skids :     skeleton IDs (str)
+    """
+    ends = tags[tags.tag.isin(END_TAGS)]
+    counts = ends.skeleton_id.astype(str).value_counts()
+    return {s: int(counts.get(s, 0)) for s in skids}
+
+
+def extract_metrics(skdata, connectivity, annotations, r_status):
+    """ Extracts summary metrics for all neurons at once.
+
+    Parameters:
+    ----------
+    skdata :        CatmaidNeuronList with nodes, connectors and tags
+    connectivity :  partner table from get_partners
+    annotations :   { skid : [ annotations ] } from get_annotations
+    r_status :      review status from get_review
+
+    Returns:
+    -------
+    { skid : { 'name', 'branch_points', 'n_nodes', 'pre_synapses',
+               'post_synapses', 'open_ends', 'partners',
+               'annotations', 'review_status' } }
+    """
+    neurons = list(skdata.itertuples())
+    skids = [str(n.skeleton_id) for n in neurons]
+
+    nodes = _concat(neurons, 'nodes', ['type'])
+    node_types = _counts(nodes, 'type', skids, ['branch', 'end'])
+    n_nodes = nodes.groupby('skeleton_id').size().reindex(skids, fill_value=0)
+
+    connectors = _concat(neurons, 'connectors', ['relation'])
+    relations = _counts(connectors, 'relation', skids, [0, 1])
+
+    closed_ends = {str(n.skeleton_id): sum(len(n.tags.get(t, [])) for t in END_TAGS)
+                   for n in neurons}
+
+    partners = extract_partners(connectivity, skids)
+
+    review = r_status.set_index(r_status.skeleton_id.astype(str)).percent_reviewed.to_dict()
+
+    branch_points = node_types['branch'].to_dict()
+    ends = node_types['end'].to_dict()
+    pre = relations[0].to_dict()
+    post = relations[1].to_dict()
+    n_nodes = n_nodes.to_dict()
+
+    return {s: {'name': n.neuron_name,
+                'branch_points': int(branch_points[s]),
+                'n_nodes': int(n_nodes[s]),
+                'pre_synapses': int(pre[s]),
+                'post_synapses': int(post[s]),
+                'open_ends': int(ends[s] - closed_ends[s]),
+                'partners': partners[s],
+                'annotations': sorted(set(annotations.get(s, []))),
+                'review_status': review.get(s)}
+            for s, n in zip(skids, neurons)}
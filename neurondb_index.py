@@ -0,0 +1,136 @@
+"""
+    Search index for the neuron database
+    neurondb_index.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Inverted index from token to skeleton IDs over the searchable fields of the
+    neuron database (see neurondb_manager in pybot.py). The index is built once
+    from the shelve and then kept up to date as entries are edited or deleted.
+    A search intersects the posting lists of its terms; terms match as
+    prefixes, which are looked up in a sorted list of all tokens.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect, logging, re, threading
+
+logger = logging.getLogger('pybotLog')
+
+#Fields of a neuron entry that are searched (all of them)
+INDEXED_FIELDS = ['name', 'catmaid_name', 'skid', 'alternative_names', 'type',
+                  'neuropils', 'status', 'tags', 'last_edited', 'comments']
+
+
+def tokenize(text):
+    """ Returns lower case word tokens in text. """
+    return re.findall(r'\w+', text.lower())
+
+
+def neuron_tokens(neuron):
+    """ Returns set of tokens for a neuron entry. List fields (e.g. comments)
+    are indexed item by item.
+    """
+    tokens = set()
+    for f in INDEXED_FIELDS:
+        value = neuron.get(f, '')
+        if not isinstance(value, list):
+            value = [value]
+        for v in value:
+            tokens.update(tokenize(str(v)))
+    return tokens
+
+
+class neurondb_index:
+    """ In-memory { token : set of skids } index of the neuron database.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        #Tokens per skid - needed to remove an entry's old tokens
+        self.tokens = {}
+        self.sorted_tokens = []
+        self.lock = threading.Lock()
+        self.built = False
+
+    def build(self, data):
+        """ (Re-)builds the index from the neuron database (shelve or dict).
+        """
+        with self.lock:
+            self.postings, self.tokens = {}, {}
+            for s in data.keys():
+                self._add(s, data[s])
+            self.sorted_tokens = sorted(self.postings)
+            self.built = True
+        logger.debug('Indexed %i neurons (%i tokens)' % (len(self.tokens),
+                                                          len(self.postings)))
+
+    def _add(self, skid, neuron):
+        tokens = neuron_tokens(neuron)
+        self.tokens[skid] = tokens
+        new = False
+        for t in tokens:
+            if t not in self.postings:
+                self.postings[t] = set()
+                new = True
+            self.postings[t].add(skid)
+        return new
+
+    def _remove(self, skid):
+        gone = False
+        for t in self.tokens.pop(skid, ()):
+            self.postings[t].discard(skid)
+            if not self.postings[t]:
+                del self.postings[t]
+                gone = True
+        return gone
+
+    def update(self, skid, neuron):
+        """ Re-indexes a single (new or edited) entry. """
+        skid = str(skid)
+        with self.lock:
+            if self._remove(skid) | self._add(skid, neuron):
+                self.sorted_tokens = sorted(self.postings)
+
+    def remove(self, skid):
+        """ Drops an entry from the index. """
+        with self.lock:
+            if self._remove(str(skid)):
+                self.sorted_tokens = sorted(self.postings)
+
+    def _prefix(self, prefix):
+        """ Returns set of skids with any token starting with prefix. """
+        hits = set()
+        i = bisect.bisect_left(self.sorted_tokens, prefix)
+        while i < len(self.sorted_tokens) and self.sorted_tokens[i].startswith(prefix):
+            hits |= self.postings[self.sorted_tokens[i]]
+            i += 1
+        return hits
+
+    def search(self, terms):
+        """ Returns set of skids matching all terms (each term as prefix of
+        a token).
+        """
+        tokens = set(t for term in terms for t in tokenize(term))
+        if not tokens:
+            return set()
+
+        with self.lock:
+            #Start with the rarest term to keep intersections small
+            postings = sorted((self._prefix(t) for t in tokens), key=len)
+        hits = postings[0]
+        for p in postings[1:]:
+            hits = hits & p
+            if not hits:
+                break
+        return hits
@@ -22,7 +22,9 @@ matplotlib.use('AGG')
 #Pyplot has to imported AFTER setting the backend!
 import matplotlib.pyplot as plt
 
-import time, re, threading, random, json, sys, subprocess, shelve, os
+import time, re, threading, random, json, sys, shelve, os, select
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import rpy2.robjects as robjects
 import logging
 from slackclient import SlackClient
@@ -32,20 +34,50 @@ from pyzotero import zotero
 from datetime import datetime, date, timedelta
 from websocket import WebSocketConnectionClosedException
 
+from ffnblast import post_results
+from nblast_pool import nblast_pool
+from nblast_cache import result_cache, job_key
+from dispatcher import command_dispatcher
+from slack_delivery import delivery_client
+from root_index import root_index
+from subscription_db import subscription_db
+from neuron_metrics import extract_metrics, extract_roots, PARTNER_MIN_SIZE
+from subscription_diff import diff_neuron, format_changes
+from zotero_index import zotero_index
+from zotero_cache import attachment_cache
+from neurondb_index import neurondb_index
+
 import pymaid
 from pymaid.plotting import plot2d
 from pymaid import (CatmaidInstance,
-                    get_review,
-                    get_neuron,
-                    get_partners,
-                    get_names,
-                    neuron_exists,
                     get_skids_by_name,
                     get_skids_by_annotation,
-                    get_annotations,
                     url_to_coordinates,
                     eval_skids)
 
+import catmaid_cache
+from skeleton_versions import get_edit_stamps, edited_neurons
+
+#Number of skeleton IDs validated per request (see missing_neurons())
+VALIDATION_CHUNK_SIZE = 1000
+
+#Number of neurons downloaded at a time when updating subscriptions
+UPDATE_CHUNK_SIZE = 100
+
+#Lookups shared by all handlers go through a process-wide cache
+lookup_cache = catmaid_cache.lookup_cache()
+get_names = lookup_cache.wrap(pymaid.get_names, per_skid=True)
+get_annotations = lookup_cache.wrap(pymaid.get_annotations, per_skid=True)
+get_neuron = lookup_cache.wrap(pymaid.get_neuron)
+get_partners = lookup_cache.wrap(pymaid.get_partners)
+get_review = lookup_cache.wrap(pymaid.get_review)
+
+#Root nodes for links to neurons (see root_index.py)
+root_nodes = root_index()
+
+#Search index of the neuron database - built on first use
+neuron_index = neurondb_index()
+
 
 class subscription_manager(threading.Thread):
     """ Class to process subscriptions to neurons
@@ -73,160 +105,135 @@ class subscription_manager(threading.Thread):
             logger.error('Failed to join thread for ' + self.url, exc_info = True  )
         return None
 
-    def process_neurons( self, skids ):
+    def process_neurons( self, skids, stamps=None ):
         """
-        Retrieves data for neurons from the CATMAID server and extracts relevant information
+        Retrieves data for neurons from the CATMAID server and extracts relevant information.
+        Neurons are processed in chunks of UPDATE_CHUNK_SIZE and only their
+        summary is kept, so memory does not grow with the number of neurons.
+        Root nodes go straight into the root index.
 
         Parameters:
         ----------
         skids :     skeleton IDs to check
+        stamps :    edit stamps of the neurons (see skeleton_versions.get_edit_stamps).
+                    Fetched if not provided. Stored with the data to tell
+                    whether a neuron has been edited since.
 
         Returns:
         -------
-        changes :   {skid: { value : [ old, new ] }}
-        skdata :    skeleton data for all neurons (order as in <skids>)
+        new_data :  { skid : summary } (see neuron_metrics.extract_metrics)
         """
 
-        #Retrieve relevant data from Catmaid server
-        skdata = get_neuron(skids, remote_instance=remote_instance)
-        connectivity = get_partners(skids, remote_instance=remote_instance,
-                                    min_size = 500)
-        annotations = get_annotations(skids, remote_instance=remote_instance)
-        r_status = get_review(skids, remote_instance=remote_instance).set_index('skeleton_id')
+        #Make sure other handlers don't use stale data
+        lookup_cache.invalidate(skids)
+
+        #Take stamps BEFORE the data so that edits in between are caught next time
+        if stamps is None:
+            stamps = get_edit_stamps(skids, remote_instance=remote_instance)
 
         new_data = {}
-        logger.info('Extracting data...')
-        #Extract data
-        for neuron in skdata.itertuples():
-            if 'ends' in neuron.tags:
-                closed_ends  =  len( neuron.tags['ends'] )
-            else:
-                closed_ends = 0
+        for i in range(0, len(skids), UPDATE_CHUNK_SIZE):
+            chunk = skids[i: i + UPDATE_CHUNK_SIZE]
+            logger.info('Processing neurons %i-%i of %i' % (i + 1, i + len(chunk), len(skids)))
 
-            if 'uncertain_ends' in neuron.tags:
-                uncertain_ends  =  len( neuron.tags['uncertain_end'] )
-            else:
-                uncertain_ends = 0
+            #Retrieve relevant data from Catmaid server - bypasses the lookup
+            #cache so that the raw tables are not kept around
+            skdata = pymaid.get_neuron(chunk, remote_instance=remote_instance)
+            connectivity = pymaid.get_partners(chunk, remote_instance=remote_instance,
+                                               min_size = PARTNER_MIN_SIZE)
+            annotations = pymaid.get_annotations(chunk, remote_instance=remote_instance)
+            r_status = pymaid.get_review(chunk, remote_instance=remote_instance)
 
-            open_ends = neuron.nodes[ neuron.nodes.type == 'end' ].shape[0] - closed_ends - uncertain_ends
+            new_data.update( extract_metrics(skdata, connectivity, annotations, r_status) )
 
-            try:
-                this_an = annotations[ str(s) ]
-            except:
-                this_an = []
-
-            #First collect all synaptically connected neurons
-            all_con = {  n :  { 'upstream' : '-', 'downstream' : '-' }  for n in connectivity[ connectivity[ neuron.skeleton_id ] > 0 ].skeleton_id.unique() }
-
-            for n in connectivity[ connectivity[ neuron.skeleton_id ] > 0 ][ [ 'skeleton_id', 'relation', neuron.skeleton_id ]  ].itertuples():
-                all_con[ n.skeleton_id] [  n.relation ] = n[ 2 ]
-
-            #Don't forget to update basic_values when editing database entries!
-            new_data[ neuron.skeleton_id ] = {  'name'                  : neuron.neuron_name,
-                                                'branch_points'         : neuron.nodes[ neuron.nodes.type == 'branch' ].shape[0],
-                                                'n_nodes'               : neuron.nodes.shape[0],
-                                                'pre_synapses'          : neuron.connectors[ neuron.connectors.relation == 0 ].shape[0],
-                                                'post_synapses'         : neuron.connectors[ neuron.connectors.relation == 1 ].shape[0],
-                                                'open_ends'             : open_ends,
-                                                'synaptic_partners'     : all_con,
-                                                'last_update'           : str( date.today() ),
-                                                'last_edited_by'        : 'unknown',
-                                                'annotations'           : this_an,
-                                                'review_status'         : r_status.ix[ neuron.skeleton_id ].percent_reviewed
-                                            }
+            roots = extract_roots(skdata)
+            root_nodes.update(roots, { s : stamps[s][0] for s in roots if s in stamps })
+
+            #Free the raw tables before fetching the next chunk
+            del skdata, connectivity, annotations, r_status
 
-        return new_data, skdata
+        #Don't forget to update basic_values when editing database entries!
+        for s, v in new_data.items():
+            v.update( { 'last_update'           : str( date.today() ),
+                        'last_edited_by'        : 'unknown',
+                        'edit_stamp'            : stamps.get( s ) } )
+
+        return new_data
 
     def run(self):
         """
-        Structure of subscription database:
-
-        { 'users': {
-            'user_id'   : {
-
-                                    'subscriptions': [ neuronA, neuronB, neuronC ] ,
-                                    'daily_updates' : True/False,
-                                    'neurons'       : { skid: {
-                                                            'name' : str(),
-                                                            'branch_points'         : int(),
-                                                            'n_nodes'               : inte(),
-                                                            'pre_synapses'          : int(),
-                                                            'post_synapses'         : int(),
-                                                            'open_ends'             : int(),
-                                                            'upstream_partners'     : { skid: n_synapses },
-                                                            'downstream_partners'   : { skid: n_synapses },
-                                                            'last_update'           : timestamp_of_last_update,
-                                                            'last_edited_by'        : user_id,
-                                                            'annotations'           : list(),
-                                                            'review_status'         : int()
-                                                            }
-                                                        }
-            }
-        }
+        Subscriptions are stored in a SQLite database (see subscription_db.py):
+
+        users           : user_id, daily_updates
+        subscriptions   : user_id, skid
+        snapshots       : skid, last_update, data = {
+                                                'name' : str(),
+                                                'branch_points'         : int(),
+                                                'n_nodes'               : inte(),
+                                                'pre_synapses'          : int(),
+                                                'post_synapses'         : int(),
+                                                'open_ends'             : int(),
+                                                'partners'              : { 'upstream' : { 'ids': [ skid ], 'counts': [ n_synapses ] },
+                                                                            'downstream' : { 'ids': [ skid ], 'counts': [ n_synapses ] } },
+                                                'last_update'           : timestamp_of_last_update,
+                                                'last_edited_by'        : user_id,
+                                                'annotations'           : sorted list(),
+                                                'review_status'         : int(),
+                                                'edit_stamp'            : list()
+                                                }
+
+        Snapshots are shared by all users subscribed to a neuron. They are the
+        baseline for everyone's changes and only move on with the global
+        (daily) update.
         """
         basic_values = ['name','branch_points','n_nodes','pre_synapses','post_synapses','open_ends', 'review_status']
 
         logger.info('Started new thread %i for command <%s> by user <%s>' % (self.id, self.command, self.user ) )
 
         try:
-            data = shelve.open('subscriptiondb')
+            data = subscription_db( botconfig.SUBSCRIPTION_DB )
         except:
             if self.user != None:
                 self.slack_client.api_call("chat.postMessage", channel='@' + self.user,
                                       text='Unable to open subscription database!', as_user=True)
-            else:
-                logger.error('Unable to open subscription database.')
+            logger.error('Unable to open subscription database.', exc_info=True)
             return
 
-        skids = parse_neurons( self.raw_command )
-
-        #If db is fresh:
-        if len(data) == 0:
-            data['users'] = {}
+        skids = [ str(s) for s in parse_neurons( self.raw_command ) ]
 
         #If user not yet in database, add entry
-        if self.user not in data['users'] and self.user != None:
-            #Have to do this explicitedly - otherwise shelve won't update
-            users = data['users']
-            users[self.user] = {    'subscriptions' : [],
-                                    'daily_updates' : True,
-                                    'neurons': {} }
-            data['users'] = users
+        if self.user != None:
+            data.add_user( self.user )
 
         #Now execture user command
         if 'list' in self.command:
             #List current subscriptions
-            neuron_names = get_names(data['users'][self.user]['subscriptions'],
-                                     remote_instance=remote_instance)
+            subscriptions = data.subscriptions( self.user )
+            neuron_names = get_names(subscriptions, remote_instance=remote_instance)
             if neuron_names:
                 response = 'You are currently subscribed to the following neurons: \n'
-                response += '```' + tabulate( [ (neuron_names[str(s)], '#'+str(s) ) for s in data['users'][self.user]['subscriptions'] ] ) + '```'
+                response += '```' + tabulate( [ (neuron_names[str(s)], '#'+str(s) ) for s in subscriptions ] ) + '```'
             else:
                 response = 'Currently, I do not have any subscriptions for you!'
         if 'new' in self.command:
             #Add new subscriptions
             if skids:
-                new_data, skdata = self.process_neurons( [ str(s) for s in skids if s not in data['users'][self.user]['neurons'] ]  )
-
-                users = data['users']
-                users[self.user]['subscriptions'] += skids
-                users[self.user]['subscriptions'] = list ( set( users[self.user]['subscriptions'] ) )
-                data['users'] = users
+                #Only neurons nobody is subscribed to yet need a snapshot
+                known = data.get_snapshots( skids )
+                to_fetch = [ s for s in skids if s not in known ]
+                if to_fetch:
+                    new_data = self.process_neurons( to_fetch )
+                else:
+                    new_data = {}
 
-                old_data = data['users']
-                old_data[self.user]['neurons'].update( new_data )
-                data['users'] = old_data
+                data.subscribe( self.user, skids, snapshots=new_data )
 
                 response = 'Thanks! I have subscribed you to `' + ' #'.join( [ str(s )for s in skids ] ) + '`'
             else:
                 response = 'Please give me at least a single neuron to subscribe you to!'
         if 'auto' in self.command:
-            users = data['users']
             #Switch
-            users[self.user]['daily_updates'] = users[self.user]['daily_updates'] == False
-            data['users'] = users
-
-            if data['users'][self.user]['daily_updates'] is True:
+            if data.toggle_daily_updates( self.user ) is True:
                 response = 'Thanks! You will now automatically receive daily updates for your subscribed neurons.'
             else:
                 response = 'Thanks! You will no longer receive daily updates.'
@@ -234,178 +241,107 @@ class subscription_manager(threading.Thread):
         if 'delete' in self.command:
             #Delete subscriptions
             if skids:
+                removed = data.unsubscribe( self.user, skids )
                 response = 'Thanks! I succesfully unsubscribed you from neuron(s) ```'
-                for s in skids:
-                    try:
-                        users = data['users']
-                        users[self.user]['subscriptions'].remove( s )
-                        data['users'] = users
-                        response += +'#' + str(s) + ' '
-                    except:
-                        pass
+                response += ' '.join( [ '#' + s for s in removed ] )
                 response += '```'
             else:
                 response = 'Please provide me at least a single neuron to subscribe you to!'
 
         #IDEA: PRINT CHANGES (+100, -100) instead of new/old?
-        #ADD CHANGES IN ANNOTATIONS
         #MAKE SYNAPTIC PARTNERS CLICKY? like this: <http://www.zapier.com|Text to make into a link>
 
         if 'update' in self.command or self.global_update is True:
             logger.debug('Pushing updates')
             if self.global_update is True:
-                users_to_notify = [ u for u in data['users'] if data['users'][u]['daily_updates'] is True ]
+                users_to_notify = data.users( daily_updates=True )
                 logger.debug('Global update! ' + str(users_to_notify))
-                neurons_to_process = []
-                for u in data['users']:
-                    neurons_to_process += [ str(n) for n in data['users'][u]['neurons'] ]
+                neurons_to_process = data.subscriptions()
             else:
                 ts = self.slack_client.api_call("chat.postMessage", channel='@' + self.user,
-                                    text='Got it! Collecting intel - please wait...', as_user=True)['ts']
+                                    text='Got it! Collecting intel - please wait...', as_user=True).get('ts')
                 users_to_notify = [ self.user ]
-                neurons_to_process = [ str(s) for s in data['users'][self.user]['subscriptions'] ]
+                neurons_to_process = data.subscriptions( self.user )
+
+            #Each neuron is processed once no matter how many users follow it
+            neurons_to_process = list( set( neurons_to_process ) )
+            snapshots = data.get_snapshots( neurons_to_process )
+
+            #Ask for edit stamps in bulk first and only gather full data for
+            #neurons that have been edited since their snapshot
+            stamps = get_edit_stamps( neurons_to_process, remote_instance=remote_instance )
+            edited = edited_neurons( neurons_to_process, snapshots, stamps )
+            logger.info('%i of %i neurons edited since last update' % ( len(edited), len(neurons_to_process) ) )
 
             #Gather new data here - this costs time!
-            new_data,skdata = self.process_neurons ( neurons_to_process )
+            if edited:
+                new_data = self.process_neurons ( edited, stamps=stamps )
+            else:
+                new_data = {}
+            roots = root_nodes.get_roots(list(new_data),
+                                         remote_instance=remote_instance)
+
+            #Changes are the same for everyone following a neuron: diff each
+            #edited neuron once and look up names of all partners in one go
+            changes = { n : diff_neuron( snapshots[n], new_data[n], basic_values )
+                        for n in new_data if n in snapshots }
+            changes = { n : c for n, c in changes.items() if c }
+
+            partner_ids = set()
+            for c in changes.values():
+                partner_ids.update( c['partners'][0].tolist() )
+            if partner_ids:
+                partner_names = get_names( sorted( partner_ids ), remote_instance=remote_instance )
+            else:
+                partner_names = {}
+
+            reports = {}
+            for n, c in changes.items():
+                if n in roots:
+                    root = roots[n]
+                    url = url_to_coordinates((root['x'], root['y'], root['z']),
+                                             stack_id=5,
+                                             tool='tracingtool',
+                                             active_skeleton_id=n,
+                                             remote_instance=remote_instance,
+                                             active_node_id=root['root_id'])
+                    link = '<' + url + '|' + new_data[n]['name'] + '>'
+                else:
+                    link = new_data[n]['name']
+                reports[n] = '%s - #%s (changes since %s) \n```' % ( link , str(n), snapshots[n]['last_update'] )
+                reports[n] += format_changes( c, basic_values, partner_names ) + '```\n'
 
             for u in users_to_notify:
-                not_changed = []
-                response = ''
                 if not skids:
-                    neurons_to_update = [ str(s) for s in data['users'][u]['subscriptions'] ]
+                    neurons_to_update = data.subscriptions( u )
                 else:
-                    neurons_to_update = [ str(s) for s in skids ]
-
-                for n in neurons_to_update:
-                    n = str(n)
-
-                    #Changes are sorted into basic values and more complicated stuff (i.e. synaptic partners)
-                    changes = {
-                                'basic': {},
-                                'synaptic_partners': {},
-                                'new_annotations': [],
-                                'annotations': {    'new': [],
-                                                    'gone': []
-                                                    }
-                                }
-
-                    #Search for change in basic values
-                    for e in basic_values:
-                        #If value is new, skip it for now and just write it back
-                        if e not in data['users'][u]['neurons'][n]:
-                            continue
-
-                        if new_data[n][e] != data['users'][u]['neurons'][n][e]:
-                            changes['basic'][e] = [ new_data[n][e] , data['users'][u]['neurons'][n][e] ]
-
-                    #Search for changes in values that are lists (i.e. up- and downstream partners)
-                    for e in new_data[n]['synaptic_partners']:
-                        try:
-                            if new_data[n]['synaptic_partners'][e] != data['users'][u]['neurons'][n]['synaptic_partners'][e]:
-                                changes['synaptic_partners'][e] = [ new_data[n]['synaptic_partners'][e], data['users'][u]['neurons'][n]['synaptic_partners'][e] ]
-                        except:
-                            #When partner is entirely new
-                            changes['synaptic_partners'][e] = [ new_data[n]['synaptic_partners'][e], {'incoming':'-', 'outgoing': '- '} ]
+                    neurons_to_update = skids
 
-                    #Search for partners that have vanished
-                    for e in data['users'][u]['neurons'][n]['synaptic_partners']:
-                        try:
-                            if new_data[n]['synaptic_partners'][e] != data['users'][u]['neurons'][n]['synaptic_partners'][e]:
-                                changes['synaptic_partners'][e] = [ new_data[n]['synaptic_partners'][e], data['users'][u]['neurons'][n]['synaptic_partners'][e] ]
-                        except:
-                            changes['synaptic_partners'][e] = [ {'incoming':'-', 'outgoing': '- '} , data['users'][u]['neurons'][n]['synaptic_partners'][e] ]
-
-                    try:
-                        #Find new annotations
-                        for e in new_data[n]['annotations']:
-                            if e not in data['users'][u]['neurons'][n]['annotations']:
-                                changes['annotations']['new'].append(e)
-
-                        #Find annotations that have vanished:
-                        for e in data['users'][u]['neurons'][n]['annotations']:
-                            if e not in new_data[n]['annotations']:
-                                changes['annotations']['gone'].append(e)
-                    except:
-                        #E.g. if annotations have not yet been tracked in the old dataset
-                        pass
-
-                    #If changes have been found, generate response
-                    if changes['basic'] or changes['synaptic_partners'] or changes['annotations']['new'] or changes['annotations']['gone']:
-                        nodes = skdata.set_index('skeleton_id').ix[ str(n) ].nodes
-                        root_index = nodes [ nodes.type == 'root' ].index[0]
-                        root = nodes.ix[ root_index  ]
-
-                        #root = [nd for nd in skdata[ neurons_to_process.index(n) ][0] if nd[1] == None][0]
-
-                        url = url_to_coordinates((root.x, root.y, root.z),
-                                                 stack_id=5,
-                                                 tool='tracingtool',
-                                                 active_skeleton_id=n,
-                                                 remote_instance=remote_instance,
-                                                 active_node_id=root[0])
-                        link = '<' + url + '|' + new_data[n]['name'] + '>'
-                        response += '%s - #%s (changes since %s) \n```' % ( link , str(n), data['users'][u]['neurons'][n]['last_update'] )
-                    else:
-                        not_changed.append(n)
-
-                    #Basic values first
-                    if changes['basic']:
-                        if True in [ e in changes['basic'] for e in basic_values ]:
-                            table = [ [ 'Value', 'New', 'Old' ] ] + [ [ e, changes['basic'][e][0], changes['basic'][e][1] ] for e in basic_values if e in changes['basic'] ]
-                            response += tabulate(table) + '\n'
-                    if changes['annotations']['new']:
-                        response += 'New annotations: %s \n' % '; '.join(changes['annotations']['new'])
-                    if changes['annotations']['gone']:
-                        response += 'Deleted annotations: %s \n' % '; '.join(changes['annotations']['gone'])
-                    #Now connectivity
-                    if changes['synaptic_partners']:
-                        partner_names = get_names(list(changes['synaptic_partners'].keys()),
-                                                  remote_instance=remote_instance)
-
-                        #If partner does not exist anymore:
-                        partner_names.update( { e:'not found' for e in list( changes['synaptic_partners'].keys() ) if e not in partner_names } )
-
-                        response += 'Synaptic partners:\n'
-
-                        table = [ [ 'Name', 'SKID', 'Synapses from (new/old)', 'Synapses to (new/old)' ] ]
-                        table += [ [ partner_names[e], e, str(changes['synaptic_partners'][e][0]['incoming'])+'/'+str(changes['synaptic_partners'][e][1]['incoming']), str(changes['synaptic_partners'][e][0]['outgoing'])+'/'+str(changes['synaptic_partners'][e][1]['outgoing']),   ] for e in changes['synaptic_partners'] ]
-                        response += tabulate(table) + '\n'
-
-                    if changes['basic'] or changes['synaptic_partners'] or changes['annotations']['new'] or changes['annotations']['gone']:
-                        response += '```\n'
+                response = ''.join( [ reports[n] for n in neurons_to_update if n in reports ] )
+                not_changed = [ n for n in neurons_to_update if n not in reports ]
 
+                #Reports are queued - the delivery client spaces them out
                 if response:
-                    self.slack_client.api_call("chat.postMessage", channel='@' + u,
-                                      text= response  , as_user=True)
+                    self.slack_client.post('@' + u, response)
                     if not_changed:
-                        self.slack_client.api_call("chat.postMessage", channel='@' + u,
-                                      text= 'No changes for neurons `' + ', '.join(not_changed) + '`', as_user=True)
+                        self.slack_client.post('@' + u, 'No changes for neurons `' + ', '.join(not_changed) + '`')
                     #Reset response
                     response = ''
                 else:
                     logger.debug( 'No changes for user ' + u )
-                    self.slack_client.api_call("chat.postMessage", channel= '@' + u,
-                                      text='None of the neurons you are subscribed to have changed recently!', as_user=True)
+                    self.slack_client.post('@' + u, 'None of the neurons you are subscribed to have changed recently!')
 
-            #Write back changes to DB
-            users = data['users']
-            users[u]['neurons'].update(new_data)
-            data['users'] = users
-        try:
-            data.close()
-            logger.debug('Database update successful')
-            if self.user != None:
-                self.slack_client.api_call("chat.postMessage", channel='@' + self.user,
-                                          text=response, as_user=True)
-            else:
-                logger.debug('User is None: ' + response)
-        except:
-            logger.error('Failed to update database')
-            if self.user != None:
-                self.slack_client.api_call("chat.postMessage", channel='@' + self.user,
-                                          text='Oops! Something went wrong. If you made any changes to your subscriptions, please try again.', as_user=True)
-            else:
-                logger.debug('User is None: ' + response)
+            #Write back changes to DB - the baseline only moves on with the
+            #global update so that nobody misses changes
+            if self.global_update is True:
+                data.put_snapshots( new_data, prune=True )
+
+        logger.debug('Database update successful')
+        if self.user != None:
+            self.slack_client.api_call("chat.postMessage", channel='@' + self.user,
+                                      text=response, as_user=True)
+        else:
+            logger.debug('User is None: ' + response)
         return
 
 
@@ -444,17 +380,15 @@ class return_review_status(threading.Thread):
                                         channel=self.channel,
                                         text='Got it! Collecting intel - '
                                              'please wait...',
-                                        as_user=True)['ts']
+                                        as_user=True).get('ts')
 
-        for s in skids:
-            if not neuron_exists(s, remote_instance=remote_instance):
-                response = "I'm sorry - the neuron #%s does not seem to " \
-                           "exists. Please try again." % s
-                self.slack_client.api_call("chat.postMessage",
-                                           channel=self.channel,
-                                           text=response,
-                                           as_user=True)
-                return
+        missing = missing_neurons(skids)
+        if missing:
+            self.slack_client.api_call("chat.postMessage",
+                                       channel=self.channel,
+                                       text=missing_message(missing),
+                                       as_user=True)
+            return
 
         if not skids:
             response = 'Please provide neurons as *#skid*, *annotation=" "* ' \
@@ -464,9 +398,11 @@ class return_review_status(threading.Thread):
             r_status = get_review(skids, remote_instance=remote_instance)
             response = "This is the current review status:\n ```{}``` ".format(r_status.to_string())
 
-        self.slack_client.api_call("chat.delete",
-                                   channel = self.channel,
-                                   ts = ts)
+        #The delivery client returns an error instead of raising
+        if ts:
+            self.slack_client.api_call("chat.delete",
+                                       channel = self.channel,
+                                       ts = ts)
 
         if response:
             self.slack_client.api_call("chat.postMessage",
@@ -513,20 +449,19 @@ class return_plot_neuron(threading.Thread):
                        'or *name=" "*! For example: _@catbot plot-neuron ' \
                        '#957684_'
         else:
-            for s in skids:
-                if not neuron_exists(s, remote_instance=remote_instance):
-                    response = "I'm sorry - the neuron #%s does not seem to " \
-                               "exists. Please try again." % s
-                    self.slack_client.api_call("chat.postMessage",
-                                               channel=self.channel,
-                                               text=response, as_user=True)
-                    return
+            missing = missing_neurons(skids)
+            if missing:
+                self.slack_client.api_call("chat.postMessage",
+                                           channel=self.channel,
+                                           text=missing_message(missing),
+                                           as_user=True)
+                return
 
             ts = self.slack_client.api_call("chat.postMessage",
                                             channel=self.channel,
                                             text='Got it! Generating plot - '
                                                  'please wait...',
-                                            as_user=True)['ts']
+                                            as_user=True).get('ts')
 
             # Get all volumes
             vlist = pymaid.get_volume(remote_instance=remote_instance)
@@ -552,10 +487,11 @@ class return_plot_neuron(threading.Thread):
                                  method='3d_complex',
                                  remote_instance=remote_instance)
             except Exception as e:
-                self.slack_client.api_call("chat.delete",
-                                           channel = self.channel,
-                                           ts = ts
-                                           )
+                if ts:
+                    self.slack_client.api_call("chat.delete",
+                                               channel = self.channel,
+                                               ts = ts
+                                               )
                 logger.error('Error in plotneuron()', exc_info = True)
                 self.slack_client.api_call("chat.postMessage",
                                            channel=self.channel,
@@ -578,9 +514,10 @@ class return_plot_neuron(threading.Thread):
                         transparent=False, dpi=300)
 
             #Delete stand-by message
-            self.slack_client.api_call("chat.delete",
-                                       channel=self.channel,
-                                       ts=ts)
+            if ts:
+                self.slack_client.api_call("chat.delete",
+                                           channel=self.channel,
+                                           ts=ts)
 
             #Upload neuron plot
             with open('renderings/neuron_plot.png', 'rb') as f:
@@ -632,14 +569,13 @@ class return_connectivity(threading.Thread):
         logger.debug('Started new thread %i for command <%s>' % (self.id,
                                                                  self.command))
 
-        for s in skids:
-            if not neuron_exists(s, remote_instance=remote_instance):
-                response = "I'm sorry - the neuron #%s does not seem to " \
-                           "exists. Please try again." % s
-                self.slack_client.api_call("chat.postMessage",
-                                           channel=self.channel,
-                                           text=response, as_user=True)
-                return
+        missing = missing_neurons(skids)
+        if missing:
+            self.slack_client.api_call("chat.postMessage",
+                                       channel=self.channel,
+                                       text=missing_message(missing),
+                                       as_user=True)
+            return
 
         self.command = self.command.replace('”','"')
 
@@ -729,37 +665,32 @@ class return_url(threading.Thread):
         logger.debug('Started new thread %i for command <%s>' % (self.id,
                                                                  self.command))
 
-        for s in skids:
-            if not neuron_exists(s, remote_instance=remote_instance):
-                response = "I'm sorry - the neuron #%s does not seem to " \
-                           "exists. Please try again." % s
-                self.slack_client.api_call("chat.postMessage",
-                                           channel=self.channel,
-                                           text=response,
-                                           as_user=True)
-                return
+        missing = missing_neurons(skids)
+        if missing:
+            self.slack_client.api_call("chat.postMessage",
+                                       channel=self.channel,
+                                       text=missing_message(missing),
+                                       as_user=True)
+            return
 
         if not skids:
             response = 'Please provide neurons as `#skid`, `annotation=" "` ' \
                        'or `name=" "`! For example: `@catbot plot-neuron #957684`'
         else:
             response = 'Here are URLs to the neurons you have provided!'
-            skdata = get_neuron(skids, remote_instance=remote_instance,
-                                connector_flag=0, tag_flag=0,
-                                get_history=False)
-
-            skdata = pymaid.CatmaidNeuronList(skdata)
+            roots = root_nodes.get_roots(skids, remote_instance=remote_instance)
 
-            for neuron in skdata:
-                root = neuron.nodes[neuron.nodes.type=='root']
-                url = url_to_coordinates(root,
+            for s in skids:
+                root = roots.get(str(s))
+                if root is None:
+                    continue
+                url = url_to_coordinates((root['x'], root['y'], root['z']),
                                          stack_id=5,
                                          tool='tracingtool',
-                                         active_skeleton_id=neuron.skeleton_id,
-                                         active_node_id=root.treenode_id.values,
+                                         active_skeleton_id=s,
+                                         active_node_id=root['root_id'],
                                          remote_instance=remote_instance)
-                for u in url:
-                    response += '\n *#%s*: %s' % (neuron.skeleton_id, u)
+                response += '\n *#%s*: %s' % (s, url)
 
         if response:
             self.slack_client.api_call("chat.postMessage",
@@ -807,21 +738,18 @@ class return_zotero(threading.Thread):
         if '' in tags:
             tags.remove('')
 
-        ts = self.slack_client.api_call("chat.postMessage",
-                                        channel=self.channel,
-                                        text='Searching Zotero database. '
-                                             'Please hold...',
-                                        as_user=True)['ts']
-
-        #Retrieve all items in library
-        items = zot.everything ( zot.items() )
-        pdf_files = [ i for i in items if i['data']['itemType'] == 'attachment' and i['data']['title'] == 'Full Text PDF' ]
-        logger.debug('Searching %i Zotero items for:' % len(items))
-        logger.debug(tags)
-
-        self.slack_client.api_call("chat.delete",
-                                   channel=self.channel,
-                                   ts=ts)
+        #Fetch items changed since the last sync into the local index
+        try:
+            zotero_items.sync()
+        except Exception:
+            logger.warning('Zotero sync failed - searching local index',
+                           exc_info=True)
+        logger.debug('Searching Zotero index for: %s' % str(tags))
+
+        if 'fulltext' in tags:
+            tags.remove('fulltext')
+            self.search_fulltext(tags)
+            return
 
         if 'file' in tags:
             dl_file = True
@@ -835,17 +763,18 @@ class return_zotero(threading.Thread):
                                                 'file <ZOTERO-ID>`',
                                            as_user=True)
             elif len(tags) == 1:
-                this_item = [f for f in pdf_files if f['data']['parentItem'].lower() == tags[0]]
+                this_item = zotero_items.get_pdf( tags[0] )
 
                 if this_item:
-                    filename = this_item[0]['data']['filename']
-                    zot.dump( this_item[0]['key'] , filename )
-                    with open( filename , 'rb') as f:
-                        self.slack_client.api_call("files.upload",
-                                                   channels=self.channel,
-                                                   file = f,
-                                                   title = filename,
-                                                   initial_comment = '')
+                    #Upload straight from the attachment cache - the file is
+                    #pinned until the queued upload has gone out
+                    filename = this_item['filename']
+                    path = zotero_files.get( this_item, pin = True )
+                    self.slack_client.upload(self.channel, path,
+                                             filename = filename,
+                                             title = filename,
+                                             initial_comment = '')
+                    self.slack_client.after_sent(lambda: zotero_files.unpin( path ))
                     return
                 else:
                     self.slack_client.api_call("chat.postMessage",
@@ -859,34 +788,7 @@ class return_zotero(threading.Thread):
         else:
             dl_file = False
 
-        results = []
-
-        for e in items:
-            include = []
-            for t in tags:
-                this_tag = False
-                #Try/Except is important because some entries aren't articles
-                try:
-                    if t in e['data']['date']:
-                        this_tag = True
-                        logger.debug('Found tag %s in %s' % ( t, e['data']['date'] ) )
-                    elif t.lower() in [ a['lastName'].lower() for a in e['data']['creators']]:
-                        this_tag = True
-                        logger.debug('Found tag %s in %s' % ( t, str([ a['lastName'].lower() for a in e['data']['creators']]) ) )
-                    elif t.lower() in e['data']['title'].lower():
-                        this_tag = True
-                        logger.debug('Found tag %s in %s' % ( t, e['data']['title'].lower() ) )
-                    elif True in [ t.lower() in a['tag'].lower() for a in e['data']['tags'] ]:
-                        this_tag = True
-                        logger.debug('Found tag %s in %s (%s)' % ( t, [ a['tag'].lower() for a in e['data']['tags'] ], [ t.lower() in a['tag'].lower() for a in e['data']['tags'] ] ) )
-                except:
-                    pass
-
-                include.append( this_tag )
-
-            if False not in include:
-                logger.debug( str(tags) + str(include) + e['data']['date'] )
-                results.append( e )
+        results = [ { 'key' : d['key'], 'data' : d } for d in zotero_items.search( tags ) ]
 
         if results:
             response = 'Here are the publications matching your criteria:\n```'
@@ -897,18 +799,19 @@ class return_zotero(threading.Thread):
                 except:
                     doi_url = ''
 
-                authors = [ a['lastName'] for a in e['data']['creators'] ]
-                date = e['data']['date']
-                journal = e['data']['journalAbbreviation']
-                title = e['data']['title']
+                #Not every item type has all fields (e.g. books)
+                authors = [ a.get('lastName', a.get('name', '')) for a in e['data'].get('creators', []) ]
+                date = e['data'].get('date', '')
+                journal = e['data'].get('journalAbbreviation', '')
+                title = e['data'].get('title', '')
                 zot_key = e['key']
 
 
-                if len(e['data']['creators']) > 2:
+                if len(authors) > 2:
                     response += '%s et al., %s (%s): %s %s (%s)\n\n' % ( authors[0], journal, date, title , doi_url, zot_key  )
-                elif len(e['data']['creators']) == 2:
+                elif len(authors) == 2:
                     response += '%s and %s, %s (%s): %s %s (%s)\n\n' % ( authors[0], authors[1] , journal, date, title , doi_url, zot_key   )
-                elif len(e['data']['creators']) == 1:
+                elif len(authors) == 1:
                     response += '%s, %s (%s): %s %s (%s)\n\n' % ( authors[0], journal, date, title , doi_url, zot_key  )
             response += '```\n'
             response += 'Use `@catbot zotero file <ZOTERO-ID>` if you want ' \
@@ -923,6 +826,40 @@ class return_zotero(threading.Thread):
 
         return
 
+    def search_fulltext(self, terms):
+        """ Searches the (pre-extracted) text of our PDFs and posts the best
+        matches with a snippet each.
+        """
+        if not terms:
+            self.slack_client.post(self.channel,
+                                   'Please give me something to search for: '
+                                   '`@catbot zotero fulltext TERM1 TERM2`')
+            return
+
+        results = zotero_items.search_fulltext( terms, limit = 10 )
+
+        if results:
+            response = 'Here are the PDFs mentioning your search terms (best ' \
+                       'matches first):\n```'
+            for data, snippet in results:
+                authors = [ a.get('lastName', a.get('name', '')) for a in data.get('creators', []) ]
+                if len(authors) > 2:
+                    authors = authors[0] + ' et al.'
+                else:
+                    authors = ' and '.join(authors)
+                response += '%s (%s): %s (%s)\n> %s\n\n' % ( authors,
+                                                              data.get('date', ''),
+                                                              data.get('title', ''),
+                                                              data['key'],
+                                                              snippet )
+            response += '```\n'
+            response += 'Use `@catbot zotero file <ZOTERO-ID>` if you want ' \
+                        'me to grab you the PDF!'
+        else:
+            response = 'Sorry, none of our PDFs mention all of these terms!'
+
+        self.slack_client.post(self.channel, response)
+
 
 class return_help(threading.Thread):
     """ Class to process incoming help request
@@ -965,6 +902,10 @@ class return_help(threading.Thread):
             response += '4. Use `nblast-fafb <neuron> cores=N` to set the number of CPU cores used to nblast. Default is 8\n'
             response += '5. Use `nblast-fafb <neuron> prefermu` to sort hits by reverse score (muscore) rather than forward score\n'
             response += '6. Use `nblast-fafb <neuron> usealpha` to make nblast value backbones higher than smaller neurites\n'
+            response += '7. Use `nblast-fafb <neuron> prefilter=N` to skip neurons that have no point within N microns of your neuron (smaller = faster but riskier). Use `noprefilter` to score all neurons\n'
+            response += '8. Use `nblast-fafb <neuron> showpruned` to report how many neurons were skipped by the prefilter\n'
+            response += '9. Use `nblast-fafb <neuron> revdepth=N` to calculate reverse and mean scores for the top N forward hits. Use `revdepth=all` to score all neurons. Default is %s\n' % botconfig.NBLAST_REVERSE_DEPTH
+            response += '10. Pass several neurons (e.g. `nblast-fafb annotation="DA1"`) to blast them as one batch and get a single table. Use `top=N` to set the number of hits per neuron. Default is 10\n'
         elif 'nblast' in self.command:
             response = '`nblast` blasts the provided neuron against the flycircuit database. Use combinations of the following optional arguments to refine: \n'
             response += '1. Use `nblast <neuron> nomirror` to prevent mirroring of neurons before nblasting (i.e. if cellbody is already on the flys left). \n'
@@ -973,6 +914,7 @@ class return_help(threading.Thread):
             response += '4. Use `nblast <neuron> cores=N` to set the number of CPU cores used to nblast. Default is 8\n'
             response += '5. Use `nblast <neuron> prefermu` to sort hits by reverse score (muscore) rather than forward score\n'
             response += '6. Use `nblast <neuron> usealpha` to make nblast value backbones higher than smaller neurites\n'
+            response += '7. Pass several neurons (e.g. `nblast annotation="DA1"`) to blast them as one batch and get a single table. Use `top=N` to set the number of hits per neuron. Default is 10\n'
         elif 'neurondb' in self.command:
             response = '`neurondb` lets you access and edit the neuron database. \n'
             response += 'I am using skeleton IDs as unique identifiers -> you can search for names/annotations/etc but I need a SKID when you want to add/edit an entry! \n'
@@ -1002,10 +944,11 @@ class return_help(threading.Thread):
                         '`review-status <neurons>` : give me a list of neurons and I will tell you their review status.',
                         '`plot <neurons>` : give me a list of neurons to plot. Use `@catbot help plot` to learn about how to show neuropils.',
                         '`url <neurons>` : give me a list of neurons and I will generate urls to their root nodes.',
-                        '`nblast <neuron>` : give me a *single* neuron and let me run an nblast search. Use `@catbot help nblast` to learn more.',
-                        '`nblast-fafb <neuron>` : `nblast` against a nightly dump of (simplified) CATMAID neurons. Use `@catbot help nblast-fafb` to learn more.',
+                        '`nblast <neurons>` : give me one or more neurons and let me run an nblast search. Use `@catbot help nblast` to learn more.',
+                        '`nblast-fafb <neurons>` : `nblast` against a nightly dump of (simplified) CATMAID neurons. Use `@catbot help nblast-fafb` to learn more.',
                         '`zotero TAG1 TAG2 TAG3` : give me tags and I will search our Zotero group for you',
                         '`zotero file ZOTERO-ID` : give me a Zotero ID and I will download the PDF for you',
+                        '`zotero fulltext TERM1 TERM2` : I will search the text of the PDFs in our Zotero group',
                         '`partners <neurons>` : returns synaptic partners. Use `@catbot help partners` to learn more.',
                         '`help` : You have just used that, dummy...'
                         ]
@@ -1109,10 +1052,11 @@ class neurondb_manager(threading.Thread):
                         'type', 'neuropils', 'status', 'tags', 'last_edited',
                         'comments']
 
-        skids = parse_neurons( self.raw_command )
+        #Shelve keys are strings
+        skids = [ str(s) for s in parse_neurons( self.raw_command ) ]
 
         if skids:
-            self.neuron_names = get_names( skids, remote_instance )
+            self.neuron_names = get_names( skids, remote_instance=remote_instance )
 
         try:
             data = shelve.open('neurondb')
@@ -1123,6 +1067,9 @@ class neurondb_manager(threading.Thread):
                                        as_user=True)
             return
 
+        if not neuron_index.built:
+            neuron_index.build(data)
+
         if 'list' in self.command.lower():
             response = 'I have these neurons in my database:\n'
             response += '```' + tabulate( [ ['*Name*','*Skid*' ] ] + [ [ data[k]['name'], k ] for k in data.keys() ] ) + '```'
@@ -1142,25 +1089,13 @@ class neurondb_manager(threading.Thread):
         elif 'search' in self.command.lower():
             #First extract tags to search for
             search = self.command.lower().replace('neurondb', '')
-            tags = search.split(' ')
-            if '' in tags:
-                tags.remove('')
-
-            hits = set()
-            for n in data.keys():
-                for t in tags:
-                    if [ t in data[n][entry].lower() for entry in data[n] if type( data[n][entry] ) != type ( list() ) ]:
-                        hits.add(n)
-                        break
-                    else:
-                        for entry in [ e for e in data[n] if type( data[n][entry] != type ( list() ) ) ]:
-                            if [ t in data[n][entry][e].lower() for e in data[n][entry] ]:
-                                hits.add(n)
-                                break
+            tags = [ t for t in search.split(' ') if t and t != 'search' ]
+
+            hits = neuron_index.search( tags )
 
             if hits:
                 response = 'I found the following match(es):\n'
-                response += '```' + tabulate([['*Name*', '*Skid*']] + [[ data[n]['name'], n] for n in hits ] ) +'```'
+                response += '```' + tabulate([['*Name*', '*Skid*']] + [[ data[n]['name'], n] for n in sorted(hits) ] ) +'```'
             else:
                 response = 'Sorry, could not find anything matching your query!'
 
@@ -1198,6 +1133,7 @@ class neurondb_manager(threading.Thread):
                                                    as_user=True)
 
                 data[ skids[0] ] = self.edit_entry( data[ skids[0] ] )
+                neuron_index.update( skids[0], data[ skids[0] ] )
                 response = 'Updated entry for neuron %s #%s!' % ( data[ skids[0] ]['name'], skids[0] )
         elif 'delete' in self.command.lower():
             if len(skids) != 1:
@@ -1207,6 +1143,7 @@ class neurondb_manager(threading.Thread):
                 response = 'Could not find neuron #%s in my database.' % (skids[0])
             else:
                 data[ skids[0] ] = self.delete_value( data[ skids[0] ] )
+                neuron_index.update( skids[0], data[ skids[0] ] )
                 response = 'Updated entry for neuron %s #%s!' % (data[skids[0]]['name'],
                                                                  skids[0])
 
@@ -1266,22 +1203,47 @@ def time2hh():
 def parse_slack_output(slack_rtm_output, user_list):
     """
         The Slack Real Time Messaging API is an events firehose.
-        this parsing function returns None unless a message is
-        directed at the Bot, based on its ID.
+        this parsing function returns a list of (command, channel, user)
+        for every message in the batch that is directed at the Bot, based
+        on its ID.
     """
+    commands = []
     output_list = slack_rtm_output
     if output_list and len(output_list) > 0:
         for output in output_list:
-            if output and 'text' in output and botconfig.AT_BOT in output['text']:
+            #Bot and system messages have no user
+            if output and 'text' in output and 'user' in output \
+               and botconfig.AT_BOT in output['text']:
                 # return text after the @ mention, whitespace removed
+                #(looks up users that joined after start-up)
                 user = user_list[output['user']]
                 logger.debug('Message from %s (%s): %s' % (user,
                                                            output['user'],
                                                            output['text']))
-                return output['text'].split(botconfig.AT_BOT)[1].strip(), \
-                       output['channel'], \
-                       user
-    return None, None, None
+                commands.append((output['text'].split(botconfig.AT_BOT)[1].strip(),
+                                 output.get('channel'),
+                                 user))
+    return commands
+
+
+def wait_for_slack(slack_client, timeout):
+    """ Blocks until there is data on the RTM websocket or timeout (seconds)
+    has passed.
+    """
+    try:
+        sock = slack_client.server.websocket.sock
+    except AttributeError:
+        sock = None
+
+    if not sock:
+        time.sleep(timeout)
+        return
+
+    #SSL may already have decrypted data buffered that select can't see
+    if hasattr(sock, 'pending') and sock.pending():
+        return
+
+    select.select([sock], [], [], timeout)
 
 
 def parse_neurons(command):
@@ -1309,6 +1271,35 @@ def parse_neurons(command):
     return list(set([int(n) for n in skids]))
 
 
+def missing_neurons(skids):
+    """ Returns those skeleton IDs that do not exist in CATMAID. Instead of
+    one request per neuron, names are fetched in bulk (a neuron without a
+    name does not exist) in chunks of VALIDATION_CHUNK_SIZE that are run in
+    parallel.
+    """
+    skids = list(OrderedDict.fromkeys([str(s) for s in skids]))
+    chunks = [skids[i:i + VALIDATION_CHUNK_SIZE]
+              for i in range(0, len(skids), VALIDATION_CHUNK_SIZE)]
+
+    names = {}
+    if len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(chunks), 4)) as ex:
+            for n in ex.map(lambda c: get_names(c,
+                                                remote_instance=remote_instance),
+                            chunks):
+                names.update(n)
+    elif chunks:
+        names = get_names(chunks[0], remote_instance=remote_instance)
+
+    return [s for s in skids if s not in names]
+
+
+def missing_message(missing):
+    """ Returns a response listing all missing neurons. """
+    return "I'm sorry - the neuron(s) #%s do not seem to exist. Please " \
+           "try again." % ' #'.join([str(s) for s in missing])
+
+
 class user_list:
     """ Works like a dictionary mapping user ID to user name. Will update
     itself when ID for user is unknown (i.e. a new user was added on Slack).
@@ -1373,7 +1364,12 @@ if __name__ == '__main__':
                      ' have this configuration file correctly set up!')
         sys.exit()
 
-    #Initialize CATMAID instance (without caching)
+    #Configure cache for CATMAID lookups
+    lookup_cache.max_entries = botconfig.CATMAID_CACHE_SIZE
+    lookup_cache.ttls.update(botconfig.CATMAID_CACHE_TTLS)
+    root_nodes.path = botconfig.ROOT_INDEX
+
+    #Initialize CATMAID instance (without caching - see catmaid_cache.py)
     remote_instance = CatmaidInstance(botconfig.SERVER_URL,
                                       botconfig.HTTP_USER,
                                       botconfig.HTTP_PW,
@@ -1385,52 +1381,91 @@ if __name__ == '__main__':
     pymaid.set_pbars(hide=True)
     pymaid.set_loggers('ERROR')
 
-    #Inintialize slack client
-    slack_client = SlackClient(botconfig.SLACK_KEY)
+    #Inintialize slack clients: slackclient for events (RTM), everything
+    #else goes through the rate-limit aware delivery client
+    rtm_client = SlackClient(botconfig.SLACK_KEY)
+    slack_client = delivery_client(botconfig.SLACK_KEY)
+    slack_client.start()
 
     if botconfig.ZOT_KEY:
         # Zotero( group_id, library_type, API_key )
         zot = zotero.Zotero(botconfig.ZOT_GRP_ID, 'group', botconfig.ZOT_KEY)
+        #Local copy of the library for searches (synced incrementally)
+        zotero_items = zotero_index(zot, botconfig.ZOTERO_INDEX)
+        #PDFs are downloaded once and then served from the cache
+        zotero_files = attachment_cache(zot, botconfig.ZOTERO_CACHE,
+                                        max_size=botconfig.ZOTERO_CACHE_SIZE,
+                                        on_download=zotero_items.queue_extraction)
+        #Index text of PDFs cached before (in the background)
+        for key, path in zotero_files.files().items():
+            zotero_items.queue_extraction(key, path)
     else:
         zot = None
 
-    open_threads = []
-    open_processes = []
-    previous_open_threads = 0
-    command = channel = None
+    previous_open_requests = 0
+    commands = deque()
     last_global_update = date.today()
 
+    #Commands are queued and processed by a fixed number of workers
+    dispatcher = command_dispatcher(slack_client,
+                                    workers=botconfig.MAX_PARALLEL_REQUESTS,
+                                    max_queue=botconfig.MAX_QUEUED_REQUESTS)
+    dispatcher.start()
+
+    #Start NBLAST workers - this loads R and the databases only once
+    nblast_workers = nblast_pool(n_workers=botconfig.NBLAST_WORKERS,
+                                 core_budget=botconfig.NBLAST_CORE_BUDGET)
+    nblast_workers.start()
+
+    #Cache for NBLAST results
+    if botconfig.NBLAST_CACHE:
+        nblast_results = result_cache(botconfig.NBLAST_CACHE,
+                                      max_size=botconfig.NBLAST_CACHE_SIZE)
+    else:
+        nblast_results = None
+
     user_list = user_list(slack_client)
     logger.debug('Users: ' + ', '.join(list(user_list.values())))
 
-    if slack_client.rtm_connect():
+    if rtm_client.rtm_connect():
         logger.info("Pybot connected and running!")
         while True:
             try:
-                command, channel, user = parse_slack_output(slack_client.rtm_read(),
-                                                            user_list)
+                #Wait for events but check on running jobs at least every
+                #READ_WEBSOCKET_DELAY seconds
+                wait_for_slack(rtm_client, botconfig.READ_WEBSOCKET_DELAY)
+                commands.extend(parse_slack_output(rtm_client.rtm_read(),
+                                                   user_list))
             except WebSocketConnectionClosedException as e:
                 logger.error('Caught websocket disconnect, reconnecting...',
                              exc_info = True)
                 time.sleep(botconfig.READ_WEBSOCKET_DELAY)
 
-                if slack_client.rtm_connect():
+                if rtm_client.rtm_connect():
                     logger.error('Reconnect successful!')
                 else:
                     logger.error('Reconnect failed!')
 
             except Exception as e:
-                logger.error('Error parsing slack output: ' + e, exc_info=True)
+                logger.error('Error parsing slack output: ' + str(e),
+                             exc_info=True)
 
             #On midnight, trigger global update
             if date.today() != last_global_update:
                 last_global_update = date.today()
-                t = subscription_manager(slack_client, '', None, None,
-                                         global_update = True )
-                t.start()
-                open_threads.append( t )
+                logger.info('CATMAID lookup cache: %i entries; hits/misses: %s' % (len(lookup_cache),
+                            ', '.join(['%s %i/%i' % (k, v['hits'], v['misses'])
+                                       for k, v in lookup_cache.stats().items()])))
+                dispatcher.submit(subscription_manager(slack_client, '', None,
+                                                       None,
+                                                       global_update = True))
+
+            #Dispatch every command of this batch
+            while commands:
+                command, channel, user = commands.popleft()
+                if not command or not channel or user == botconfig.BOT_NAME:
+                    continue
 
-            if command and channel and user != botconfig.BOT_NAME:
                 #Replace odd ” with "
                 command = command.replace( '”' , '"' )
 
@@ -1438,197 +1473,267 @@ if __name__ == '__main__':
                                                                   channel,
                                                                   command))
 
-                #Only process if not at max open threads
-                if len(open_threads)+len(open_processes) <= botconfig.MAX_PARALLEL_REQUESTS:
-                        t = None
-                        if 'help' in command.lower():
-                            t = return_help(slack_client, command, channel)
-                        elif 'review-status' in command.lower():
-                            t = return_review_status(slack_client, command,
-                                                     channel)
-                        elif 'plot' in command.lower():
-                            try:
-                                t = return_plot_neuron(slack_client, command,
-                                                       channel)
-                            except Exception as e:
-                                logger.error("Error while plotting: " + e,
-                                             exc_info=True )
-                                slack_client.api_call("chat.postMessage",
-                                                      channel=channel,
-                                                      text='Ooops, something '
-                                                           'went wrong... '
-                                                           'please try again '
-                                                           'or contact an '
-                                                           'admin.',
-                                                      as_user=True)
-                        elif 'url' in command.lower():
-                            t = return_url(slack_client, command, channel)
-                        elif 'partners' in command.lower():
-                            t = return_connectivity(slack_client, command,
-                                                    channel)
-                        elif 'neurondb' in command.lower():
-                            try:
-                                t = neurondb_manager(slack_client, command,
-                                                     channel, user)
-                            except Exception as e:
-                                logger.error("Error while database "
-                                             "operation: " + e, exc_info=True)
-                                slack_client.api_call("chat.postMessage",
-                                                      channel=channel,
-                                                      text='Ooops, something '
-                                                           'went wrong... '
-                                                           'please try again '
-                                                           'or contact an '
-                                                           'admin.',
-                                                      as_user=True)
-                        elif 'subscription' in command.lower():
+                t = None
+                if 'help' in command.lower():
+                    t = return_help(slack_client, command, channel)
+                elif 'review-status' in command.lower():
+                    t = return_review_status(slack_client, command,
+                                             channel)
+                elif 'plot' in command.lower():
+                    try:
+                        t = return_plot_neuron(slack_client, command,
+                                               channel)
+                    except Exception as e:
+                        logger.error("Error while plotting: " + e,
+                                     exc_info=True )
+                        slack_client.post(channel=channel,
+                                          text='Ooops, something '
+                                               'went wrong... '
+                                               'please try again '
+                                               'or contact an '
+                                               'admin.',
+                                          as_user=True)
+                elif 'url' in command.lower():
+                    t = return_url(slack_client, command, channel)
+                elif 'partners' in command.lower():
+                    t = return_connectivity(slack_client, command,
+                                            channel)
+                elif 'neurondb' in command.lower():
+                    try:
+                        t = neurondb_manager(slack_client, command,
+                                             channel, user)
+                    except Exception as e:
+                        logger.error("Error while database "
+                                     "operation: " + e, exc_info=True)
+                        slack_client.post(channel=channel,
+                                          text='Ooops, something '
+                                               'went wrong... '
+                                               'please try again '
+                                               'or contact an '
+                                               'admin.',
+                                          as_user=True)
+                elif 'subscription' in command.lower():
+                    try:
+                        t = subscription_manager(slack_client, command,
+                                                 channel, user)
+                    except Exception as e:
+                        logger.error("Error while processing "
+                                     "subscription: " + e,
+                                     exc_info=True )
+                        slack_client.post(channel=channel,
+                                          text='Ooops, something '
+                                               'went wrong... '
+                                               'please try again '
+                                               'or contact an '
+                                               'admin.',
+                                          as_user=True)
+                elif 'nblast' in command.lower():
+                    # For some odd reason, threading does not prevent
+                    # freezing while waiting R code to return nblast
+                    # results.
+                    # Therefore nblasting is handed to a pool of
+                    # worker processes that keep R and the databases
+                    # loaded between jobs (see nblast_pool.py)
+
+                    skids = [str(s) for s in parse_neurons( command )]
+                    missing = missing_neurons(skids)
+
+                    if skids and not missing:
+                        prefermu = 'prefermu' in command
+                        alpha = 'alpha' in command
+
+                        try:
+                            hits = int(re.search('hits=(\d+)',
+                                                 command).group(1))
+                        except:
+                            hits = 3
+
+                        # Number of top forward hits that get a
+                        # reverse score (nblast-fafb only)
+                        try:
+                            reverse_depth = re.search('revdepth=(\d+|all)',
+                                                      command).group(1)
+                            reverse_depth = None if reverse_depth == 'all' else int(reverse_depth)
+                        except:
+                            reverse_depth = botconfig.NBLAST_REVERSE_DEPTH
+
+                        # Hits per query neuron in batch tables
+                        try:
+                            top_n = int(re.search('top=(\d+)',
+                                                  command).group(1))
+                        except:
+                            top_n = 10
+
+                        try:
+                            cores = int(re.search('cores=(\d+)',
+                                                 command).group(1))
+                        except:
+                            cores = 8
+
+                        # Spatial prefilter (nblast-fafb only)
+                        try:
+                            prefilter = int(re.search('prefilter=(\d+)',
+                                                      command).group(1))
+                        except:
+                            prefilter = botconfig.NBLAST_PREFILTER
+                        if 'noprefilter' in command:
+                            prefilter = None
+
+                        if 'fafb' in command.lower():
+                            db = 'fafb'
+                            mirror = 'mirror' in command
+                        elif 'gmrdb' in command:
+                            db = 'gmr'
+                            mirror = not 'nomirror' in command
+                        else:
+                            db = 'fc'
+                            mirror = not 'nomirror' in command
+
+                        if len(skids) == 1:
+                            wait_msg = 'Blasting neuron #%s `(mirror=%s; ' \
+                                       'hits=%i; db=%s; use_alpha=%s; ' \
+                                       'prefer_reverse_score=%s)` ' \
+                                       '- please wait...' % (skids[0],
+                                       mirror, hits, db, alpha,
+                                       prefermu)
+                        else:
+                            wait_msg = 'Blasting %i neurons `(mirror=%s; ' \
+                                       'top=%i; db=%s; use_alpha=%s; ' \
+                                       'prefer_reverse_score=%s)` ' \
+                                       '- please wait...' % (len(skids),
+                                       mirror, top_n, db, alpha,
+                                       prefermu)
+
+                        job = {'skids': skids,
+                               'channel': channel,
+                               'db': db,
+                               'mirror': mirror,
+                               'hits': hits,
+                               'top_n': top_n,
+                               'cores': cores,
+                               'prefer_muscore': prefermu,
+                               'use_alpha': alpha,
+                               'prefilter': prefilter,
+                               'show_pruned': 'showpruned' in command,
+                               'reverse_depth': reverse_depth,
+                               'wait_msg': wait_msg,
+                               'user': user}
+
+                        # Neurons that have not changed since they
+                        # were last blasted are answered from cache
+                        cached = None
+                        if nblast_results is not None:
                             try:
-                                t = subscription_manager(slack_client, command,
-                                                         channel, user)
-                            except Exception as e:
-                                logger.error("Error while processing "
-                                             "subscription: " + e,
-                                             exc_info=True )
-                                slack_client.api_call("chat.postMessage",
-                                                      channel=channel,
-                                                      text='Ooops, something '
-                                                           'went wrong... '
-                                                           'please try again '
-                                                           'or contact an '
-                                                           'admin.',
-                                                      as_user=True)
-                        elif 'nblast' in command.lower():
-                            # For some odd reason, threading does not prevent
-                            # freezing while waiting R code to return nblast
-                            # results.
-                            # Therfore nblasting is used as a fire and forget
-                            # script by creating a new subprocess
-
-                            skids = parse_neurons( command )
-
-                            if len(skids) == 1:
-                                if not neuron_exists(skids[0],
-                                                     remote_instance=remote_instance):
-                                        response = "I'm sorry - the neuron " \
-                                                   "#%s does not seem to " \
-                                                   "exists. Please try " \
-                                                   "again." % skids[0]
-                                        slack_client.api_call("chat.postMessage",
-                                                              channel=channel,
-                                                              text=response,
-                                                              as_user=True)
-                                else:
-                                    prefermu = 'prefermu' in command
-                                    alpha = 'alpha' in command
-
-                                    try:
-                                        hits = int(re.search('hits=(\d+)',
-                                                             command).group(1))
-                                    except:
-                                        hits = 3
-
-                                    try:
-                                        cores = int(re.search('cores=(\d+)',
-                                                             command).group(1))
-                                    except:
-                                        cores = 8
-
-                                    if 'gmrdb' in command:
-                                        db = 'gmr'
-                                    else:
-                                        db = 'fc'
-
-                                    if 'fafb' in command.lower():
-                                        mirror = 'mirror' in command
-                                        p = subprocess.Popen("python3 ffnblast_fafb.py "
-                                                             "%s %s %i %i %i "
-                                                             "%i %i" % (skids[0],
-                                                             channel, int(mirror),
-                                                             hits, cores,
-                                                             int(prefermu),
-                                                             int(alpha)),
-                                                             shell=True)
-                                    else:
-                                        mirror = not 'nomirror' in command
-                                        p = subprocess.Popen("python3 ffnblast.py "
-                                                             "%s %s %i %i %s %i "
-                                                             "%i %i" % (skids[0],
-                                                             channel, int(mirror),
-                                                             hits, db, cores,
-                                                             int(prefermu),
-                                                             int(alpha)),
-                                                             shell=True)
-                                    open_processes.append(p)
-                            else:
-                                slack_client.api_call("chat.postMessage",
-                                                      channel=channel,
-                                                      text='I need a *single* '
-                                                           'neuron to nblast! '
-                                                           'E.g. `@catbot '
-                                                           'nblast #123456`',
-                                                      as_user=True)
-                        elif 'zotero' in command.lower():
-                            if zot:
-                                try:
-                                    t = return_zotero(slack_client, command,
-                                                      channel)
-                                except Exception as e:
-                                    logger.error("Error while processing "
-                                                 "Zotero: " + e, exc_info=True)
-                            else:
-                                response = "Sorry, I can't process your " \
-                                           "Zotero request unless you have " \
-                                           "it properly configured :("
-                                slack_client.api_call("chat.postMessage",
-                                                      channel=channel,
-                                                      text=response,
-                                                      as_user=True)
-                        elif 'happy' in command.lower() and 'hour' in command.lower():
-                            slack_client.api_call("chat.postMessage",
-                                                  channel=channel,
-                                                  text=time2hh(),
-                                                  as_user=True)
+                                job['cache_key'] = job_key(job, botconfig,
+                                                           remote_instance=remote_instance)
+                            except Exception:
+                                logger.warning('Unable to get NBLAST '
+                                               'cache key', exc_info=True)
+                                job['cache_key'] = None
+                            if job['cache_key']:
+                                cached = nblast_results.get(job['cache_key'])
+
+                        if cached:
+                            logger.info('Posting cached NBLAST results '
+                                        'for #%s' % skids[0])
+                            post_results(slack_client, channel,
+                                         skids[0], cached)
                         else:
-                            response = "Not sure what you mean. Type " \
-                                       "_@catbot help_ to get a list of " \
-                                       "things I can do for you."
-                            slack_client.api_call("chat.postMessage",
-                                                  channel=channel,
-                                                  text=response,
-                                                  as_user=True)
-                        if t:
-                            t.start()
-                            open_threads.append( t )
-
+                            job['ts'] = slack_client.api_call("chat.postMessage",
+                                                              channel=channel,
+                                                              text=wait_msg,
+                                                              as_user=True).get('ts')
+                            nblast_workers.submit(job)
+                    elif missing:
+                        slack_client.post(channel=channel,
+                                          text=missing_message(missing),
+                                          as_user=True)
+                    else:
+                        slack_client.post(channel=channel,
+                                          text='I need at least '
+                                               'one neuron to '
+                                               'nblast! E.g. '
+                                               '`@catbot nblast '
+                                               '#123456`',
+                                          as_user=True)
+                elif 'zotero' in command.lower():
+                    if zot:
+                        try:
+                            t = return_zotero(slack_client, command,
+                                              channel)
+                        except Exception as e:
+                            logger.error("Error while processing "
+                                         "Zotero: " + e, exc_info=True)
+                    else:
+                        response = "Sorry, I can't process your " \
+                                   "Zotero request unless you have " \
+                                   "it properly configured :("
+                        slack_client.post(channel=channel,
+                                          text=response,
+                                          as_user=True)
+                elif 'happy' in command.lower() and 'hour' in command.lower():
+                    slack_client.post(channel=channel,
+                                      text=time2hh(),
+                                      as_user=True)
+                else:
+                    response = "Not sure what you mean. Type " \
+                               "_@catbot help_ to get a list of " \
+                               "things I can do for you."
+                    slack_client.post(channel=channel,
+                                      text=response,
+                                      as_user=True)
+                if t:
+                    #Blocking handlers run on the dispatcher's executor
+                    dispatcher.submit(t, channel)
+
+            if len(dispatcher) + len(nblast_workers) != previous_open_requests:
+                logger.debug('Open requests/NBLAST jobs: %i' % (len(dispatcher) + len(nblast_workers)))
+                previous_open_requests = len(dispatcher) + len(nblast_workers)
+
+            #Post results of finished NBLAST jobs
+            for job, res in nblast_workers.finished():
+                if res['status'] in ['progress', 'queued']:
+                    if res['status'] == 'progress':
+                        status = res['message']
+                    elif res['position']:
+                        status = 'Waiting for free CPU cores - you are ' \
+                                 'number %i in the queue.' % res['position']
+                    else:
+                        status = 'Started!'
+                    #Slack may have failed to post the wait message
+                    if job.get('ts'):
+                        slack_client.update(job['channel'], job['ts'],
+                                            job['wait_msg'] + '\n' + status)
+                    continue
+                if job.get('ts'):
+                    slack_client.delete(job['channel'], job['ts'])
+                if res['status'] == 'done':
+                    #Queued - the main loop must not block on uploads
+                    post_results(slack_client, job['channel'],
+                                 ' #'.join(job['skids']), res['results'])
+                    if nblast_results is not None and job.get('cache_key'):
+                        try:
+                            nblast_results.put(job['cache_key'], res['results'])
+                        except Exception:
+                            logger.warning('Unable to cache NBLAST results',
+                                           exc_info=True)
                 else:
-                    logger.info('Too many open threads - ignoring command '
-                                'for now.')
-                    slack_client.api_call("chat.postMessage", channel=channel,
-                                          text= 'I am currently really busy. '
-                                                'Please give me a moment and '
-                                                'try again. Cheers!',
-                                          as_user=True )
-
-            if len(open_threads) + len(open_processes) != previous_open_threads:
-                logger.debug('Open threads/processes: %i' % (len(open_threads) + len(open_processes)))
-                previous_open_threads = len(open_threads) + len(open_processes)
-
-            #Try closing open threads
-            if open_threads:
-                for t in open_threads:
-                    if not t.is_alive():
-                        t.join()
-                        open_threads.remove(t)
-
-            #Check if open processes have finished
-            if open_processes:
-                for p in open_processes:
-                    if p.poll() is not None:
-                        open_processes.remove(p)
-
-            time.sleep(botconfig.READ_WEBSOCKET_DELAY)
+                    logger.error('NBLAST for #%s failed: %s' % (' #'.join(job['skids']),
+                                                               res['error']))
+                    slack_client.post(channel=job['channel'],
+                                      text='Ooops, something went wrong '
+                                           'while nblasting neuron(s) #%s... '
+                                           'please try again or contact '
+                                           'an admin.' % ' #'.join(job['skids']),
+                                      as_user=True)
+                #Output files have to exist until they are uploaded
+                slack_client.after_sent(lambda job=job: nblast_workers.cleanup(job))
     else:
         logger.error("Connection failed. Invalid Slack token or bot ID?")
 
+    nblast_workers.stop()
+    dispatcher.stop()
+    slack_client.stop()
+
 
 
@@ -0,0 +1,137 @@
+"""
+    Persistent index of root nodes
+    root_index.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Keeps root node ID and coordinates per skeleton ID in a small shelve so
+    that links to neurons (e.g. for `url` or subscription updates) don't
+    require downloading whole skeletons. Each entry remembers the skeleton's
+    version (see skeleton_versions.get_versions()) - versions are checked in bulk
+    and only roots of skeletons that changed (or that have not been looked up
+    for a while) are fetched again.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging, shelve, threading, time
+from collections import OrderedDict
+
+from skeleton_versions import get_versions
+
+logger = logging.getLogger('pybotLog')
+
+#Roots are fetched again after this many seconds even if the skeleton's
+#version did not change (rerooting does not change the cable length)
+MAX_AGE = 86400
+
+
+def fetch_roots(skids, remote_instance):
+    """ Fetches root nodes from the CATMAID server (requests run in parallel).
+
+    Returns:
+    -------
+    { skid : { 'root_id', 'x', 'y', 'z' } } - skeletons that could not be
+    found are missing
+    """
+    skids = [str(s) for s in skids]
+    if not skids:
+        return {}
+
+    urls = [remote_instance.make_url(remote_instance.project_id, 'skeletons',
+                                     s, 'root') for s in skids]
+    resp = remote_instance.fetch(urls, on_error='log', disable_pbar=True)
+
+    return {s: {k: r[k] for k in ['root_id', 'x', 'y', 'z']}
+            for s, r in zip(skids, resp) if isinstance(r, dict) and 'root_id' in r}
+
+
+class root_index:
+    """ Persistent { skid : root node } index.
+
+    Parameters:
+    ----------
+    path :      filename of the shelve
+    max_age :   seconds after which entries are refreshed regardless of the
+                skeleton's version
+    """
+
+    def __init__(self, path='rootindex', max_age=MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+    def get_roots(self, skids, remote_instance=None):
+        """ Returns root nodes for given skeleton IDs. Needs one bulk request
+        for the versions plus one request per skeleton that is not indexed
+        or has changed.
+
+        Returns:
+        -------
+        { skid : { 'root_id', 'x', 'y', 'z' } } - skeletons that could not be
+        found are missing
+        """
+        skids = list(OrderedDict.fromkeys(str(s) for s in skids))
+        if not skids:
+            return {}
+
+        versions = get_versions(skids, remote_instance=remote_instance)
+        now = time.time()
+
+        with self.lock:
+            with shelve.open(self.path) as db:
+                known = {s: db[s] for s in skids if s in db}
+
+        roots = {}
+        todo = []
+        for s in skids:
+            e = known.get(s)
+            if e and e['version'] == versions.get(s) \
+               and now - e['fetched'] < self.max_age:
+                roots[s] = e['root']
+            elif s in versions:
+                todo.append(s)
+
+        if todo:
+            logger.debug('Fetching %i of %i root nodes' % (len(todo), len(skids)))
+            fetched = fetch_roots(todo, remote_instance)
+            self.update(fetched, {s: versions[s] for s in fetched})
+            roots.update(fetched)
+
+        return roots
+
+    def update(self, roots, versions):
+        """ Writes root nodes to the index.
+
+        Parameters:
+        ----------
+        roots :     { skid : { 'root_id', 'x', 'y', 'z' } }
+        versions :  { skid : version }
+        """
+        now = time.time()
+        with self.lock:
+            with shelve.open(self.path) as db:
+                for s, r in roots.items():
+                    db[str(s)] = {'root': r, 'version': versions.get(s),
+                                  'fetched': now}
+
+    def invalidate(self, skids=None):
+        """ Drops given skeleton IDs from the index (everything if None).
+        """
+        with self.lock:
+            with shelve.open(self.path) as db:
+                if skids is None:
+                    db.clear()
+                    return
+                for s in skids:
+                    db.pop(str(s), None)
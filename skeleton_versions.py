@@ -0,0 +1,90 @@
+"""
+    Skeleton versions and edit stamps
+    skeleton_versions.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Cheap, bulk queries that tell whether neurons have changed: versions
+    (cable length) are used to validate the root index, NBLAST result cache
+    and all-by-all score matrix; edit stamps decide which subscribed neurons
+    need a full update.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib, json
+
+import pymaid
+
+from neuron_metrics import PARTNER_MIN_SIZE, closed_end_counts, extract_partners
+
+
+def get_versions(skids, remote_instance=None):
+    """ Returns { skid : version } for given skeleton IDs. Cable length is
+    used as version: it is available in bulk and changes with every edit
+    that changes the neuron's geometry.
+    """
+    return {str(k): v for k, v in pymaid.get_cable_lengths(list(skids),
+                                                           remote_instance=remote_instance).items()}
+
+
+def get_edit_stamps(skids, remote_instance=None):
+    """ Returns { skid : stamp } for given skeleton IDs (missing skeletons are
+    left out). CATMAID has no bulk endpoint for last-edit times, so stamps
+    are made of everything a subscription update reports that is available
+    in bulk: cable length, a hash of the synaptic partners (per partner and
+    relation), annotations, name, review status and number of closed end
+    tags. Neurons whose stamp did not change have not changed in any way
+    that would show up in their update.
+
+    Needs one request each for cable lengths, partners, annotations, names
+    and review status plus one for the project's label list.
+    """
+    skids = [str(s) for s in skids]
+    if not skids:
+        return {}
+
+    cable = get_versions(skids, remote_instance=remote_instance)
+    connectivity = pymaid.get_partners(skids, remote_instance=remote_instance,
+                                       min_size=PARTNER_MIN_SIZE)
+    partners = extract_partners(connectivity, skids)
+    annotations = pymaid.get_annotations(skids, remote_instance=remote_instance)
+    names = pymaid.get_names(skids, remote_instance=remote_instance)
+    review = pymaid.get_review(skids, remote_instance=remote_instance)
+    review = review.set_index(review.skeleton_id.astype(str)).percent_reviewed.to_dict()
+    closed_ends = closed_end_counts(pymaid.get_label_list(remote_instance=remote_instance),
+                                    skids)
+
+    #Lists (not tuples) so that stamps compare equal after a JSON round trip
+    return {s: [cable[s],
+                hashlib.md5(json.dumps(partners[s], sort_keys=True).encode()).hexdigest(),
+                sorted(annotations.get(s, [])),
+                names.get(s),
+                review.get(s),
+                closed_ends[s]]
+            for s in skids if s in cable}
+
+
+def edited_neurons(skids, snapshots, stamps):
+    """ Returns skeleton IDs that have been edited since their snapshot (or
+    have none). Skeletons without a stamp (i.e. missing in CATMAID) are left
+    out.
+
+    Parameters:
+    ----------
+    skids :     skeleton IDs to check
+    snapshots : { skid : snapshot } - snapshots hold their 'edit_stamp'
+    stamps :    { skid : stamp } as returned by get_edit_stamps()
+    """
+    return [s for s in skids if s in stamps and
+            (s not in snapshots or snapshots[s].get('edit_stamp') != stamps[s])]
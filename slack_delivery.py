@@ -0,0 +1,264 @@
+"""
+    Rate-limit aware delivery of Slack messages
+    slack_delivery.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    All Web API calls go through one pooled HTTP session. Calls to a method are
+    spaced out according to Slack's per-method rate limits and retried (with
+    backoff) if Slack answers with 429/Retry-After or the connection fails.
+
+    Posts, updates, deletes and uploads whose response nobody waits for can be
+    queued: a single sender thread delivers them in order and merges short
+    posts to the same channel that arrive within a few moments of each other.
+
+    The RTM connection (rtm_connect, rtm_read) stays with slackclient.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json, logging, threading, time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('pybotLog')
+
+API_URL = 'https://slack.com/api/'
+
+#Min seconds between two calls of a method (Slack's rate limit tiers). Posts
+#are limited per channel
+METHOD_INTERVALS = {'chat.postMessage': 1,
+                    'chat.update': 1.2,
+                    'chat.delete': 1.2,
+                    'files.upload': 3,
+                    'users.list': 3}
+
+#For methods not listed in METHOD_INTERVALS
+DEFAULT_INTERVAL = 1
+
+#Queued posts shorter than this are merged with other posts to the same channel
+COALESCE_MAX_CHARS = 500
+
+#Slack truncates longer messages
+MAX_MESSAGE_CHARS = 4000
+
+
+class delivery_client:
+    """ Slack Web API client with rate limiting, retries and a send queue.
+    Drop-in replacement for slackclient's api_call().
+
+    Parameters:
+    ----------
+    token :             Slack API token
+    pool_size :         max number of pooled HTTP connections
+    max_retries :       give up on a call after this many failed attempts
+    coalesce_window :   seconds a short queued post waits for others to the
+                        same channel to be merged with
+    """
+
+    def __init__(self, token, pool_size=10, max_retries=5, coalesce_window=1):
+        self.token = token
+        self.max_retries = max_retries
+        self.coalesce_window = coalesce_window
+
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer ' + token
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+        #Earliest time each method may be called again
+        self.next_call = {}
+        self.rate_lock = threading.Lock()
+
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.sender = threading.Thread(target=self._send_queued,
+                                       name='slack_delivery', daemon=True)
+
+    def start(self):
+        self.sender.start()
+
+    def stop(self, timeout=30):
+        """ Stops the sender after delivering what is queued (or timeout). """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.sender.join(timeout)
+
+    def _wait_turn(self, method, channel=None):
+        """ Blocks until method may be called and reserves the slot. """
+        key = (method, channel) if method == 'chat.postMessage' else method
+        with self.rate_lock:
+            now = time.time()
+            #Back-offs after 429s are per method
+            start = max(now, self.next_call.get(method, 0),
+                        self.next_call.get(key, 0))
+            self.next_call[key] = start + METHOD_INTERVALS.get(method,
+                                                               DEFAULT_INTERVAL)
+        if start > now:
+            time.sleep(start - now)
+
+    def _back_off(self, method, seconds):
+        with self.rate_lock:
+            self.next_call[method] = max(self.next_call.get(method, 0),
+                                         time.time() + seconds)
+
+    def api_call(self, method, **kwargs):
+        """ Calls a Web API method and returns Slack's response (dict).
+        Blocks while rate limited.
+        """
+        files = None
+        if 'file' in kwargs:
+            files = {'file': kwargs.pop('file')}
+        data = {k: json.dumps(v) if isinstance(v, (list, dict)) else v
+                for k, v in kwargs.items()}
+
+        for attempt in range(self.max_retries):
+            self._wait_turn(method, kwargs.get('channel'))
+            try:
+                if files:
+                    files['file'].seek(0)
+                r = self.session.post(API_URL + method, data=data,
+                                      files=files, timeout=60)
+            except requests.RequestException as e:
+                wait = 2 ** attempt
+                logger.warning('Slack %s failed (%s) - retrying in %is' % (method,
+                                                                          e,
+                                                                          wait))
+                self._back_off(method, wait)
+                continue
+
+            if r.status_code == 429:
+                wait = int(r.headers.get('Retry-After', 2 ** attempt))
+                logger.warning('Slack rate limit hit for %s - retrying in %is' % (method,
+                                                                                 wait))
+                self._back_off(method, wait)
+                continue
+
+            if r.status_code >= 500:
+                self._back_off(method, 2 ** attempt)
+                continue
+
+            try:
+                return r.json()
+            except ValueError:
+                return {'ok': False, 'error': 'invalid_response'}
+
+        logger.error('Giving up on Slack %s after %i attempts' % (method,
+                                                                 self.max_retries))
+        return {'ok': False, 'error': 'max_retries'}
+
+    def post(self, channel, text, **kwargs):
+        """ Queues a message (as_user=True unless given). Short plain-text
+        posts to the same channel are merged.
+        """
+        kwargs.setdefault('as_user', True)
+        self._enqueue('chat.postMessage', dict(kwargs, channel=channel,
+                                                text=text))
+
+    def update(self, channel, ts, text, **kwargs):
+        """ Queues an update of a message. """
+        kwargs.setdefault('as_user', True)
+        self._enqueue('chat.update', dict(kwargs, channel=channel, ts=ts,
+                                          text=text))
+
+    def delete(self, channel, ts):
+        """ Queues deletion of a message. """
+        self._enqueue('chat.delete', {'channel': channel, 'ts': ts})
+
+    def upload(self, channels, path, **kwargs):
+        """ Queues upload of a file. The file has to exist until it has been
+        sent.
+        """
+        self._enqueue('files.upload', dict(kwargs, channels=channels,
+                                            path=path))
+
+    def after_sent(self, callback):
+        """ Queues callback() to be run by the sender once everything queued
+        before it has been sent - e.g. to remove uploaded files.
+        """
+        self._enqueue('callback', {'callback': callback})
+
+    def _enqueue(self, method, kwargs):
+        with self.cond:
+            self.queue.append((time.time(), method, kwargs))
+            self.cond.notify()
+
+    @staticmethod
+    def _mergeable(method, kwargs):
+        return method == 'chat.postMessage' \
+               and set(kwargs) <= {'channel', 'text', 'as_user'} \
+               and len(kwargs['text']) < COALESCE_MAX_CHARS
+
+    def _next(self):
+        """ Pops the next call - short posts are merged with later short posts
+        to the same channel that are queued before any other call to that
+        channel.
+        """
+        with self.cond:
+            while not self.queue and not self.stopped:
+                self.cond.wait()
+            if not self.queue:
+                return None
+            queued, method, kwargs = self.queue[0]
+
+        if not self._mergeable(method, kwargs):
+            with self.cond:
+                return self.queue.popleft()[1:]
+
+        #Give other posts to this channel a moment to arrive
+        wait = queued + self.coalesce_window - time.time()
+        if wait > 0 and not self.stopped:
+            time.sleep(wait)
+
+        with self.cond:
+            self.queue.popleft()
+            texts = [kwargs['text']]
+            length = len(kwargs['text'])
+            for item in list(self.queue):
+                m, kw = item[1:]
+                if kw.get('channel', kw.get('channels')) != kwargs['channel']:
+                    continue
+                if not self._mergeable(m, kw) or length + len(kw['text']) + 1 > MAX_MESSAGE_CHARS:
+                    break
+                self.queue.remove(item)
+                texts.append(kw['text'])
+                length += len(kw['text']) + 1
+
+        return method, dict(kwargs, text='\n'.join(texts))
+
+    def _send_queued(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            method, kwargs = item
+            try:
+                if method == 'callback':
+                    kwargs['callback']()
+                    continue
+                if method == 'files.upload':
+                    kwargs = dict(kwargs)
+                    with open(kwargs.pop('path'), 'rb') as f:
+                        resp = self.api_call(method, file=f, **kwargs)
+                else:
+                    resp = self.api_call(method, **kwargs)
+                if not resp.get('ok'):
+                    logger.error('Slack %s failed: %s' % (method,
+                                                          resp.get('error')))
+            except Exception:
+                logger.error('Failed to deliver Slack %s' % method,
+                             exc_info=True)
@@ -0,0 +1,211 @@
+"""
+    SQLite database for subscriptions
+    subscription_db.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Users, their subscriptions and the shared neuron snapshots live in three
+    tables of a SQLite database in WAL mode: readers don't block the writer
+    and every change touches only the affected rows inside a transaction
+    (shelve had to rewrite the whole 'users' dict for any change).
+
+    The old shelve database (subscriptiondb) is migrated once when the
+    SQLite database is created.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import dbm, json, logging, shelve, sqlite3
+from contextlib import contextmanager
+
+logger = logging.getLogger('pybotLog')
+
+#Bump when changing the schema
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id         TEXT PRIMARY KEY,
+    daily_updates   INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    user_id         TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    skid            TEXT NOT NULL,
+    PRIMARY KEY (user_id, skid)
+);
+CREATE INDEX IF NOT EXISTS subscriptions_skid ON subscriptions(skid);
+CREATE TABLE IF NOT EXISTS snapshots (
+    skid            TEXT PRIMARY KEY,
+    last_update     TEXT,
+    data            TEXT NOT NULL
+);
+"""
+
+
+def _to_json(obj):
+    """ Makes numpy/pandas scalars JSON serializable. """
+    if hasattr(obj, 'item'):
+        return obj.item()
+    return str(obj)
+
+
+class subscription_db:
+    """ Subscriptions and neuron snapshots in SQLite. Safe to use from
+    several threads: every call opens its own connection.
+
+    Parameters:
+    ----------
+    path :          filename of the SQLite database
+    shelve_path :   old shelve database to migrate from when the SQLite
+                    database is created (None to skip)
+    """
+
+    def __init__(self, path='subscriptions.sqlite', shelve_path='subscriptiondb'):
+        self.path = path
+
+        with self.transaction() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            version = con.execute('PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                con.executescript(SCHEMA)
+                if version == 0 and shelve_path:
+                    self._migrate(con, shelve_path)
+                con.execute('PRAGMA user_version = %i' % SCHEMA_VERSION)
+
+    @contextmanager
+    def transaction(self):
+        """ Yields a connection - commits on success, rolls back on error.
+        """
+        con = sqlite3.connect(self.path, timeout=30)
+        con.execute('PRAGMA foreign_keys = ON')
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def _migrate(self, con, shelve_path):
+        """ Copies users, subscriptions and snapshots from the old shelve.
+        """
+        if not dbm.whichdb(shelve_path):
+            return
+
+        with shelve.open(shelve_path, flag='r') as data:
+            users = data.get('users', {})
+            neurons = dict(data.get('neurons', {}))
+
+        for u, v in users.items():
+            con.execute('INSERT OR REPLACE INTO users VALUES (?, ?)',
+                        (u, int(v.get('daily_updates', True))))
+            con.executemany('INSERT OR IGNORE INTO subscriptions VALUES (?, ?)',
+                            [(u, str(s)) for s in v.get('subscriptions', [])])
+            #Old layout had per-user snapshots: keep the most recent
+            for n, snapshot in v.get('neurons', {}).items():
+                if str(n) not in neurons or snapshot['last_update'] > neurons[str(n)]['last_update']:
+                    neurons[str(n)] = snapshot
+
+        self._put_snapshots(con, neurons)
+
+        logger.info('Migrated %i users and %i snapshots from %s' % (len(users),
+                                                                   len(neurons),
+                                                                   shelve_path))
+
+    def users(self, daily_updates=None):
+        """ Returns user IDs (only those with/without daily updates if
+        daily_updates is True/False).
+        """
+        with self.transaction() as con:
+            if daily_updates is None:
+                rows = con.execute('SELECT user_id FROM users')
+            else:
+                rows = con.execute('SELECT user_id FROM users WHERE daily_updates = ?',
+                                   (int(daily_updates), ))
+            return [r[0] for r in rows]
+
+    def add_user(self, user):
+        """ Adds user (with daily updates) if not yet in the database. """
+        with self.transaction() as con:
+            con.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)',
+                        (user, ))
+
+    def toggle_daily_updates(self, user):
+        """ Switches daily updates on/off. Returns the new setting. """
+        with self.transaction() as con:
+            con.execute('UPDATE users SET daily_updates = 1 - daily_updates '
+                        'WHERE user_id = ?', (user, ))
+            row = con.execute('SELECT daily_updates FROM users WHERE user_id = ?',
+                              (user, )).fetchone()
+            return bool(row and row[0])
+
+    def subscriptions(self, user=None):
+        """ Returns skeleton IDs the user is subscribed to (those of all users
+        if user is None).
+        """
+        with self.transaction() as con:
+            if user is None:
+                rows = con.execute('SELECT DISTINCT skid FROM subscriptions')
+            else:
+                rows = con.execute('SELECT skid FROM subscriptions WHERE user_id = ?',
+                                   (user, ))
+            return [r[0] for r in rows]
+
+    def subscribe(self, user, skids, snapshots=None):
+        """ Subscribes user to skids and stores snapshots (if any) in the
+        same transaction.
+        """
+        with self.transaction() as con:
+            con.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)',
+                        (user, ))
+            con.executemany('INSERT OR IGNORE INTO subscriptions VALUES (?, ?)',
+                            [(user, str(s)) for s in skids])
+            if snapshots:
+                self._put_snapshots(con, snapshots)
+
+    def unsubscribe(self, user, skids):
+        """ Returns skeleton IDs the user actually was subscribed to. """
+        removed = []
+        with self.transaction() as con:
+            for s in skids:
+                cur = con.execute('DELETE FROM subscriptions WHERE user_id = ? AND skid = ?',
+                                  (user, str(s)))
+                if cur.rowcount:
+                    removed.append(str(s))
+        return removed
+
+    def get_snapshots(self, skids):
+        """ Returns { skid : snapshot } for those skids that have one. """
+        skids = [str(s) for s in skids]
+        snapshots = {}
+        with self.transaction() as con:
+            #Stay below SQLite's limit on the number of variables
+            for i in range(0, len(skids), 500):
+                chunk = skids[i: i + 500]
+                rows = con.execute('SELECT skid, data FROM snapshots WHERE skid IN (%s)'
+                                   % ','.join('?' * len(chunk)), chunk)
+                snapshots.update({s: json.loads(d) for s, d in rows})
+        return snapshots
+
+    def put_snapshots(self, snapshots, prune=False):
+        """ Stores { skid : snapshot }. If prune=True, snapshots of neurons
+        nobody is subscribed to are dropped in the same transaction.
+        """
+        with self.transaction() as con:
+            self._put_snapshots(con, snapshots)
+            if prune:
+                con.execute('DELETE FROM snapshots WHERE skid NOT IN '
+                            '(SELECT skid FROM subscriptions)')
+
+    def _put_snapshots(self, con, snapshots):
+        con.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)',
+                        [(str(s), v.get('last_update'), json.dumps(v, default=_to_json))
+                         for s, v in snapshots.items()])
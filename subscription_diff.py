@@ -0,0 +1,128 @@
+"""
+    Change reports for subscribed neurons
+    subscription_diff.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Compares two snapshots of a neuron (see neuron_metrics.py). Partners are
+    stored as sorted arrays of partner IDs and synapse counts per relation, so
+    partner changes come down to a union and two scatters per relation;
+    annotations are compared as sets.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+from tabulate import tabulate
+
+RELATIONS = ['upstream', 'downstream']
+
+
+def partner_arrays(snapshot):
+    """ Returns { relation : (ids, counts) } as int arrays sorted by ID.
+    Also understands snapshots from before partners were stored as arrays
+    ('synaptic_partners': { skid : { relation : n or '-' } }).
+    """
+    if 'partners' in snapshot:
+        return {rel: (np.asarray(snapshot['partners'][rel]['ids'], dtype=np.int64),
+                      np.asarray(snapshot['partners'][rel]['counts'], dtype=np.int64))
+                for rel in RELATIONS}
+
+    old = snapshot.get('synaptic_partners', {})
+    arrays = {}
+    for rel in RELATIONS:
+        pairs = sorted((int(p), int(v[rel])) for p, v in old.items()
+                       if v.get(rel, '-') != '-')
+        arrays[rel] = (np.array([p for p, n in pairs], dtype=np.int64),
+                       np.array([n for p, n in pairs], dtype=np.int64))
+    return arrays
+
+
+def _scatter(ids, counts, union):
+    """ Returns counts aligned to union (0 for missing IDs). """
+    aligned = np.zeros(len(union), dtype=np.int64)
+    aligned[np.searchsorted(union, ids)] = counts
+    return aligned
+
+
+def diff_partners(old, new):
+    """ Returns (ids, counts) of partners whose synapse counts changed.
+    counts is an array of shape (N, 4): upstream new/old, downstream new/old.
+    """
+    old, new = partner_arrays(old), partner_arrays(new)
+    union = np.unique(np.concatenate([old[rel][0] for rel in RELATIONS] +
+                                     [new[rel][0] for rel in RELATIONS]))
+
+    counts = np.stack([_scatter(*snap[rel], union) for rel in RELATIONS
+                       for snap in (new, old)], axis=1)
+    changed = (counts[:, 0] != counts[:, 1]) | (counts[:, 2] != counts[:, 3])
+    return union[changed], counts[changed]
+
+
+def diff_neuron(old, new, basic_values):
+    """ Compares two snapshots of a neuron.
+
+    Returns:
+    -------
+    None if nothing changed, otherwise
+    { 'basic' : { value : [ new, old ] },
+      'partners' : (ids, counts) - see diff_partners(),
+      'annotations' : { 'new' : [], 'gone' : [] } }
+    """
+    basic = {e: [new[e], old[e]] for e in basic_values
+             if e in old and e in new and new[e] != old[e]}
+
+    partners = diff_partners(old, new)
+
+    old_an, new_an = set(old.get('annotations', [])), set(new.get('annotations', []))
+    annotations = {'new': sorted(new_an - old_an), 'gone': sorted(old_an - new_an)}
+
+    if not basic and not len(partners[0]) and not annotations['new'] \
+       and not annotations['gone']:
+        return None
+
+    return {'basic': basic, 'partners': partners, 'annotations': annotations}
+
+
+def format_changes(changes, basic_values, partner_names):
+    """ Renders changes as returned by diff_neuron() as text tables.
+
+    Parameters:
+    ----------
+    changes :       dict as returned by diff_neuron()
+    basic_values :  order of basic values in the table
+    partner_names : { skid : name } for partners - missing partners are
+                    reported as 'not found'
+    """
+    response = ''
+    if changes['basic']:
+        table = [['Value', 'New', 'Old']] + [[e] + changes['basic'][e]
+                                             for e in basic_values
+                                             if e in changes['basic']]
+        response += tabulate(table) + '\n'
+    if changes['annotations']['new']:
+        response += 'New annotations: %s \n' % '; '.join(changes['annotations']['new'])
+    if changes['annotations']['gone']:
+        response += 'Deleted annotations: %s \n' % '; '.join(changes['annotations']['gone'])
+
+    ids, counts = changes['partners']
+    if len(ids):
+        response += 'Synaptic partners:\n'
+        show = lambda n: str(n) if n else '-'
+        table = [['Name', 'SKID', 'Synapses from (new/old)', 'Synapses to (new/old)']]
+        table += [[partner_names.get(str(p), 'not found'), str(p),
+                   show(c[0]) + '/' + show(c[1]), show(c[2]) + '/' + show(c[3])]
+                  for p, c in zip(ids.tolist(), counts.tolist())]
+        response += tabulate(table) + '\n'
+
+    return response
@@ -0,0 +1,4 @@
+import os, sys
+
+#Catbot's modules live in the repository's root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
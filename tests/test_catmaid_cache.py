@@ -0,0 +1,86 @@
+from catmaid_cache import lookup_cache
+
+
+def counting(func):
+    """ Records the skeleton IDs each call was made with. """
+    calls = []
+
+    def wrapped(x, remote_instance=None, **kwargs):
+        calls.append(x)
+        return func(x, **kwargs)
+
+    wrapped.__name__ = func.__name__
+    return wrapped, calls
+
+
+def get_names(x):
+    return {str(s): 'neuron %s' % s for s in x}
+
+
+def test_per_skid_reuses_earlier_lookups():
+    cache = lookup_cache()
+    func, calls = counting(get_names)
+    names = cache.wrap(func, per_skid=True)
+
+    assert names(['1', '2']) == {'1': 'neuron 1', '2': 'neuron 2'}
+    assert names(['1', '2', '3']) == {'1': 'neuron 1', '2': 'neuron 2',
+                                      '3': 'neuron 3'}
+    assert calls == [['1', '2'], ['3']]
+    assert cache.stats()['get_names'] == {'hits': 2, 'misses': 3}
+
+
+def test_per_call_keys_include_arguments():
+    cache = lookup_cache()
+    func, calls = counting(lambda x, mirror=False: (x, mirror))
+    func.__name__ = 'get_neuron'
+    get_neuron = cache.wrap(func)
+
+    get_neuron('1')
+    get_neuron('1')
+    get_neuron('1', mirror=True)
+    assert len(calls) == 2
+
+
+def test_ttl_expires(monkeypatch):
+    import catmaid_cache
+    now = [1000.]
+    monkeypatch.setattr(catmaid_cache.time, 'time', lambda: now[0])
+
+    cache = lookup_cache(ttls={'get_names': 10})
+    func, calls = counting(get_names)
+    names = cache.wrap(func, per_skid=True)
+
+    names(['1'])
+    now[0] += 5
+    names(['1'])
+    now[0] += 10
+    names(['1'])
+    assert calls == [['1'], ['1']]
+
+
+def test_lru_bound():
+    cache = lookup_cache(max_entries=2)
+    func, calls = counting(get_names)
+    names = cache.wrap(func, per_skid=True)
+
+    names(['1', '2'])
+    names(['1'])
+    names(['3'])
+    assert len(cache) == 2
+    #2 was least recently used
+    names(['1', '2'])
+    assert calls[-1] == ['2']
+
+
+def test_invalidate():
+    cache = lookup_cache()
+    func, calls = counting(get_names)
+    names = cache.wrap(func, per_skid=True)
+
+    names(['1', '2'])
+    cache.invalidate(['2'])
+    names(['1', '2'])
+    assert calls == [['1', '2'], ['2']]
+
+    cache.invalidate()
+    assert len(cache) == 0
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+
+import nblast_engine
+from nblast_engine import (dotprops, dotprops_db, smat, forward_scores,
+                           forward_scores_batch, reverse_scores, prefilter)
+
+SM = smat(np.array([0, 5, 10, 20, 30, 40, 500.]),
+          np.linspace(0, 1, 5),
+          np.random.RandomState(1).uniform(-1, 1, (6, 4)))
+
+
+def random_db(n=40, seed=0, empty=(7, )):
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(5, 30, n)
+    lengths[list(empty)] = 0
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    #Neurons are spread out so that some are far apart
+    centers = np.repeat(rng.uniform(0, 300, (n, 3)), lengths, axis=0)
+    points = centers + rng.normal(0, 10, (offsets[-1], 3))
+    vect = rng.normal(size=(offsets[-1], 3))
+    vect /= np.linalg.norm(vect, axis=1)[:, None]
+    alpha = rng.uniform(0, 1, offsets[-1])
+    return dotprops_db([str(i) for i in range(n)], points, vect, alpha, offsets)
+
+
+def bin_score(d, dp):
+    """ Naive lookup: R's findInterval(..., all.inside=TRUE). """
+    i = min(max(sum(b <= d for b in SM.distbreaks) - 1, 0), len(SM.distbreaks) - 2)
+    j = min(max(sum(b <= dp for b in SM.dotbreaks) - 1, 0), len(SM.dotbreaks) - 2)
+    return SM.scores[i, j]
+
+
+def naive(query, target, use_alpha=False):
+    """ Raw NBLAST score: nearest target point for every query point. """
+    total = 0
+    for p, v, a in zip(query.points, query.vect, query.alpha):
+        if not len(target.points):
+            total += bin_score(np.inf, 0)
+            continue
+        d = np.sqrt(((target.points - p) ** 2).sum(axis=1))
+        k = d.argmin()
+        dp = abs(np.dot(v, target.vect[k]))
+        if use_alpha:
+            dp *= np.sqrt(a * target.alpha[k])
+        total += bin_score(d[k], dp)
+    return total
+
+
+def naive_self(n, use_alpha=False):
+    return naive(n, n, use_alpha)
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(nblast_engine, 'CHUNK_SIZE', 6)
+    monkeypatch.setattr(nblast_engine, 'REVERSE_CHUNK_POINTS', 60)
+
+
+@pytest.mark.parametrize('use_alpha', [False, True])
+@pytest.mark.parametrize('cores', [1, 2])
+def test_forward_scores(small_chunks, use_alpha, cores):
+    db = random_db()
+    query = db.neuron(3)
+    expected = [naive(query, db.neuron(i), use_alpha) / naive_self(query, use_alpha)
+                for i in range(len(db))]
+    scores = forward_scores(query, db, SM, use_alpha=use_alpha, cores=cores)
+    assert np.allclose(scores, expected)
+
+
+def test_forward_scores_subset():
+    db = random_db()
+    query = db.neuron(3)
+    idx = np.array([10, 2, 7])
+    scores = forward_scores(query, db, SM, idx=idx, normalised=False)
+    assert np.allclose(scores, [naive(query, db.neuron(i)) for i in idx])
+
+
+def test_forward_scores_batch(small_chunks):
+    db = random_db()
+    queries = [db.neuron(1), db.neuron(5), db.neuron(20)]
+    batch = forward_scores_batch(queries, db, SM)
+    for q, scores in zip(queries, batch):
+        assert np.allclose(scores, forward_scores(q, db, SM))
+
+
+@pytest.mark.parametrize('cores', [1, 2])
+def test_forward_scores_batch_bounded(monkeypatch, cores):
+    #Groups of a few queries and chunks of a few targets
+    monkeypatch.setattr(nblast_engine, 'MAX_QUERY_POINTS', 50)
+    monkeypatch.setattr(nblast_engine, 'MAX_CHUNK_PAIRS', 120)
+    db = random_db()
+    queries = [db.neuron(i) for i in [1, 5, 20, 3, 30, 12]]
+    assert len(nblast_engine.query_groups(queries, 50)) > 1
+
+    batch = forward_scores_batch(queries, db, SM, cores=cores)
+    expected = [[naive(q, db.neuron(i)) / naive_self(q) for i in range(len(db))]
+                for q in queries]
+    assert np.allclose(batch, expected)
+
+
+def test_query_groups():
+    db = random_db()
+    queries = [db.neuron(i) for i in range(10)]
+    groups = nblast_engine.query_groups(queries, 40)
+    assert sum(groups, []) == list(range(10))
+    for g in groups:
+        assert len(g) == 1 or sum(len(queries[i].points) for i in g) <= 40
+
+
+@pytest.mark.parametrize('use_alpha', [False, True])
+@pytest.mark.parametrize('cores', [1, 2])
+def test_reverse_scores(small_chunks, use_alpha, cores):
+    db = random_db()
+    query = db.neuron(3)
+    idx = np.array([i for i in range(len(db)) if i != 7])
+    expected = [naive(db.neuron(i), query, use_alpha) / naive_self(db.neuron(i), use_alpha)
+                for i in idx]
+
+    seen = []
+    scores = reverse_scores(query, db, SM, use_alpha=use_alpha, idx=idx,
+                            cores=cores,
+                            callback=lambda pos, values: seen.extend(pos))
+    assert np.allclose(scores, expected)
+    assert sorted(seen) == list(range(len(idx)))
+
+
+def test_prefilter_is_lossless_by_default():
+    db = random_db(n=60)
+    query = db.neuron(3)
+    kept = prefilter(query, db, sm=SM)
+    assert 3 in kept and 7 not in kept
+    assert len(kept) < len(db)
+
+    #Pruned targets have no point within the second-to-last distance break
+    for i in set(range(len(db))) - set(kept):
+        t = db.neuron(i)
+        for p in t.points:
+            assert np.sqrt(((query.points - p) ** 2).sum(axis=1)).min() >= SM.distbreaks[-2]
+
+    #Smaller paddings prune more
+    assert set(prefilter(query, db, padding=10)) <= set(kept)
+
+
+def test_build_trees(monkeypatch):
+    monkeypatch.setattr(nblast_engine, 'TREE_CACHE_SIZE', 5)
+    db = random_db()
+    db.build_trees(np.arange(len(db)))
+    assert sorted(db.trees) == [0, 1, 2, 3, 4]
+    #Cached trees are used as they are
+    tree = db.trees[0]
+    db.build_trees(np.arange(len(db)))
+    assert db.tree(0) is tree
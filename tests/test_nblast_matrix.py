@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+
+import dotprops_store
+import nblast_matrix
+from test_nblast_engine import SM, random_db
+
+
+@pytest.fixture
+def dump(tmp_path):
+    db = random_db(n=12, empty=())
+    versions = {n: 100. + i for i, n in enumerate(db.names)}
+    dotprops_store.write_store(db, str(tmp_path / dotprops_store.STORE_NAME),
+                               meta={'versions': versions}, sm=SM)
+    return tmp_path, versions
+
+
+def test_versions_come_from_store(dump):
+    folder, versions = dump
+    nblast_matrix.refresh_matrix(str(folder), cores=1)
+
+    mat = nblast_matrix.open_matrix(str(folder))
+    assert mat.versions == versions
+    assert mat.is_current('3', versions['3'])
+    #Edited after the dump was converted -> row is stale
+    assert not mat.is_current('3', versions['3'] + 1)
+
+
+def test_store_without_versions(tmp_path):
+    dotprops_store.write_store(random_db(n=5, empty=()),
+                               str(tmp_path / dotprops_store.STORE_NAME), sm=SM)
+    with pytest.raises(ValueError):
+        nblast_matrix.refresh_matrix(str(tmp_path), cores=1)
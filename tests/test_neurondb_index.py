@@ -0,0 +1,79 @@
+from neurondb_index import neurondb_index, neuron_tokens
+
+
+def entry(skid, **kwargs):
+    neuron = {'name': '', 'catmaid_name': '', 'skid': skid,
+              'alternative_names': [], 'type': '', 'neuropils': [],
+              'status': 'unknown', 'tags': '', 'last_edited': '2017-06-01',
+              'comments': []}
+    neuron.update(kwargs)
+    return neuron
+
+
+def make_index():
+    data = {'1': entry('1', name='MVP2', alternative_names=['MBON-g1pedc'],
+                       type='MBON', neuropils=['MB'],
+                       comments=['awesome neuron (phil)']),
+            '2': entry('2', name='PN1', catmaid_name='DA1 PN', type='uPN',
+                       neuropils=['LH', 'AL'], tags='olfactory',
+                       status='complete')}
+    index = neurondb_index()
+    index.build(data)
+    return data, index
+
+
+def test_tokens_cover_list_fields():
+    tokens = neuron_tokens(entry('1', alternative_names=['MBON-g1pedc'],
+                                 comments=['first', 'second (phil)']))
+    assert {'mbon', 'g1pedc', 'first', 'second', 'phil', 'unknown'} <= tokens
+
+
+def test_build_and_search():
+    data, index = make_index()
+    assert index.built
+    assert index.search(['lh']) == {'2'}
+    assert index.search(['MBON-g1pedc']) == {'1'}
+    assert index.search(['nothing']) == set()
+    assert index.search([]) == set()
+
+
+def test_search_intersects_terms():
+    data, index = make_index()
+    assert index.search(['lh', 'olfactory']) == {'2'}
+    assert index.search(['lh', 'mvp2']) == set()
+
+
+def test_prefix_search():
+    data, index = make_index()
+    assert index.search(['mb']) == {'1'}
+    assert index.search(['awe', 'neur']) == {'1'}
+    assert index.search(['p']) == {'1', '2'}
+
+
+def test_status_and_dates_are_searchable():
+    data, index = make_index()
+    assert index.search(['unknown']) == {'1'}
+    assert index.search(['complete']) == {'2'}
+    assert index.search(['2017']) == {'1', '2'}
+
+
+def test_update():
+    data, index = make_index()
+    data['2']['comments'].append('awesome too (phil)')
+    data['2']['tags'] = ''
+    index.update('2', data['2'])
+    assert index.search(['awesome']) == {'1', '2'}
+    assert index.search(['olfactory']) == set()
+    assert 'olfactory' not in index.sorted_tokens
+
+    index.update('3', entry('3', name='new neuron'))
+    assert index.search(['new']) == {'3'}
+
+
+def test_remove():
+    data, index = make_index()
+    index.remove('1')
+    assert index.search(['awesome']) == set()
+    assert 'mvp2' not in index.postings
+    assert 'mvp2' not in index.sorted_tokens
+    assert index.search(['lh']) == {'2'}
@@ -0,0 +1,83 @@
+import pandas as pd
+import pytest
+
+import skeleton_versions
+from skeleton_versions import get_edit_stamps, edited_neurons
+
+
+class catmaid:
+    """ Fake bulk endpoints for two neurons. """
+    def __init__(self):
+        self.names = {'1': 'PN1', '2': 'PN2'}
+        self.review = {'1': 50, '2': 0}
+        self.partners = [('10', 'upstream', 3, 0), ('11', 'downstream', 2, 5)]
+        self.tags = [('1', 'ends'), ('2', 'TODO')]
+
+    def install(self, monkeypatch):
+        pymaid = skeleton_versions.pymaid
+        monkeypatch.setattr(pymaid, 'get_cable_lengths',
+                            lambda x, remote_instance=None: {int(s): 100. for s in x})
+        monkeypatch.setattr(pymaid, 'get_partners', self.get_partners)
+        monkeypatch.setattr(pymaid, 'get_annotations',
+                            lambda x, remote_instance=None: {'1': ['a']})
+        monkeypatch.setattr(pymaid, 'get_names',
+                            lambda x, remote_instance=None: dict(self.names))
+        monkeypatch.setattr(pymaid, 'get_review', self.get_review)
+        monkeypatch.setattr(pymaid, 'get_label_list', self.get_label_list)
+
+    def get_partners(self, x, remote_instance=None, min_size=None):
+        return pd.DataFrame([{'skeleton_id': p, 'relation': rel, '1': n1, '2': n2}
+                             for p, rel, n1, n2 in self.partners])
+
+    def get_review(self, x, remote_instance=None):
+        return pd.DataFrame({'skeleton_id': list(self.review),
+                             'percent_reviewed': list(self.review.values())})
+
+    def get_label_list(self, remote_instance=None):
+        return pd.DataFrame(self.tags, columns=['skeleton_id', 'tag'])
+
+
+@pytest.fixture
+def server(monkeypatch):
+    s = catmaid()
+    s.install(monkeypatch)
+    return s
+
+
+def snapshots(stamps):
+    return {s: {'edit_stamp': st} for s, st in stamps.items()}
+
+
+def test_unchanged(server):
+    old = snapshots(get_edit_stamps(['1', '2']))
+    assert edited_neurons(['1', '2'], old, get_edit_stamps(['1', '2'])) == []
+
+
+def test_review_only_change(server):
+    old = snapshots(get_edit_stamps(['1', '2']))
+    server.review['2'] = 100
+    assert edited_neurons(['1', '2'], old, get_edit_stamps(['1', '2'])) == ['2']
+
+
+def test_name_only_change(server):
+    old = snapshots(get_edit_stamps(['1', '2']))
+    server.names['1'] = 'PN1 renamed'
+    assert edited_neurons(['1', '2'], old, get_edit_stamps(['1', '2'])) == ['1']
+
+
+def test_end_tag_change(server):
+    old = snapshots(get_edit_stamps(['1', '2']))
+    server.tags.append(('2', 'uncertain_end'))
+    assert edited_neurons(['1', '2'], old, get_edit_stamps(['1', '2'])) == ['2']
+
+
+def test_links_moved_between_partners(server):
+    old = snapshots(get_edit_stamps(['1', '2']))
+    #Same total number of links for neuron 1, different partner
+    server.partners = [('12', 'upstream', 3, 0), ('11', 'downstream', 2, 5)]
+    assert edited_neurons(['1', '2'], old, get_edit_stamps(['1', '2'])) == ['1']
+
+
+def test_new_and_missing_neurons(server):
+    stamps = get_edit_stamps(['1', '2'])
+    assert edited_neurons(['1', '2', '3'], {}, stamps) == ['1', '2']
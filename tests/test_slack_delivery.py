@@ -0,0 +1,122 @@
+import pytest
+
+pytest.importorskip('requests')
+
+import requests
+
+import slack_delivery
+from slack_delivery import delivery_client
+
+
+class response:
+    def __init__(self, status_code=200, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data if data is not None else {'ok': True}
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+
+class session:
+    """ Returns (or raises) the given responses in order. """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def post(self, url, data=None, files=None, timeout=None):
+        self.calls.append((url.split('/')[-1], data,
+                           files['file'].read() if files else None))
+        r = self.responses.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """ Records sleeps instead of sleeping. """
+    slept = []
+    monkeypatch.setattr(slack_delivery.time, 'sleep', slept.append)
+    return slept
+
+
+def client(responses, **kwargs):
+    c = delivery_client('xoxb-test', **kwargs)
+    c.session = session(responses)
+    return c
+
+
+def test_api_call(sleeps):
+    c = client([response(data={'ok': True, 'ts': '1.0'})])
+    assert c.api_call('chat.postMessage', channel='C1', text='hi')['ts'] == '1.0'
+    assert c.session.calls == [('chat.postMessage',
+                                {'channel': 'C1', 'text': 'hi'}, None)]
+
+
+def test_retry_after_429(sleeps):
+    c = client([response(429, headers={'Retry-After': '7'}), response()])
+    assert c.api_call('chat.update', channel='C1')['ok']
+    assert len(c.session.calls) == 2
+    assert any(s > 6 for s in sleeps)
+
+
+def test_retries_server_and_connection_errors(sleeps):
+    c = client([response(503), requests.ConnectionError('down'), response()])
+    assert c.api_call('chat.delete', channel='C1')['ok']
+    assert len(c.session.calls) == 3
+
+
+def test_gives_up(sleeps):
+    c = client([response(500)] * 3, max_retries=3)
+    assert c.api_call('chat.delete', channel='C1') == {'ok': False,
+                                                       'error': 'max_retries'}
+
+
+def test_rate_limit_per_channel(sleeps, monkeypatch):
+    monkeypatch.setattr(slack_delivery.time, 'time', lambda: 100.)
+    c = client([response()] * 3)
+    c.api_call('chat.postMessage', channel='C1', text='a')
+    c.api_call('chat.postMessage', channel='C2', text='b')
+    assert sleeps == []
+    c.api_call('chat.postMessage', channel='C1', text='c')
+    assert sleeps == [slack_delivery.METHOD_INTERVALS['chat.postMessage']]
+
+
+def test_queue_merges_short_posts(sleeps, tmpdir):
+    f = tmpdir.join('plot.png')
+    f.write('png')
+    c = client([response()] * 3)
+    sent = []
+    c.post('C1', 'a')
+    c.post('C2', 'b')
+    c.post('C1', 'c')
+    c.upload('C1', str(f), title='Plot')
+    c.after_sent(lambda: sent.append(len(c.session.calls)))
+    c.start()
+    c.stop()
+
+    assert c.session.calls == [('chat.postMessage',
+                                {'channel': 'C1', 'text': 'a\nc', 'as_user': True},
+                                None),
+                               ('chat.postMessage',
+                                {'channel': 'C2', 'text': 'b', 'as_user': True},
+                                None),
+                               ('files.upload',
+                                {'channels': 'C1', 'title': 'Plot'}, b'png')]
+    #Callback runs once everything queued before it has been sent
+    assert sent == [3]
+
+
+def test_posts_are_not_merged_across_uploads(sleeps, tmpdir):
+    f = tmpdir.join('plot.png')
+    f.write('png')
+    c = client([response()] * 3)
+    c.post('C1', 'a')
+    c.upload('C1', str(f))
+    c.post('C1', 'b')
+    c.start()
+    c.stop()
+    assert [call[0] for call in c.session.calls] == ['chat.postMessage',
+                                                     'files.upload',
+                                                     'chat.postMessage']
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tabulate')
+
+from subscription_diff import (partner_arrays, diff_partners, diff_neuron,
+                               format_changes)
+
+BASIC = ['name', 'n_nodes']
+
+
+def snapshot(upstream=(), downstream=(), annotations=(), **basic):
+    snap = {'name': 'PN1', 'n_nodes': 100,
+            'partners': {'upstream': {'ids': [p for p, n in upstream],
+                                      'counts': [n for p, n in upstream]},
+                         'downstream': {'ids': [p for p, n in downstream],
+                                        'counts': [n for p, n in downstream]}},
+            'annotations': sorted(annotations)}
+    snap.update(basic)
+    return snap
+
+
+def test_partner_arrays_reads_old_format():
+    old = {'synaptic_partners': {'5': {'upstream': 3, 'downstream': '-'},
+                                 '2': {'upstream': 1, 'downstream': 4}}}
+    arrays = partner_arrays(old)
+    assert arrays['upstream'][0].tolist() == [2, 5]
+    assert arrays['upstream'][1].tolist() == [1, 3]
+    assert arrays['downstream'][0].tolist() == [2]
+    assert arrays['downstream'][1].tolist() == [4]
+
+
+def test_diff_partners():
+    old = snapshot(upstream=[(1, 5), (2, 3)], downstream=[(3, 1)])
+    new = snapshot(upstream=[(1, 5), (4, 2)], downstream=[(3, 2)])
+    ids, counts = diff_partners(old, new)
+    #Columns: upstream new/old, downstream new/old
+    assert ids.tolist() == [2, 3, 4]
+    assert counts.tolist() == [[0, 3, 0, 0], [0, 0, 2, 1], [2, 0, 0, 0]]
+
+
+def test_unchanged_neuron():
+    snap = snapshot(upstream=[(1, 5)], annotations=['a'])
+    assert diff_neuron(snap, dict(snap), BASIC) is None
+
+
+def test_diff_neuron():
+    old = snapshot(upstream=[(1, 5)], annotations=['a', 'b'])
+    new = snapshot(upstream=[(1, 6)], annotations=['b', 'c'], n_nodes=120)
+    changes = diff_neuron(old, new, BASIC)
+    assert changes['basic'] == {'n_nodes': [120, 100]}
+    assert changes['annotations'] == {'new': ['c'], 'gone': ['a']}
+    assert changes['partners'][0].tolist() == [1]
+
+
+def test_format_changes():
+    old = snapshot(upstream=[(1, 5)], annotations=['a'])
+    new = snapshot(upstream=[(1, 6), (2, 1)], annotations=['b'], n_nodes=120)
+    text = format_changes(diff_neuron(old, new, BASIC), BASIC, {'1': 'PN2'})
+    assert 'New annotations: b' in text
+    assert 'Deleted annotations: a' in text
+    assert 'PN2' in text and '6/5' in text
+    assert 'not found' in text and '1/-' in text
+    assert 'n_nodes' in text and 'name' not in text.split('Synaptic')[0]
@@ -0,0 +1,171 @@
+"""
+    On-disk cache for Zotero attachments
+    zotero_cache.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Attachments (PDFs) are stored under the MD5 of their content, so that the
+    same file attached to several items is only stored once. A small shelve
+    maps attachment keys to the version and MD5 they were downloaded at: if
+    the attachment has changed in Zotero since, it is downloaded again. Least
+    recently used files are dropped once the cache exceeds its size limit -
+    except for files that are pinned (e.g. while an upload is queued).
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib, logging, os, re, shelve, threading
+
+logger = logging.getLogger('pybotLog')
+
+#Cached files are named <md5><extension>
+CONTENT_FILE = re.compile(r'^[0-9a-f]{32}(\.\w+)?$')
+
+
+class attachment_cache:
+    """ Content-addressed LRU cache for Zotero attachments.
+
+    Parameters:
+    ----------
+    zot :       pyzotero.zotero.Zotero instance
+    path :      folder to store the cache in
+    max_size :  max size of the cache in bytes
+    on_download : function called as on_download(key, path) after an
+                attachment has been downloaded (e.g. to index its text)
+    """
+
+    def __init__(self, zot, path, max_size=2 * 1024 ** 3, on_download=None):
+        self.zot = zot
+        self.path = path
+        self.max_size = max_size
+        self.on_download = on_download
+        self.lock = threading.Lock()
+        #{ path : number of pins }
+        self.pinned = {}
+        self.hits = self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, md5, filename):
+        return os.path.join(self.path, md5 + os.path.splitext(filename)[1].lower())
+
+    def pin(self, f):
+        """ Protects a cached file from eviction until unpin(f). """
+        with self.lock:
+            self.pinned[f] = self.pinned.get(f, 0) + 1
+
+    def unpin(self, f):
+        with self.lock:
+            if self.pinned.get(f, 0) > 1:
+                self.pinned[f] -= 1
+            else:
+                self.pinned.pop(f, None)
+
+    def get(self, attachment, pin=False):
+        """ Returns path to the cached file for an attachment - downloads it
+        if not cached or changed.
+
+        Parameters:
+        ----------
+        attachment :    attachment's item data (needs 'key', 'version' and
+                        'filename')
+        pin :           if True, the file is pinned (see pin()) before it is
+                        returned - call unpin() once done with it
+        """
+        key = attachment['key']
+        with self.lock:
+            with shelve.open(os.path.join(self.path, 'index')) as index:
+                entry = index.get(key)
+
+            if entry and entry['version'] == attachment.get('version'):
+                f = self._file(entry['md5'], entry['filename'])
+                if os.path.isfile(f):
+                    #Mark as recently used
+                    os.utime(f)
+                    self.hits += 1
+                    if pin:
+                        self.pinned[f] = self.pinned.get(f, 0) + 1
+                    return f
+
+        self.misses += 1
+        content = self.zot.file(key)
+        md5 = hashlib.md5(content).hexdigest()
+        f = self._file(md5, attachment['filename'])
+
+        #Pinned while it is written so that other threads can't evict it
+        self.pin(f)
+
+        try:
+            #Identical content may already be cached for another attachment
+            if not os.path.isfile(f):
+                tmp = f + '.%i.tmp' % threading.get_ident()
+                with open(tmp, 'wb') as fh:
+                    fh.write(content)
+                os.replace(tmp, f)
+            else:
+                os.utime(f)
+
+            with self.lock:
+                with shelve.open(os.path.join(self.path, 'index')) as index:
+                    index[key] = {'version': attachment.get('version'), 'md5': md5,
+                                  'filename': attachment['filename']}
+        except Exception:
+            self.unpin(f)
+            raise
+
+        logger.debug('Cached Zotero attachment %s (%i bytes)' % (key, len(content)))
+        self.evict()
+        if not pin:
+            self.unpin(f)
+        if self.on_download:
+            self.on_download(key, f)
+        return f
+
+    def files(self):
+        """ Returns { attachment key : path } for attachments currently in
+        the cache.
+        """
+        with self.lock:
+            with shelve.open(os.path.join(self.path, 'index')) as index:
+                entries = dict(index)
+        files = {k: self._file(e['md5'], e['filename']) for k, e in entries.items()}
+        return {k: f for k, f in files.items() if os.path.isfile(f)}
+
+    def evict(self):
+        """ Removes least recently used files until the cache is below its
+        size limit. Never removes pinned files.
+        """
+        with self.lock:
+            entries = []
+            total = 0
+            for e in os.listdir(self.path):
+                p = os.path.join(self.path, e)
+                if not CONTENT_FILE.match(e):
+                    continue
+                try:
+                    size = os.path.getsize(p)
+                    if p not in self.pinned:
+                        entries.append((os.path.getmtime(p), size, p))
+                except OSError:
+                    continue
+                total += size
+
+            for mtime, size, p in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(p)
+                except OSError:
+                    continue
+                total -= size
+                logger.debug('Evicted Zotero attachment %s' % os.path.basename(p))
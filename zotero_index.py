@@ -0,0 +1,340 @@
+"""
+    Local index of the Zotero library
+    zotero_index.py is part of Catbot (https://github.com/flyconnectome/catbot)
+    Copyright (C) 2017 Philipp Schlegel
+
+    Keeps a copy of the group library's items in SQLite with a full-text
+    (FTS5) index over title, authors, tags and date. The copy is synced
+    incrementally: Zotero's library version is stored and only items changed
+    (or deleted) since that version are requested.
+
+    The text of PDF attachments goes into a second FTS5 index (an inverted
+    index ranked by bm25). Text is taken from Zotero's full-text API, again
+    only for attachments whose text changed since the last sync. PDFs that
+    Zotero has no text for are extracted locally with pdftotext (poppler) in
+    a background thread once they are in the attachment cache. Each local
+    extraction is recorded (also if it failed), so a file is only tried once.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json, logging, os, queue, re, shutil, sqlite3, subprocess, threading, time
+from contextlib import contextmanager
+
+logger = logging.getLogger('pybotLog')
+
+#Min number of seconds between two syncs with the Zotero server
+SYNC_INTERVAL = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    key         TEXT PRIMARY KEY,
+    version     INTEGER,
+    item_type   TEXT,
+    parent      TEXT,
+    title       TEXT,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_parent ON items(parent);
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+    key UNINDEXED, title, creators, tags, date
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS fulltext_fts USING fts5(
+    key UNINDEXED, parent UNINDEXED, content
+);
+CREATE TABLE IF NOT EXISTS extracted (
+    key         TEXT PRIMARY KEY,
+    file        TEXT,
+    ok          INTEGER
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name        TEXT PRIMARY KEY,
+    value       TEXT
+);
+"""
+
+#Item types that are not publications
+NON_PUBLICATIONS = ('attachment', 'note')
+
+
+def extract_text(path):
+    """ Extracts text from a PDF with pdftotext. Returns None if pdftotext
+    is not installed or fails.
+    """
+    if not shutil.which('pdftotext'):
+        return None
+    try:
+        return subprocess.run(['pdftotext', '-q', path, '-'], check=True,
+                              stdout=subprocess.PIPE,
+                              timeout=120).stdout.decode('utf-8', 'ignore')
+    except (subprocess.SubprocessError, OSError):
+        logger.warning('Unable to extract text from %s' % path, exc_info=True)
+        return None
+
+
+def fts_query(terms):
+    """ Turns search terms into an FTS5 query: all terms have to match, each
+    as a prefix (e.g. 'neur' matches 'neuron').
+    """
+    tokens = [t for term in terms for t in re.findall(r'\w+', term.lower())]
+    return ' AND '.join('"%s"*' % t for t in tokens)
+
+
+class zotero_index:
+    """ SQLite copy of a Zotero library.
+
+    Parameters:
+    ----------
+    zot :       pyzotero.zotero.Zotero instance
+    path :      filename of the SQLite database
+    """
+
+    def __init__(self, zot, path='zotero.sqlite', sync_interval=SYNC_INTERVAL):
+        self.zot = zot
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_lock = threading.Lock()
+        self.last_sync = 0
+        self.extract_queue = queue.Queue()
+        self.extractor = None
+
+        with self.transaction() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """ Yields a connection - commits on success, rolls back on error.
+        """
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    @property
+    def library_version(self):
+        with self.transaction() as con:
+            row = con.execute("SELECT value FROM meta WHERE name = 'library_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def sync(self, force=False):
+        """ Fetches items changed since the last sync and indexes new
+        attachment text (see sync_fulltext()). Does nothing if the last sync
+        was less than sync_interval seconds ago (unless forced).
+
+        Returns:
+        -------
+        list of keys of changed items
+        """
+        with self.sync_lock:
+            if not force and time.time() - self.last_sync < self.sync_interval:
+                return []
+
+            since = self.library_version
+            #Ask for the version first: items changed while we are syncing
+            #are simply fetched again next time
+            version = self.zot.last_modified_version()
+            if version == since:
+                self.sync_fulltext()
+                self.last_sync = time.time()
+                return []
+
+            items = self.zot.everything(self.zot.items(since=since))
+            deleted = self.zot.deleted(since=since).get('items', []) if since else []
+
+            with self.transaction() as con:
+                for i in items:
+                    self._put(con, i['data'])
+                for key in deleted:
+                    con.execute('DELETE FROM items WHERE key = ?', (key, ))
+                    con.execute('DELETE FROM items_fts WHERE key = ?', (key, ))
+                    con.execute('DELETE FROM fulltext_fts WHERE key = ?', (key, ))
+                    con.execute('DELETE FROM extracted WHERE key = ?', (key, ))
+                con.execute("INSERT OR REPLACE INTO meta VALUES ('library_version', ?)",
+                            (str(version), ))
+
+            self.sync_fulltext()
+
+            self.last_sync = time.time()
+            logger.info('Synced Zotero library to version %i: %i items changed, '
+                        '%i deleted' % (version, len(items), len(deleted)))
+            return [i['key'] for i in items]
+
+    def _meta(self, con, name, default=None):
+        row = con.execute('SELECT value FROM meta WHERE name = ?', (name, )).fetchone()
+        return row[0] if row else default
+
+    def sync_fulltext(self):
+        """ Indexes text (from Zotero) of attachments that changed since
+        the last call.
+
+        Returns:
+        -------
+        number of newly indexed attachments
+        """
+        with self.transaction() as con:
+            since = int(self._meta(con, 'fulltext_version', 0))
+
+        versions = self.zot.new_fulltext(since=since)
+        n = 0
+        for key, version in versions.items():
+            try:
+                content = self.zot.fulltext_item(key).get('content', '')
+            except Exception:
+                logger.warning('Unable to get full text of %s' % key, exc_info=True)
+                continue
+            self.add_fulltext(key, content)
+            n += 1
+
+        if versions:
+            with self.transaction() as con:
+                con.execute("INSERT OR REPLACE INTO meta VALUES ('fulltext_version', ?)",
+                            (str(max(versions.values())), ))
+
+        if n:
+            logger.info('Indexed text of %i Zotero attachments' % n)
+        return n
+
+    def add_fulltext(self, key, content):
+        """ Adds (or replaces) the text of attachment key. """
+        with self.transaction() as con:
+            row = con.execute('SELECT parent FROM items WHERE key = ?',
+                              (key, )).fetchone()
+            con.execute('DELETE FROM fulltext_fts WHERE key = ?', (key, ))
+            con.execute('INSERT INTO fulltext_fts VALUES (?, ?, ?)',
+                        (key, row[0] if row and row[0] else key, content))
+
+    def queue_extraction(self, key, path):
+        """ Queues local text extraction of a cached attachment (e.g. as
+        attachment_cache's on_download). Does nothing if pdftotext is not
+        installed.
+        """
+        if not shutil.which('pdftotext'):
+            return
+        self.extract_queue.put((key, path))
+        if self.extractor is None:
+            self.extractor = threading.Thread(target=self._extract_queued,
+                                              name='zotero_extract',
+                                              daemon=True)
+            self.extractor.start()
+
+    def _extract_queued(self):
+        while True:
+            key, path = self.extract_queue.get()
+            try:
+                self._extract(key, path)
+            except Exception:
+                logger.error('Failed to index text of %s' % key, exc_info=True)
+
+    def _extract(self, key, path):
+        """ Extracts text of a cached file unless Zotero already provided
+        text or this file has been tried before.
+        """
+        with self.transaction() as con:
+            if con.execute('SELECT 1 FROM fulltext_fts WHERE key = ?',
+                           (key, )).fetchone():
+                return
+            row = con.execute('SELECT file FROM extracted WHERE key = ?',
+                              (key, )).fetchone()
+        #Cached files are named after their content's MD5
+        if row and row[0] == os.path.basename(path):
+            return
+        #May have been evicted in the meantime
+        if not os.path.isfile(path):
+            return
+
+        content = extract_text(path)
+        if content and content.strip():
+            self.add_fulltext(key, content)
+            logger.debug('Indexed text of Zotero attachment %s' % key)
+        with self.transaction() as con:
+            con.execute('INSERT OR REPLACE INTO extracted VALUES (?, ?, ?)',
+                        (key, os.path.basename(path), bool(content and content.strip())))
+
+    def search_fulltext(self, terms, limit=10):
+        """ Searches the text of attachments - all terms have to match (as
+        prefixes).
+
+        Returns:
+        -------
+        list of (item data, snippet) - best matches first. Item data is that
+        of the attachment's parent (if known)
+        """
+        query = fts_query(terms)
+        if not query:
+            return []
+
+        with self.transaction() as con:
+            rows = con.execute("SELECT parent, snippet(fulltext_fts, 2, '*', '*', '...', 24) "
+                               "FROM fulltext_fts WHERE fulltext_fts MATCH ? "
+                               "ORDER BY bm25(fulltext_fts) LIMIT ?",
+                               (query, limit)).fetchall()
+
+        results = []
+        for parent, snippet in rows:
+            data = self.get_item(parent) or {'key': parent}
+            results.append((data, ' '.join(snippet.split())))
+        return results
+
+    def _put(self, con, data):
+        con.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                    (data['key'], data.get('version'), data.get('itemType'),
+                     data.get('parentItem'), data.get('title'),
+                     json.dumps(data)))
+        con.execute('DELETE FROM items_fts WHERE key = ?', (data['key'], ))
+        if data.get('itemType') not in NON_PUBLICATIONS:
+            con.execute('INSERT INTO items_fts VALUES (?, ?, ?, ?, ?)',
+                        (data['key'], data.get('title', ''),
+                         ' '.join(c.get('lastName', c.get('name', ''))
+                                  for c in data.get('creators', [])),
+                         ' '.join(t['tag'] for t in data.get('tags', [])),
+                         data.get('date', '')))
+
+    def search(self, terms, limit=None):
+        """ Returns data of publications matching all terms (in title,
+        authors, tags or date), best matches first.
+        """
+        query = fts_query(terms)
+        if not query:
+            return []
+
+        sql = 'SELECT i.data FROM items_fts f JOIN items i ON i.key = f.key ' \
+              'WHERE items_fts MATCH ? ORDER BY bm25(items_fts)'
+        if limit:
+            sql += ' LIMIT %i' % limit
+        with self.transaction() as con:
+            return [json.loads(r[0]) for r in con.execute(sql, (query, ))]
+
+    def get_item(self, key):
+        """ Returns item data (None if unknown). """
+        with self.transaction() as con:
+            row = con.execute('SELECT data FROM items WHERE key = ?',
+                              (key.upper(), )).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_pdf(self, parent):
+        """ Returns data of the full text PDF attached to item parent (None if
+        there is none).
+        """
+        with self.transaction() as con:
+            rows = con.execute("SELECT data FROM items WHERE parent = ? AND "
+                               "item_type = 'attachment'", (parent.upper(), ))
+            for r in rows:
+                data = json.loads(r[0])
+                if data.get('contentType') == 'application/pdf' \
+                   or data.get('title') == 'Full Text PDF':
+                    return data
+        return None